@@ -0,0 +1,116 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Measure the memory used to diff and upload a Git commit adding large binaries.
+
+A temporary repository is created with a commit adding `--files` binaries of
+`--size` MB. The diff is created and its files uploaded with the Conduit calls
+mocked, once with the binaries read in memory (as when they're smaller than
+`MAX_TEXT_SIZE`) and once written to temporary files. The peak memory and the
+memory kept by the diff are measured with `tracemalloc`, which doesn't count the
+pages of the temporary files mapped by the upload as they're backed by the files.
+
+    python dev/benchmarks/binary_upload.py --files 3 --size 50
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
+
+from mozphab import environment  # noqa: E402
+from mozphab.commits import Commit  # noqa: E402
+from mozphab.conduit import conduit  # noqa: E402
+from mozphab.git import Git  # noqa: E402
+from mozphab.simplecache import content_cache  # noqa: E402
+
+CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def git(path, *args) -> str:
+    return subprocess.check_output(["git"] + list(args), cwd=path).decode()
+
+
+def create_repo(path: str, files: int, size: int) -> str:
+    git(path, "init", "-q")
+    git(path, "config", "user.email", "bench@example.com")
+    git(path, "config", "user.name", "Bench")
+    Path(path, ".arcconfig").write_text('{"phabricator.uri": "https://phab.test"}')
+    git(path, "add", ".arcconfig")
+    git(path, "commit", "-q", "-m", "initial")
+    for i in range(files):
+        Path(path, f"asset{i}.bin").write_bytes(os.urandom(size))
+    git(path, "add", "-A")
+    git(path, "commit", "-q", "-m", "assets")
+    return git(path, "rev-parse", "HEAD").strip()
+
+
+def call(method, args):
+    if method == "file.allocate":
+        return {"filePHID": "PHID-FILE-1", "upload": True}
+    return {}
+
+
+def run(name: str, repo: Git, node: str, max_text_size: int):
+    content_cache.clear()
+    repo._blob_sizes = {}
+    conduit._content_hashes.clear()
+
+    def upload_chunks(file_phid, data):
+        # Each chunk is copied once to be encoded.
+        view = memoryview(data)
+        for start in range(0, len(view), CHUNK_SIZE):
+            call("file.uploadchunk", {"data": bytes(view[start : start + CHUNK_SIZE])})
+
+    with mock.patch.object(environment, "MAX_TEXT_SIZE", max_text_size), mock.patch(
+        "mozphab.conduit.ConduitAPI.call", side_effect=call
+    ), mock.patch(
+        "mozphab.conduit.ConduitAPI.upload_chunks", side_effect=upload_chunks
+    ), mock.patch("mozphab.conduit.cache") as m_cache:
+        m_cache.__contains__.return_value = False
+        tracemalloc.start()
+        start = time.perf_counter()
+        diff = repo.get_diff(Commit(node=node))
+        diff_kept, diff_peak = tracemalloc.get_traced_memory()
+        conduit.upload_files_from_diff(diff)
+        elapsed = time.perf_counter() - start
+        _kept, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    print(
+        f"{name:<8} diff peak: {diff_peak / 2**20:7.1f} MB"
+        f"   diff kept: {diff_kept / 2**20:7.1f} MB"
+        f"   upload peak: {peak / 2**20:7.1f} MB"
+        f"   wall time: {elapsed * 1000:8.1f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=3)
+    parser.add_argument("--size", type=int, default=50, help="MB per file")
+    args = parser.parse_args()
+
+    size = args.size * 2**20
+    with tempfile.TemporaryDirectory() as path:
+        node = create_repo(path, args.files, size)
+        os.chdir(path)
+        repo = Git(path)
+        repo.args = argparse.Namespace(lesscontext=False)
+        print(f"commit adding {args.files} binaries of {args.size} MB")
+        run("read", repo, node, size + 1)
+        run("spooled", repo, node, environment.MAX_TEXT_SIZE)
+        repo.git.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Compare the peak memory of encoding a `differential.creatediff` request body at
+once against streaming it in chunks.
+
+A diff of files with a single large hunk each is built, then the form encoded
+body is produced with `urlencode(json.dumps(...)).encode()` and by iterating a
+`ConduitRequestBody` (counting its length first, as the transport does). Peak
+memory above the diff itself is measured with `tracemalloc`.
+
+    python dev/benchmarks/conduit_body.py --files 20 --lines 50000
+"""
+
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+import urllib.parse as url_parse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
+
+from mozphab.conduit import ConduitRequestBody  # noqa: E402
+from mozphab.diff import Diff  # noqa: E402
+
+
+def create_diff(files: int, lines: int) -> Diff:
+    diff = Diff()
+    for i in range(files):
+        change = diff.change_for(f"file{i}.txt")
+        hunk_lines = [f'+line {n} of "file {i}" ą\n' for n in range(lines)]
+        change.hunks.append(
+            Diff.Hunk(old_off=0, old_len=0, new_off=1, new_len=lines, lines=hunk_lines)
+        )
+    return diff
+
+
+def encode_at_once(params: dict) -> int:
+    body = url_parse.urlencode(
+        {
+            "params": json.dumps(params, separators=(",", ":")),
+            "output": "json",
+            "__conduit__": True,
+        }
+    ).encode()
+    return len(body)
+
+
+def encode_streaming(params: dict) -> int:
+    body = ConduitRequestBody(params)
+    length = len(body)
+    sent = sum(len(chunk) for chunk in body)
+    assert sent == length
+    return sent
+
+
+def run(name: str, params: dict, encode, corpus_size: int):
+    tracemalloc.start()
+    start = time.perf_counter()
+    size = encode(params)
+    elapsed = time.perf_counter() - start
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(
+        f"{name:<10} body: {size / 2**20:8.1f} MB"
+        f"   peak: {peak / 2**20:8.1f} MB ({peak / corpus_size:5.2f}x the hunks)"
+        f"   wall time: {elapsed * 1000:8.1f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument("--lines", type=int, default=50000)
+    args = parser.parse_args()
+
+    diff = create_diff(args.files, args.lines)
+    params = {
+        "changes": [change.to_conduit("0" * 40) for change in diff.changes.values()],
+        "__conduit__": {"token": "api-token"},
+    }
+    corpus_size = sum(
+        len(hunk.corpus) for change in diff.changes.values() for hunk in change.hunks
+    )
+    print(f"{args.files} files of {args.lines} lines: {corpus_size / 2**20:.1f} MB")
+    run("at once", params, encode_at_once, corpus_size)
+    run("streaming", params, encode_streaming, corpus_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Measure the memory used to hold the hunks of a large generated change.
+
+A file of `--lines` lines is added as a whole (like a new file is) and parsed
+from a `git diff` of it modifying every other line. The peak memory while
+building the hunks and the memory kept by the `Diff` afterwards are measured
+with `tracemalloc`, relative to the size of the hunk corpus.
+
+    python dev/benchmarks/diff_memory.py --lines 50000
+"""
+
+import argparse
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
+
+from mozphab.diff import Diff  # noqa: E402
+from mozphab.mercurial import Mercurial  # noqa: E402
+
+
+def added_file(lines: int) -> str:
+    return "".join(f"line {n} of the generated file\n" for n in range(lines))
+
+
+def modifying_diff(lines: int) -> bytes:
+    hunk = []
+    for n in range(lines):
+        if n % 2:
+            hunk.append(f"-line {n} of the generated file\n")
+            hunk.append(f"+line {n} of the changed file\n")
+        else:
+            hunk.append(f" line {n} of the generated file\n")
+    return (
+        "diff --git a/file b/file\n"
+        "--- a/file\n"
+        "+++ b/file\n"
+        f"@@ -1,{lines} +1,{lines} @@\n" + "".join(hunk)
+    ).encode("utf-8")
+
+
+def add(diff: Diff, body: str):
+    Mercurial._add_hunk(diff.change_for("added"), body)
+
+
+def modify(diff: Diff, git_diff: bytes):
+    diff.change_for("modified").from_git_diff(git_diff)
+
+
+def run(name: str, build, text):
+    diff = Diff()
+    tracemalloc.start()
+    start = time.perf_counter()
+    build(diff, text)
+    elapsed = time.perf_counter() - start
+    kept, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    change = next(iter(diff.changes.values()))
+    corpus = sum(len(hunk.corpus) for hunk in change.hunks)
+    print(
+        f"{name:<9} +{change.added:<6d} -{change.deleted:<6d}"
+        f"   peak: {peak / 2**20:6.1f} MB ({peak / corpus:5.2f}x the corpus)"
+        f"   kept: {kept / 2**20:6.1f} MB ({kept / corpus:5.2f}x)"
+        f"   wall time: {elapsed * 1000:7.1f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--lines", type=int, default=50000)
+    args = parser.parse_args()
+
+    print(f"change of {args.lines} lines")
+    run("added", add, added_file(args.lines))
+    run("modified", modify, modifying_diff(args.lines))
+
+
+if __name__ == "__main__":
+    main()
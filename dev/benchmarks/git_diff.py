@@ -0,0 +1,103 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Compare diffing each file of a commit with its own `git diff` against a single
+`git diff-tree -p` stream.
+
+A temporary repository is created with a commit modifying every file, the
+number of git processes spawned and the wall time of `Git.get_diff` are
+reported for both ways.
+
+    python dev/benchmarks/git_diff.py --files 500 --lines 200
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
+
+from mozphab.commits import Commit  # noqa: E402
+from mozphab.git import Git  # noqa: E402
+from mozphab.simplecache import content_cache  # noqa: E402
+
+
+def git(path, *args):
+    subprocess.check_call(["git"] + list(args), cwd=path, stdout=subprocess.DEVNULL)
+
+
+def create_repo(path: str, files: int, lines: int) -> str:
+    git(path, "init", "-q")
+    git(path, "config", "user.email", "bench@example.test")
+    git(path, "config", "user.name", "Bench")
+    Path(path, ".arcconfig").write_text('{"phabricator.uri": "https://phab.test"}')
+    for i in range(files):
+        content = "".join(f"file {i} line {n}\n" for n in range(lines))
+        Path(path, f"file{i}.txt").write_text(content)
+    git(path, "add", "-A")
+    git(path, "commit", "-q", "-m", "initial")
+
+    for i in range(files):
+        content = Path(path, f"file{i}.txt").read_text().splitlines(keepends=True)
+        content[lines // 2] = "changed\n"
+        Path(path, f"file{i}.txt").write_text("".join(content))
+    git(path, "commit", "-q", "-a", "-m", "change")
+    return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=path).decode()
+
+
+def run(name: str, path: str, node: str, rounds: int, single_process: bool):
+    spawned = 0
+    popen = subprocess.Popen
+
+    def counting_popen(*args, **kwargs):
+        nonlocal spawned
+        spawned += 1
+        return popen(*args, **kwargs)
+
+    elapsed = 0.0
+    for _ in range(rounds):
+        repo = Git(path)
+        repo.args = argparse.Namespace(lesscontext=False)
+        patches = mock.patch.object(Git, "_get_patches", return_value={})
+        with mock.patch("subprocess.Popen", counting_popen):
+            start = time.perf_counter()
+            if single_process:
+                diff = repo.get_diff(Commit(node=node.strip()))
+            else:
+                with patches:
+                    diff = repo.get_diff(Commit(node=node.strip()))
+            elapsed += time.perf_counter() - start
+        repo.git.close()
+        content_cache.clear()
+
+    print(
+        f"{name:<10} files: {len(diff.changes):5d}"
+        f"   spawns/diff: {spawned / rounds:7.1f}"
+        f"   wall time/diff: {elapsed / rounds * 1000:8.1f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=500)
+    parser.add_argument("--lines", type=int, default=200)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as path:
+        node = create_repo(path, args.files, args.lines)
+        os.chdir(path)
+        print(f"commit modifying {args.files} files of {args.lines} lines")
+        run("per-file", path, node, args.rounds, single_process=False)
+        run("diff-tree", path, node, args.rounds, single_process=True)
+
+
+if __name__ == "__main__":
+    main()
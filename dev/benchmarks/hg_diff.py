@@ -0,0 +1,101 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Compare diffing each file of a Mercurial commit on its own against a single
+`hg diff --git -c <node>` split per file.
+
+A temporary repository is created with a commit modifying, adding and removing
+files, the command server round trips and the wall time of
+`Mercurial.get_diff` are reported for both ways.
+
+    python dev/benchmarks/hg_diff.py --files 300 --lines 200
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
+
+from mozphab.commits import Commit  # noqa: E402
+from mozphab.mercurial import Mercurial  # noqa: E402
+from mozphab.simplecache import content_cache  # noqa: E402
+
+
+def hg(path, *args):
+    subprocess.check_call(["hg"] + list(args), cwd=path, stdout=subprocess.DEVNULL)
+
+
+def create_repo(path: str, files: int, lines: int) -> str:
+    hg(path, "init")
+    Path(path, ".arcconfig").write_text('{"phabricator.uri": "https://phab.test"}')
+    for i in range(files):
+        content = "".join(f"file {i} line {n}\n" for n in range(lines))
+        Path(path, f"file{i}.txt").write_text(content)
+    hg(path, "commit", "-A", "-u", "Bench", "-m", "initial")
+    hg(path, "phase", "--public", "-r", ".")
+
+    for i in range(files):
+        if i % 10 == 0:
+            Path(path, f"file{i}.txt").unlink()
+            Path(path, f"new{i}.txt").write_text(f"new file {i}\n")
+            continue
+        content = Path(path, f"file{i}.txt").read_text().splitlines(keepends=True)
+        content[lines // 2] = "changed\n"
+        Path(path, f"file{i}.txt").write_text("".join(content))
+    hg(path, "commit", "-A", "-u", "Bench", "-m", "change")
+    return subprocess.check_output(
+        ["hg", "log", "-r", ".", "-T", "{node}"], cwd=path
+    ).decode()
+
+
+def run(name: str, repo: Mercurial, node: str, rounds: int, whole_commit: bool):
+    rawcommand = repo.repository.rawcommand
+    patches = mock.patch.object(repo, "_get_patches", return_value={})
+    elapsed = 0.0
+    with mock.patch.object(repo.repository, "rawcommand", wraps=rawcommand) as m_raw:
+        for _ in range(rounds):
+            start = time.perf_counter()
+            if whole_commit:
+                diff = repo.get_diff(Commit(node=node))
+            else:
+                with patches:
+                    diff = repo.get_diff(Commit(node=node))
+            elapsed += time.perf_counter() - start
+            content_cache.clear()
+            repo._file_sizes = {}
+
+    print(
+        f"{name:<12} files: {len(diff.changes):5d}"
+        f"   round trips/diff: {m_raw.call_count / rounds:7.1f}"
+        f"   wall time/diff: {elapsed / rounds * 1000:8.1f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=300)
+    parser.add_argument("--lines", type=int, default=200)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as path:
+        node = create_repo(path, args.files, args.lines)
+        os.chdir(path)
+        repo = Mercurial(path)
+        repo.args = argparse.Namespace(lesscontext=False)
+        print(f"commit changing {args.files} files of {args.lines} lines")
+        run("per-file", repo, node, args.rounds, whole_commit=False)
+        run("whole-commit", repo, node, args.rounds, whole_commit=True)
+        repo.repository.close()
+
+
+if __name__ == "__main__":
+    main()
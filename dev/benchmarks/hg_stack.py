@@ -0,0 +1,80 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Compare the Mercurial command server round trips made to read a stack.
+
+A temporary repository is created with a stack of draft commits. The stack is
+read with `Mercurial.commit_stack`, and with the previous approach of one
+`hg log -r children(<node>)` per commit to detect branch points.
+
+    python dev/benchmarks/hg_stack.py --commits 100
+"""
+
+import argparse
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
+
+from mozphab.mercurial import Mercurial  # noqa: E402
+
+
+def hg(path, *args):
+    subprocess.check_call(["hg"] + list(args), cwd=path, stdout=subprocess.DEVNULL)
+
+
+def create_repo(path: str, commits: int):
+    hg(path, "init")
+    Path(path, ".arcconfig").write_text('{"phabricator.uri": "https://phab.test"}')
+    hg(path, "commit", "-A", "-u", "Bench", "-m", "initial", ".arcconfig")
+    hg(path, "phase", "--public", "-r", ".")
+    for i in range(commits):
+        Path(path, "file").write_text(f"{i}\n")
+        hg(path, "commit", "-A", "-u", "Bench", "-m", f"commit {i}")
+
+
+def per_commit_children(repo: Mercurial):
+    """Read the stack, then look for branch points one commit at a time."""
+    nodes = repo.hg_log(repo.revset)
+    for node in nodes:
+        repo.hg_log("children(%s)" % node)
+
+
+def run(name: str, repo: Mercurial, read_stack, rounds: int):
+    rawcommand = repo.repository.rawcommand
+    with mock.patch.object(repo.repository, "rawcommand", wraps=rawcommand) as m_raw:
+        start = time.perf_counter()
+        for _ in range(rounds):
+            read_stack(repo)
+        elapsed = time.perf_counter() - start
+
+    print(
+        f"{name:<10} round trips/stack: {m_raw.call_count / rounds:7.1f}"
+        f"   wall time/stack: {elapsed / rounds * 1000:8.1f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--commits", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as path:
+        create_repo(path, args.commits)
+        repo = Mercurial(path)
+        repo.revset = "draft()"
+        print(f"stack of {args.commits} draft commits")
+        run("per-commit", repo, per_commit_children, args.rounds)
+        run("template", repo, Mercurial.commit_stack, args.rounds)
+        repo.repository.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Measure the throughput of building the hunk showing a whole file.
+
+`create_hunk_corpus` is compared with splitting the body with `split_lines`,
+zipping it back with `join_lineseps` and prefixing each line (the previous
+`create_hunk_lines`), on files with LF, CRLF and mixed line endings from 1KB to
+`MAX_TEXT_SIZE`, with and without a newline at the end. Both must build the same
+corpus.
+
+    python dev/benchmarks/hunk_corpus.py --rounds 3
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
+
+from mozphab import environment, helpers  # noqa: E402
+
+SIZES = {
+    "1KB": 1024,
+    "64KB": 64 * 1024,
+    "1MB": 1024 * 1024,
+    "MAX_TEXT_SIZE": environment.MAX_TEXT_SIZE,
+}
+
+LINE_ENDINGS = {
+    "LF": ("\n",),
+    "CRLF": ("\r\n",),
+    # A lone carriage return doesn't end a line.
+    "mixed": ("\n", "\r\n", "\r still the same line\n"),
+}
+
+
+def generate_body(size: int, endings) -> str:
+    lines = []
+    length = 0
+    n = 0
+    while length < size:
+        line = f"line {n}, zażółć gęślą jaźń{endings[n % len(endings)]}"
+        lines.append(line)
+        length += len(line)
+        n += 1
+    return "".join(lines)
+
+
+def split_and_join(body: str, prefix: str):
+    lines = helpers.split_lines(body)
+    eof_missing_newline = lines[-1] != ""
+    last_line = lines.pop()
+    lines = [f"{prefix}{line}" for line in helpers.join_lineseps(lines)]
+    if eof_missing_newline:
+        lines.append(f"{prefix}{last_line}\n")
+        lines.append("\\ No newline at end of file\n")
+    return "".join(lines), len(lines) - eof_missing_newline, eof_missing_newline
+
+
+def timed(function, body, rounds: int):
+    elapsed = 0.0
+    for _ in range(rounds):
+        start = time.perf_counter()
+        result = function(body, "+")
+        elapsed += time.perf_counter() - start
+    return result, elapsed / rounds
+
+
+def run(name: str, body: str, rounds: int):
+    expected, reference_time = timed(split_and_join, body, rounds)
+    result, str_time = timed(helpers.create_hunk_corpus, body, rounds)
+    assert result == expected, f"{name}: different corpus from str"
+
+    encoded = body.encode("utf-8")
+    result, bytes_time = timed(helpers.create_hunk_corpus, encoded, rounds)
+    assert result == expected, f"{name}: different corpus from bytes"
+
+    megabytes = len(encoded) / 2**20
+    print(
+        f"{name:<26}"
+        f" split_lines: {megabytes / reference_time:7.1f} MB/s"
+        f"   corpus: {megabytes / str_time:7.1f} MB/s"
+        f"   corpus bytes: {megabytes / bytes_time:7.1f} MB/s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    for size_name, size in SIZES.items():
+        for endings_name, endings in LINE_ENDINGS.items():
+            body = generate_body(size, endings)
+            run(f"{size_name} {endings_name}", body, args.rounds)
+            run(f"{size_name} {endings_name} no-eol", body.rstrip("\n"), args.rounds)
+
+
+if __name__ == "__main__":
+    main()
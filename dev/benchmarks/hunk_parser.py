@@ -0,0 +1,116 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Measure the throughput of parsing the hunks of a unified diff.
+
+A diff with `--hunks` hunks of `--lines` lines is generated and parsed by
+decoding it, splitting it into lines and collecting the lines of each hunk (the
+previous `Diff.Change.from_git_diff`), and by `HunkParser` given the whole output
+at once or fed line by line, as it comes from `git diff-tree`.
+
+    python dev/benchmarks/hunk_parser.py --hunks 100 --lines 1000
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+from typing import List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
+
+from mozphab.diff import Diff, HunkParser  # noqa: E402
+
+
+def generate_diff(hunks: int, lines: int) -> bytes:
+    diff = ["diff --git a/file b/file\n--- a/file\n+++ b/file\n"]
+    for h in range(hunks):
+        offset = h * lines * 2 + 1
+        diff.append(f"@@ -{offset},{lines} +{offset},{lines} @@ section {h}\n")
+        for n in range(lines):
+            if n % 4 == 0:
+                diff.append(f"-line {n} of hunk {h}, zażółć\n")
+                diff.append(f"+line {n} of hunk {h}, changed\n")
+            else:
+                diff.append(f" line {n} of hunk {h}\n")
+    return "".join(diff).encode("utf-8")
+
+
+def split_lines(git_diff: bytes):
+    """Parse the lines of the decoded diff, one header at a time."""
+    hunks = []
+    hunk = {}
+    in_header = True
+    for line in git_diff.decode("utf-8").splitlines(keepends=True):
+        if in_header:
+            if not line.startswith("@@"):
+                continue
+            in_header = False
+
+        if line.startswith("@@"):
+            if hunk and hunk["lines"]:
+                hunks.append(Diff.Hunk(**hunk))
+            old_off, new_off, old_len, new_len = Diff.parse_git_diff(line)
+            hunk = {
+                "old_off": old_off,
+                "new_off": new_off,
+                "old_len": old_len,
+                "new_len": new_len,
+                "lines": [],
+            }
+        else:
+            hunk["lines"].append(line)
+    if hunk and hunk["lines"]:
+        hunks.append(Diff.Hunk(**hunk))
+    return hunks
+
+
+def parser_whole(git_diff: bytes):
+    return HunkParser.parse(git_diff)
+
+
+def parser_lines(lines: List[bytes]):
+    parser = HunkParser()
+    hunks = []
+    for line in lines:
+        hunks.extend(parser.feed(line))
+    hunks.extend(parser.close())
+    return hunks
+
+
+def run(name: str, parse, data, size: int, rounds: int):
+    elapsed = 0.0
+    for _ in range(rounds):
+        start = time.perf_counter()
+        hunks = parse(data)
+        elapsed += time.perf_counter() - start
+
+    megabytes = size * rounds / 2**20
+    print(
+        f"{name:<12} hunks: {len(hunks):5d}"
+        f"   {megabytes / elapsed:8.1f} MB/s"
+        f"   wall time: {elapsed / rounds * 1000:8.1f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--hunks", type=int, default=100)
+    parser.add_argument("--lines", type=int, default=1000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    git_diff = generate_diff(args.hunks, args.lines)
+    print(f"{args.hunks} hunks of {args.lines} lines: {len(git_diff) / 2**20:.1f} MB")
+    # The lines are split beforehand, as they're read from the process output.
+    lines = git_diff.splitlines(keepends=True)
+    size = len(git_diff)
+    run("split lines", split_lines, git_diff, size, args.rounds)
+    run("parser", parser_whole, git_diff, size, args.rounds)
+    run("parser/line", parser_lines, lines, size, args.rounds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Compare `urllib.request.urlopen` with the pooled keep-alive transport.
+
+A local stand-in Conduit server replays the requests made by a `submit` of a
+stack: a handful of sequential calls per commit plus concurrent file uploads.
+Each new connection is delayed to simulate the TCP/TLS handshake round trips
+to a remote server.
+
+    python dev/benchmarks/transport.py --commits 10 --handshake-ms 60
+"""
+
+import argparse
+import concurrent.futures
+import json
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
+
+from mozphab.transport import HTTPConnectionPool  # noqa: E402
+
+# Sequential Conduit calls made for each commit of the stack.
+CALLS_PER_COMMIT = (
+    "differential.creatediff",
+    "differential.revision.edit",
+    "differential.setdiffproperty",
+    "differential.revision.search",
+)
+# Files uploaded through `upload_files_from_diff` for each commit.
+UPLOADS_PER_COMMIT = 5
+
+
+class ConduitHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        body = json.dumps({"result": {}, "error_code": None}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ConduitServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handshake: float):
+        super().__init__(("127.0.0.1", 0), ConduitHandler)
+        self.handshake = handshake
+        self.connections = 0
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        super().process_request(request, client_address)
+
+    def finish_request(self, request, client_address):
+        time.sleep(self.handshake)
+        super().finish_request(request, client_address)
+
+
+def submit(urlopen, api_url: str, commits: int):
+    def call(method: str):
+        data = urllib.parse.urlencode({"params": "{}", "output": "json"}).encode()
+        request = urllib.request.Request(api_url + method, data=data, method="POST")
+        with urlopen(request) as r:
+            json.load(r)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
+        call("user.whoami")
+        for _commit in range(commits):
+            list(executor.map(call, ["file.upload"] * UPLOADS_PER_COMMIT))
+            for method in CALLS_PER_COMMIT:
+                call(method)
+
+
+def run(name: str, make_urlopen, commits: int, handshake: float, rounds: int):
+    """Time `rounds` submits, each one using a fresh `urlopen` like a new process."""
+    server = ConduitServer(handshake)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    api_url = "http://127.0.0.1:%s/api/" % server.server_address[1]
+    try:
+        start = time.perf_counter()
+        for _round in range(rounds):
+            submit(make_urlopen(), api_url, commits)
+        elapsed = (time.perf_counter() - start) / rounds
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    print(
+        f"{name:<10} handshakes/submit: {server.connections / rounds:7.1f}"
+        f"   wall time/submit: {elapsed * 1000:8.1f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--commits", type=int, default=10)
+    parser.add_argument("--handshake-ms", type=float, default=60.0)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    handshake = args.handshake_ms / 1000
+    print(f"submit of {args.commits} commits, {args.handshake_ms:.0f} ms per handshake")
+    run(
+        "urlopen",
+        lambda: urllib.request.urlopen,
+        args.commits,
+        handshake,
+        args.rounds,
+    )
+    run(
+        "pooled",
+        lambda: HTTPConnectionPool().urlopen,
+        args.commits,
+        handshake,
+        args.rounds,
+    )
+
+
+if __name__ == "__main__":
+    main()
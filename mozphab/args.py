@@ -46,6 +46,11 @@ def parse_args(argv: List[str]) -> argparse.Namespace:
     main_parser.add_argument(
         "--trace", "--debug", action="store_true", help=argparse.SUPPRESS
     )
+    main_parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Don't use the data cached from Phabricator by previous runs",
+    )
     parser = argparse.ArgumentParser(
         parents=[main_parser],
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -13,6 +13,7 @@ from .conduit import conduit
 from .environment import USER_AGENT
 from .exceptions import Error
 from .logger import logger
+from .transport import http_pool
 
 
 class BMOAPIError(Error):
@@ -28,7 +29,7 @@ class BMOAPI:
         logger.debug("%s %s", req_args["url"], self._sanitise_req(req_args))
 
         try:
-            with url_request.urlopen(url_request.Request(**req_args)) as r:
+            with http_pool.urlopen(url_request.Request(**req_args)) as r:
                 res = json.load(r)
         except (url_error.HTTPError, OSError) as err:
             raise BMOAPIError(err)
@@ -3,12 +3,16 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import argparse
-from typing import List
+import queue
+import threading
+import time
+from typing import List, Tuple
 
 from mozphab import environment
 from mozphab.commits import Commit
 from mozphab.conduit import conduit
 from mozphab.config import config
+from mozphab.diff import Diff
 from mozphab.exceptions import Error
 from mozphab.helpers import (
     BLOCKING_REVIEWERS_RE,
@@ -64,6 +68,12 @@ def amend_revision_url(body: str, new_url: str) -> str:
     return body
 
 
+def _sha1_changed(commit: Commit, diff: dict) -> bool:
+    """Return `True` if the diff was submitted from a different commit."""
+    diff_commits = diff["attachments"]["commits"]["commits"]
+    return bool(not diff_commits or commit.node != diff_commits[0]["identifier"])
+
+
 def show_commit_stack(
     commits: List[Commit],
     args: argparse.Namespace,
@@ -94,6 +104,19 @@ def show_commit_stack(
                 ]
                 diffs = conduit.get_diffs(phids=diff_phids) if diff_phids else {}
 
+            # preload the fingerprints of the diffs of commits with a new SHA1
+            changed_diff_ids = []
+            for commit in commits:
+                revision = revisions.get(commit.rev_id)
+                if commit.fingerprint and revision:
+                    diff = diffs[revision["fields"]["diffPHID"]]
+                    if _sha1_changed(commit, diff):
+                        changed_diff_ids.append(diff["id"])
+            fingerprints = {}
+            if changed_diff_ids and not args.force:
+                with wait_message("Loading diff fingerprints..."):
+                    fingerprints = conduit.get_diff_fingerprints(changed_diff_ids)
+
     for commit in reversed(commits):
         if show_updated_only and not commit.submit:
             continue
@@ -146,10 +169,14 @@ def show_commit_stack(
                 # and we're not adding reviewers to a revision without reviewers
                 # and we're not changing the bug ID
                 # then don't submit.
-                diff_phid = fields["diffPHID"]
-                diff_commits = diffs[diff_phid]["attachments"]["commits"]["commits"]
-                sha1_changed = bool(
-                    not diff_commits or commit.node != diff_commits[0]["identifier"]
+                diff = diffs[fields["diffPHID"]]
+                sha1_changed = _sha1_changed(commit, diff)
+                # The changes are the same if their fingerprint is, eg. after
+                # editing the commit message or its parent's. A commit with the
+                # same SHA1 has the same changes, without comparing them.
+                changes_unchanged = not sha1_changed or bool(
+                    commit.fingerprint
+                    and fingerprints.get(diff["id"]) == commit.fingerprint
                 )
                 if (
                     not sha1_changed
@@ -161,6 +188,10 @@ def show_commit_stack(
                 ):
                     commit.submit = False
 
+                # Don't create a new diff if the changes didn't change.
+                elif changes_unchanged and not args.force:
+                    commit.skip_diff = True
+
         else:
             action = action_template % "New"
 
@@ -172,6 +203,11 @@ def show_commit_stack(
                 )
                 continue
 
+            if commit.skip_diff:
+                logger.info(
+                    " * The changes are the same, the diff will not be updated."
+                )
+
             if revision:
                 if not commit.wip and revision_is_wip:
                     logger.warning(
@@ -454,6 +490,198 @@ def local_uplift_if_possible(
     return False
 
 
+class DiffPipeline:
+    """Create the local diffs of the commits ahead of their submission.
+
+    A diff only depends on the commit's tree, so the diffs of the next commits are
+    created in a background thread while the previous ones are being uploaded.
+    Up to `depth` diffs are created in advance, `0` creates each diff on request.
+
+    Repositories aren't thread safe, any other use of the repository while the
+    pipeline is running has to hold the `lock`.
+    """
+
+    def __init__(self, repo: Repository, commits: List[Commit], depth: int):
+        self.repo = repo
+        self.commits = [
+            commit for commit in commits if commit.submit and not commit.skip_diff
+        ]
+        self.depth = max(depth, 0)
+        self.lock = threading.RLock()
+        # Time spent creating diffs, and time spent waiting for them.
+        self.create_time = 0.0
+        self.wait_time = 0.0
+        self._queue: queue.Queue = queue.Queue(maxsize=self.depth or 1)
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        if self.depth and len(self.commits) > 1:
+            self._thread = threading.Thread(target=self._create_diffs, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+            overlap = max(self.create_time - self.wait_time, 0.0)
+            logger.debug(
+                "Created %s diffs in %.2fs, %.2fs (%d%%) overlapped with submission",
+                len(self.commits),
+                self.create_time,
+                overlap,
+                100 * overlap / self.create_time if self.create_time else 0,
+            )
+
+    def get_diff(self, commit: Commit) -> Diff:
+        """Return the diff of the next commit to submit."""
+        if not self._thread:
+            with self.lock:
+                return self.repo.get_diff(commit)
+
+        start = time.perf_counter()
+        diff_commit, diff, error = self._queue.get()
+        self.wait_time += time.perf_counter() - start
+        if error:
+            raise error
+
+        assert diff_commit is commit, "diffs requested out of order"
+        return diff
+
+    def _create_diffs(self):
+        for commit in self.commits:
+            start = time.perf_counter()
+            diff, error = None, None
+            try:
+                with self.lock:
+                    diff = self.repo.get_diff(commit)
+            except Exception as e:
+                error = e
+            self.create_time += time.perf_counter() - start
+
+            # Wait for a free slot, unless the submission has stopped.
+            while not self._stopped.is_set():
+                try:
+                    self._queue.put((commit, diff, error), timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+
+            if error or self._stopped.is_set():
+                return
+
+
+def _submit_commits(
+    repo: Repository,
+    args: argparse.Namespace,
+    commits: List[Commit],
+    pipeline: DiffPipeline,
+    avoid_local_changes: bool,
+    diffs: List[Tuple[Diff, Commit]],
+):
+    """Submit the commits in order, with their diffs created by the `pipeline`.
+
+    The submitted diffs are added to `diffs` with their commits, the metadata of
+    the diffs is set once the commits are amended.
+    """
+    previous_commit = None
+    for commit in commits:
+        if not commit.submit:
+            previous_commit = commit
+            continue
+
+        # Only revisions being updated have an ID. Newly created ones don't.
+        is_update = bool(commit.rev_id)
+
+        # Let the user know something's happening.
+        if is_update:
+            logger.info("\nUpdating revision D%s:", commit.rev_id)
+        else:
+            logger.info("\nCreating new revision:")
+
+        logger.info("%s %s", commit.name, commit.revision_title())
+
+        # Create a diff if needed
+        diff = None
+        if not commit.skip_diff:
+            with wait_message("Creating local diff..."):
+                diff = pipeline.get_diff(commit)
+
+        if diff:
+            telemetry().submission.files_count.add(len(diff.changes))
+            with wait_message("Uploading binary file(s)..."):
+                conduit.upload_files_from_diff(diff)
+
+            with wait_message("Submitting the diff..."):
+                result = conduit.submit_diff(diff, commit)
+                diff.phid = result["phid"]
+                diff.id = result["diffid"]
+
+        if is_update:
+            with wait_message("Updating revision..."):
+                rev = conduit.update_revision(
+                    commit,
+                    diff_phid=diff.phid if diff else None,
+                    comment=args.message,
+                )
+        else:
+            with wait_message("Creating a new revision..."):
+                rev = conduit.create_revision(
+                    commit,
+                    diff.phid,
+                    # Set the parent revision if one is available.
+                    parent_rev_phid=(
+                        previous_commit.rev_phid if previous_commit else None
+                    ),
+                )
+
+        # Set revision ID and PHID from the Conduit API response.
+        commit.rev_id = rev["object"]["id"]
+        commit.rev_phid = rev["object"]["phid"]
+
+        revision_url = "%s/D%s" % (repo.phab_url, commit.rev_id)
+
+        # Append/replace div rev url to/in commit description.
+        body = amend_revision_url(commit.body, revision_url)
+
+        # Amend the commit if required.
+        # As commit rewriting can be expensive we avoid it in some circumstances, such
+        # as pre-pending "WIP: " to commits submitted as WIP to Phabricator.
+        if commit.title_preview != commit.title or body != commit.body:
+            commit.title = commit.title_preview
+            commit.body = body
+
+            if not avoid_local_changes:
+                with wait_message("Updating commit.."), pipeline.lock:
+                    repo.amend_commit(commit, commits)
+
+        if diff:
+            diffs.append((diff, commit))
+
+        previous_commit = commit
+
+
+def _finish_submission(
+    repo: Repository, args: argparse.Namespace, commits: List[Commit]
+):
+    """Amend the submitted commits and refresh the stack."""
+    # The public nodes of the amended commits are known until they're written.
+    repo.load_public_nodes(
+        [commit.node for commit in commits]
+        + [commit.parent for commit in commits if commit.parent]
+    )
+
+    # Cleanup (eg. strip nodes) and refresh to ensure the stack is right for the
+    # final showing.
+    with wait_message("Cleaning up.."):
+        if args.command != "uplift":
+            repo.finalize(commits)
+        repo.after_submit()
+        repo.cleanup()
+        repo.refresh_commit_stack(commits)
+
+
 def _submit(repo: Repository, args: argparse.Namespace):
     telemetry().submission.preparation_time.start()
     with wait_message("Checking connection to Phabricator."):
@@ -486,6 +714,11 @@ def _submit(repo: Repository, args: argparse.Namespace):
         if args.command == "uplift":
             update_commits_for_uplift(commits, repo)
         update_commit_title_previews(commits)
+        repo.set_diff_fingerprints(commits)
+        repo.load_public_nodes(
+            [commit.node for commit in commits]
+            + [commit.parent for commit in commits if commit.parent]
+        )
 
     # Display a one-line summary of commit and WIP count.
     commit_count = len(commits)
@@ -559,92 +792,27 @@ def _submit(repo: Repository, args: argparse.Namespace):
     # Process.
     telemetry().submission.process_time.start()
 
-    previous_commit = None
-    for commit in commits:
-        if not commit.submit:
-            previous_commit = commit
-            continue
-
-        # Only revisions being updated have an ID. Newly created ones don't.
-        is_update = bool(commit.rev_id)
-
-        # Let the user know something's happening.
-        if is_update:
-            logger.info("\nUpdating revision D%s:", commit.rev_id)
-        else:
-            logger.info("\nCreating new revision:")
-
-        logger.info("%s %s", commit.name, commit.revision_title())
-
-        # Create a diff if needed
-        with wait_message("Creating local diff..."):
-            diff = repo.get_diff(commit)
-
-        if diff:
-            telemetry().submission.files_count.add(len(diff.changes))
-            with wait_message("Uploading binary file(s)..."):
-                conduit.upload_files_from_diff(diff)
-
-            with wait_message("Submitting the diff..."):
-                result = conduit.submit_diff(diff, commit)
-                diff.phid = result["phid"]
-                diff.id = result["diffid"]
-
-        if is_update:
-            with wait_message("Updating revision..."):
-                rev = conduit.update_revision(
-                    commit,
-                    diff_phid=diff.phid,
-                    comment=args.message,
-                )
-        else:
-            with wait_message("Creating a new revision..."):
-                rev = conduit.create_revision(
-                    commit,
-                    diff.phid,
-                    # Set the parent revision if one is available.
-                    parent_rev_phid=(
-                        previous_commit.rev_phid if previous_commit else None
-                    ),
-                )
-
-        # Set revision ID and PHID from the Conduit API response.
-        commit.rev_id = rev["object"]["id"]
-        commit.rev_phid = rev["object"]["phid"]
-
-        revision_url = "%s/D%s" % (repo.phab_url, commit.rev_id)
-
-        # Append/replace div rev url to/in commit description.
-        body = amend_revision_url(commit.body, revision_url)
-
-        # Amend the commit if required.
-        # As commit rewriting can be expensive we avoid it in some circumstances, such
-        # as pre-pending "WIP: " to commits submitted as WIP to Phabricator.
-        if commit.title_preview != commit.title or body != commit.body:
-            commit.title = commit.title_preview
-            commit.body = body
-
-            if not avoid_local_changes:
-                with wait_message("Updating commit.."):
-                    repo.amend_commit(commit, commits)
-
-        # Diff property has to be set after potential SHA1 change.
-        if diff:
-            with wait_message("Setting diff metadata..."):
+    diffs = []
+    try:
+        with DiffPipeline(repo, commits, config.pipeline_depth) as pipeline:
+            _submit_commits(repo, args, commits, pipeline, avoid_local_changes, diffs)
+    except BaseException:
+        # Amend the commits submitted before the failure, otherwise they would
+        # lose their revision URL and be submitted as new revisions next time.
+        # Their diffs miss their metadata, so they're uploaded again then.
+        logger.warning("\nSubmission failed, updating the submitted commits")
+        _finish_submission(repo, args, commits)
+        raise
+
+    _finish_submission(repo, args, commits)
+
+    # Diff property has to be set after potential SHA1 change.
+    if diffs:
+        with wait_message("Setting diff metadata..."):
+            for diff, commit in diffs:
                 message = commit.build_arc_commit_message()
                 conduit.set_diff_property(diff.id, commit, message)
 
-        previous_commit = commit
-
-    # Cleanup (eg. strip nodes) and refresh to ensure the stack is right for the
-    # final showing.
-    with wait_message("Cleaning up.."):
-        if args.command != "uplift":
-            repo.finalize(commits)
-        repo.after_submit()
-        repo.cleanup()
-        repo.refresh_commit_stack(commits)
-
     logger.warning("\nCompleted")
     show_commit_stack(
         commits, args, validate=False, show_rev_urls=True, show_updated_only=True
@@ -56,6 +56,8 @@ class Commit:
     rev_phid: Optional[str] = None
     wip: Optional[bool] = None
     tree_hash: Optional[str] = None
+    fingerprint: Optional[str] = None
+    skip_diff: bool = False
     reviewers: Dict[str, List[str]] = field(default_factory=dict)
 
     @property
@@ -2,20 +2,23 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-import base64
+import binascii
 import concurrent.futures
 import datetime
 import hashlib
 import json
 import operator
 import os
+import string
 import urllib.parse as url_parse
 import urllib.request as url_request
 from typing import (
     Any,
     Dict,
+    Iterator,
     List,
     Optional,
+    Tuple,
 )
 
 from .commits import Commit
@@ -28,12 +31,51 @@ from .exceptions import (
     NotFoundError,
 )
 from .helpers import (
+    SpooledContents,
+    contents_view,
     get_arcrc_path,
     read_json_field,
     strip_differential_revision,
 )
 from .logger import logger
 from .simplecache import cache
+from .transport import MAX_CONNECTIONS_PER_HOST, http_pool
+
+# Number of chunks of a single file uploaded in parallel, and the number of times
+# incomplete chunks are queried and uploaded.
+UPLOAD_CHUNK_WORKERS = 4
+UPLOAD_CHUNK_ATTEMPTS = 3
+
+# Maximum number of results returned in a single page by the `*.search` methods,
+# we split longer constraint lists into chunks of this size.
+SEARCH_CHUNK_SIZE = 100
+
+# Conduit methods which only read data, by the last part of their name. Their
+# requests can be sent again if the connection is dropped before the response.
+READ_ONLY_METHODS = (
+    "getrawdiff",
+    "ping",
+    "query",
+    "querychunks",
+    "querydiffs",
+    "search",
+    "whoami",
+)
+
+# Size of the pieces the body of a Conduit request is encoded and sent in.
+REQUEST_BODY_CHUNK_SIZE = 64 * 1024
+
+# Characters left as they are by `quote_plus`, the space becomes a `+`.
+UNQUOTED_BYTES = (string.ascii_letters + string.digits + "_.-~ ").encode("ascii")
+
+
+def encode_base64(data) -> str:
+    """Return base64 encoded `data` as a string.
+
+    `data` may be any bytes-like object, slices of a `memoryview` are encoded
+    without being copied first.
+    """
+    return binascii.b2a_base64(data, newline=False).decode("ascii")
 
 
 def normalise_reviewer(reviewer: str, strip_group: bool = True) -> str:
@@ -44,6 +86,62 @@ def normalise_reviewer(reviewer: str, strip_group: bool = True) -> str:
     return reviewer
 
 
+class ConduitRequestBody:
+    """Form encoded body of a Conduit request, encoded while it is sent.
+
+    Encoding the `params` with `urlencode(json.dumps(params)).encode()` holds
+    the JSON, its percent-encoded form and the bytes of it at once, which for
+    `differential.creatediff` is several copies of every hunk. The body is
+    instead generated in chunks of `REQUEST_BODY_CHUNK_SIZE` as the connection
+    consumes it.
+
+    The body may be iterated more than once (a request can be resent on a new
+    connection), each iteration encodes it again. Its length is counted without
+    percent-encoding so it can be sent with a `Content-Length` header.
+    """
+
+    def __init__(self, params: dict):
+        self.params = params
+        self._length: Optional[int] = None
+
+    def __iter__(self) -> Iterator[bytes]:
+        chunk = []
+        size = 0
+        for part, quote in self._parts():
+            quoted = url_parse.quote_plus(part) if quote else part
+            chunk.append(quoted)
+            size += len(quoted)
+            if size >= REQUEST_BODY_CHUNK_SIZE:
+                yield "".join(chunk).encode("ascii")
+                chunk = []
+                size = 0
+        if chunk:
+            yield "".join(chunk).encode("ascii")
+
+    def __len__(self) -> int:
+        if self._length is None:
+            length = 0
+            for part, quote in self._parts():
+                length += len(part)
+                if quote:
+                    # Every other character is replaced with a `%XX` escape.
+                    data = part.encode("ascii")
+                    length += 2 * len(data.translate(None, UNQUOTED_BYTES))
+            self._length = length
+        return self._length
+
+    def _parts(self) -> Iterator[Tuple[str, bool]]:
+        """Yield the pieces of the body and whether to percent-encode them."""
+        yield "params=", False
+        # With `ensure_ascii` the JSON is ASCII only, long strings can be split
+        # anywhere without breaking a character apart.
+        encoder = json.JSONEncoder(separators=(",", ":"))
+        for part in encoder.iterencode(self.params):
+            for start in range(0, len(part), REQUEST_BODY_CHUNK_SIZE):
+                yield part[start : start + REQUEST_BODY_CHUNK_SIZE], True
+        yield "&output=json&__conduit__=True", False
+
+
 class ConduitAPIError(Error):
     """Raised when the Phabricator Conduit API returns an error response."""
 
@@ -54,6 +152,10 @@ class ConduitAPIError(Error):
 class ConduitAPI:
     def __init__(self):
         self.repo = None
+        # SHA-256 of binary contents, keyed by their repository identifier.
+        self._content_hashes: Dict[str, str] = {}
+        # Cache keys of the uploaded files, keyed by their PHID.
+        self._file_keys: Dict[str, str] = {}
 
     def set_repo(self, repo):
         self.repo = repo
@@ -121,9 +223,17 @@ class ConduitAPI:
             args=api_call_args,
             token=api_token,
         )
-        logger.debug("%s %s", req_args["url"], api_call_args)
-
-        with url_request.urlopen(url_request.Request(**req_args)) as r:
+        logged_args = api_call_args
+        if "changes" in api_call_args:
+            # Formatting the hunks would hold another copy of the whole diff.
+            changes = api_call_args["changes"]
+            logged_args = {**api_call_args, "changes": f"<{len(changes)} changes>"}
+        logger.debug("%s %s", req_args["url"], logged_args)
+
+        replayable = api_method.rsplit(".", 1)[-1] in READ_ONLY_METHODS
+        with http_pool.urlopen(
+            url_request.Request(**req_args), replayable=replayable
+        ) as r:
             res = json.load(r)
         if res["error_code"]:
             raise ConduitAPIError(res.get("error_info", "Error %s" % res["error_code"]))
@@ -137,21 +247,69 @@ class ConduitAPI:
             "url": url_parse.urljoin(self.repo.api_url, method),
             "method": "POST",
             "headers": {"User-Agent": USER_AGENT},
-            "data": url_parse.urlencode(
-                {
-                    "params": json.dumps(
-                        {
-                            **args,
-                            "__conduit__": {"token": token or self.load_api_token()},
-                        },
-                        separators=(",", ":"),
-                    ),
-                    "output": "json",
-                    "__conduit__": True,
-                }
-            ).encode(),
+            "data": ConduitRequestBody(
+                {**args, "__conduit__": {"token": token or self.load_api_token()}}
+            ),
         }
 
+    def search_pages(
+        self,
+        api_method: str,
+        api_call_args: dict,
+        *,
+        chunk_by: Optional[str] = None,
+    ) -> Iterator[dict]:
+        """Yield each page of results of a cursor-paginated `*.search` method.
+
+        If `chunk_by` names a constraint with more than `SEARCH_CHUNK_SIZE`
+        values, the values are split into chunks which are searched concurrently.
+        Pages are yielded in the order of the chunks, following the cursor of each
+        chunk before moving to the next one.
+        """
+        args_list = [
+            {**api_call_args, "constraints": {**api_call_args["constraints"], **c}}
+            for c in self._chunk_constraint(api_call_args["constraints"], chunk_by)
+        ]
+
+        for args, page in zip(args_list, self.call_many(api_method, args_list)):
+            while True:
+                yield page
+
+                after = (page.get("cursor") or {}).get("after")
+                if not after:
+                    break
+                page = self.call(api_method, {**args, "after": after})
+
+    def call_many(self, api_method: str, args_list: List[dict]) -> Iterator[dict]:
+        """Call the API method once for each of the args, concurrently.
+
+        Results are yielded in the order of `args_list`.
+        """
+        if len(args_list) == 1:
+            yield self.call(api_method, args_list[0])
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=MAX_CONNECTIONS_PER_HOST
+        ) as executor:
+            futures = [
+                executor.submit(self.call, api_method, args) for args in args_list
+            ]
+            for future in futures:
+                yield future.result()
+
+    @staticmethod
+    def _chunk_constraint(constraints: dict, name: Optional[str]) -> List[dict]:
+        """Split the `name` constraint values into `SEARCH_CHUNK_SIZE` chunks."""
+        values = constraints.get(name) if name else None
+        if not values or len(values) <= SEARCH_CHUNK_SIZE:
+            return [{}]
+
+        return [
+            {name: values[i : i + SEARCH_CHUNK_SIZE]}
+            for i in range(0, len(values), SEARCH_CHUNK_SIZE)
+        ]
+
     def ping(self) -> bool:
         """Sends a ping to the Phabricator server using `conduit.ping` API.
 
@@ -253,6 +411,7 @@ class ConduitAPI:
                 rev_id: cache.get("rev-id-%s" % rev_id)
                 for rev_id in ids
                 if "rev-id-%s" % rev_id in cache
+                and "rev-%s" % cache.get("rev-id-%s" % rev_id) in cache
             }
             found_phids = list(phids_by_id.values())
             query_field = "ids"
@@ -273,14 +432,28 @@ class ConduitAPI:
             if "rev-%s" % phid in cache
         }
 
+        # Revisions loaded from the persistent cache might have been updated since.
+        stale = {
+            phid: revision
+            for phid, revision in revisions.items()
+            if cache.needs_revalidation("rev-%s" % phid)
+        }
+        if stale:
+            revisions.update(self._revalidate_revisions(stale))
+
         # Query Phabricator if we don't have cached values for revisions.
         if query_values:
             api_call_args = {
                 "constraints": {query_field: sorted(query_values)},
                 "attachments": {"reviewers": True},
             }
-            response = self.call("differential.revision.search", api_call_args)
-            rev_list = response.get("data")
+            rev_list = [
+                r
+                for page in self.search_pages(
+                    "differential.revision.search", api_call_args, chunk_by=query_field
+                )
+                for r in page.get("data", [])
+            ]
 
             for r in rev_list:
                 phids_by_id[str(r["id"])] = r["phid"]
@@ -288,16 +461,42 @@ class ConduitAPI:
                 cache.set("rev-id-%s" % r["id"], r["phid"])
                 cache.set("rev-%s" % r["phid"], r)
 
-        # Return revisions in the same order requested.
+        # Return revisions in the same order requested, skipping revisions for
+        # which we do not have a query result.
         if ids:
-            # Skip revisions for which we do not have a query result.
             return [
                 revisions[phids_by_id[rev_id]]
                 for rev_id in ids
                 if rev_id in phids_by_id
             ]
         else:
-            return [revisions[phid] for phid in phids]
+            return [revisions[phid] for phid in phids if phid in revisions]
+
+    def _revalidate_revisions(self, revisions: Dict[str, dict]) -> Dict[str, dict]:
+        """Refresh cached revisions which were modified since they were cached.
+
+        Only revisions modified after the oldest `dateModified` are sent back.
+        """
+        modified_start = min(
+            r["fields"].get("dateModified", 0) for r in revisions.values()
+        )
+        api_call_args = {
+            "constraints": {
+                "phids": sorted(revisions),
+                "modifiedStart": modified_start,
+            },
+            "attachments": {"reviewers": True},
+        }
+        revisions = revisions.copy()
+        for page in self.search_pages(
+            "differential.revision.search", api_call_args, chunk_by="phids"
+        ):
+            for r in page.get("data", []):
+                revisions[r["phid"]] = r
+
+        for phid, r in revisions.items():
+            cache.set("rev-%s" % phid, r)
+        return revisions
 
     def get_diffs(
         self, ids: Optional[List[int]] = None, phids: Optional[List[str]] = None
@@ -322,15 +521,38 @@ class ConduitAPI:
             "constraints": constraints,
             "attachments": {"commits": True},
         }
-        response = self.call("differential.diff.search", api_call_args)
-        diff_list = response.get("data", [])
+        pages = self.search_pages(
+            "differential.diff.search", api_call_args, chunk_by=list(constraints)[0]
+        )
 
         diff_dict = {}
-        for diff in diff_list:
-            diff_dict[diff["phid"]] = diff
+        for page in pages:
+            for diff in page.get("data", []):
+                diff_dict[diff["phid"]] = diff
 
         return diff_dict
 
+    def get_diff_fingerprints(self, ids: List[int]) -> Dict[int, str]:
+        """Get the fingerprints stored with the diffs by `set_diff_property`.
+
+        The `commits` attachment of `differential.diff.search` only returns the
+        standard fields of the `local:commits` property, so the properties are
+        read with `differential.querydiffs`.
+
+        Returns a dict of fingerprints identified by the diff ID.
+        """
+        diffs = self.call("differential.querydiffs", {"ids": sorted(set(ids))})
+
+        fingerprints = {}
+        # An empty result is returned as a list.
+        for diff_id, diff in (diffs or {}).items():
+            local_commits = (diff.get("properties") or {}).get("local:commits")
+            for local_commit in (local_commits or {}).values():
+                if local_commit.get("fingerprint"):
+                    fingerprints[int(diff_id)] = local_commit["fingerprint"]
+
+        return fingerprints
+
     def get_successor_phids(
         self, phid: str, include_abandoned: bool = False
     ) -> List[str]:
@@ -345,23 +567,50 @@ class ConduitAPI:
             phid, relation="parent", include_abandoned=include_abandoned
         )
 
+    def get_stack_graph(self, phid: str) -> Dict[str, List[str]]:
+        """Return the stack graph of the revision.
+
+        The graph maps PHIDs of all revisions in the stack to the list of PHIDs of
+        their parents. All revisions of the stack are fetched in one call and
+        stored in the cache.
+        """
+        revisions = self.get_revisions(phids=[phid])
+        if not revisions:
+            raise NotFoundError("revision {} not found".format(phid))
+
+        stack_graph = revisions[0]["fields"].get("stackGraph", {})
+        if stack_graph:
+            self.get_revisions(phids=list(stack_graph.keys()))
+
+        return stack_graph
+
     def get_related_phids(
         self, base_phid: str, relation: str = "parent", include_abandoned: bool = False
     ) -> List[str]:
-        """Returns the list of PHIDs with direct dependency"""
-        result = []
+        """Returns the list of PHIDs with direct dependency.
 
-        def _get_related(phid):
-            api_call_args = {"sourcePHIDs": [phid], "types": ["revision.%s" % relation]}
-            edge = self.call("edge.search", api_call_args)
-            if edge.get("data"):
-                if len(edge["data"]) > 1:
-                    raise NonLinearException()
+        Raises `NonLinearException` if a revision on the path from `base_phid` has
+        more than one related revision.
+        """
+        stack_graph = self.get_stack_graph(base_phid)
+        if relation == "parent":
+            related = stack_graph
+        else:
+            related = {}
+            for phid, parents in stack_graph.items():
+                for parent in parents:
+                    related.setdefault(parent, []).append(phid)
 
-                result.append(edge["data"][0]["destinationPHID"])
-                _get_related(result[-1])
+        result = []
+        phid = base_phid
+        while related.get(phid):
+            if len(related[phid]) > 1:
+                raise NonLinearException()
 
-        _get_related(base_phid)
+            phid = related[phid][0]
+            if phid == base_phid or phid in result:
+                break
+            result.append(phid)
 
         if not result or include_abandoned:
             return result
@@ -392,16 +641,20 @@ class ConduitAPI:
         if not to_collect:
             return users
 
-        api_call_args = {"usernames": to_collect}
         # We're using the deprecated user.query API as the user.search does not
-        # provide the user availability information.
+        # provide the user availability information. It is not cursor-paginated,
+        # but returns at most `SEARCH_CHUNK_SIZE` users by default.
         # See https://phabricator.services.mozilla.com/conduit/method/user.query/
-        response = self.call("user.query", api_call_args)
-        for user in response:
-            users.append(user)
-            key = "user-%s" % user["userName"]
-            cache.set(key, user)
-            cache.set(user["phid"], key)
+        args_list = [
+            {"usernames": to_collect[i : i + SEARCH_CHUNK_SIZE]}
+            for i in range(0, len(to_collect), SEARCH_CHUNK_SIZE)
+        ]
+        for response in self.call_many("user.query", args_list):
+            for user in response:
+                users.append(user)
+                key = "user-%s" % user["userName"]
+                cache.set(key, user)
+                cache.set(user["phid"], key)
 
         return users
 
@@ -421,15 +674,18 @@ class ConduitAPI:
 
         # See https://phabricator.services.mozilla.com/conduit/method/project.search/
         api_call_args = {"queryKey": "active", "constraints": {"slugs": to_collect}}
-        response = self.call("project.search", api_call_args)
-        for data in response.get("data"):
-            group = {"name": data["fields"]["slug"], "phid": data["phid"]}
-            groups.append(group)
-            key = "group-%s" % group["name"]
-            cache.set(key, group)
+        maps = {}
+        for page in self.search_pages(
+            "project.search", api_call_args, chunk_by="slugs"
+        ):
+            for data in page.get("data"):
+                group = {"name": data["fields"]["slug"], "phid": data["phid"]}
+                groups.append(group)
+                key = "group-%s" % group["name"]
+                cache.set(key, group)
+            maps.update(page["maps"]["slugMap"])
 
         # projects might be received by an alias.
-        maps = response["maps"]["slugMap"]
         for alias in maps.keys():
             name = normalise_reviewer(alias)
             group = {"name": name, "phid": maps[alias]["projectPHID"]}
@@ -438,6 +694,14 @@ class ConduitAPI:
                 groups.append(group)
                 cache.set(key, group)
 
+        # Also remember groups by the requested slug (like `#slug`), so that a
+        # later lookup is served from the cache.
+        groups_by_name = {group["name"]: group for group in groups}
+        for slug in to_collect:
+            name = normalise_reviewer(slug)
+            if name in groups_by_name and "group-%s" % slug not in cache:
+                cache.set("group-%s" % slug, groups_by_name[name])
+
         return groups
 
     def create_revision(
@@ -598,7 +862,8 @@ class ConduitAPI:
         must be a single element and will be passed in a list to Conduit.
         """
         api_call_args = {"constraints": {constraint: [value]}, "limit": 1}
-        data = self.call("diffusion.repository.search", api_call_args)
+        # Only the first page is needed.
+        data = next(self.search_pages("diffusion.repository.search", api_call_args))
         if not data.get("data"):
             raise NotFoundError("Repository %s not found" % value)
 
@@ -613,7 +878,11 @@ class ConduitAPI:
             }
         }
 
-        data = self.call("diffusion.repository.search", api_call_args).get("data")
+        data = [
+            repo
+            for page in self.search_pages("diffusion.repository.search", api_call_args)
+            for repo in page.get("data", [])
+        ]
         if not data:
             raise NotFoundError(f"No repositories found with tag {tag}")
 
@@ -651,7 +920,12 @@ class ConduitAPI:
             "sourcePath": self.repo.path,
             "branch": "HEAD" if self.repo.phab_vcs == "git" else "default",
         }
-        return self.call("differential.creatediff", api_call_args)
+        try:
+            return self.call("differential.creatediff", api_call_args)
+        except ConduitAPIError:
+            # A cached file may have been deleted, it's uploaded again next time.
+            self._forget_uploaded_files(diff)
+            raise
 
     def set_diff_property(self, diff_id: str, commit: Commit, message: str):
         """Add information about our local commit to the diff."""
@@ -669,6 +943,9 @@ class ConduitAPI:
         if commit.tree_hash is not None:
             data[commit.node]["tree"] = commit.tree_hash
 
+        if commit.fingerprint is not None:
+            data[commit.node]["fingerprint"] = commit.fingerprint
+
         if self.repo.phab_vcs == "hg":
             data[commit.node]["rev"] = commit.node
 
@@ -680,66 +957,177 @@ class ConduitAPI:
         self.call("differential.setdiffproperty", api_call_args)
 
     def upload_files_from_diff(self, diff: Diff):
+        uploads = [
+            (upload, change.cur_path if upload["type"] == "new" else change.old_path)
+            for change in diff.changes.values()
+            for upload in change.uploads
+        ]
+
         # Files are uploaded in parallel using a pool of threads.
         with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-            futures = []
-            for change in diff.changes.values():
-                for upload in change.uploads:
-                    path = (
-                        change.cur_path if upload["type"] == "new" else change.old_path
-                    )
-                    futures.append(executor.submit(self.upload_file, upload, path))
+            try:
+                content_hashes = executor.map(
+                    self.content_hash,
+                    [upload for upload, _path in uploads if upload["value"]],
+                )
+                self._revalidate_files(list(content_hashes))
+
+                futures = [
+                    executor.submit(self.upload_file, upload, path)
+                    for upload, path in uploads
+                ]
+
+                # Wait for all uploads to be finished.
+                concurrent.futures.wait(futures)
+
+                # Check that all went well. If not, propagate the first error here
+                # by calling the future's result() method.
+                for upload in futures:
+                    upload.result()
+            finally:
+                # Remove the temporary files of the contents too big to be read.
+                for upload, _path in uploads:
+                    if isinstance(upload["value"], SpooledContents):
+                        upload["value"].close()
+
+    def _revalidate_files(self, content_hashes: List[str]):
+        """Forget the cached files which were deleted since they were uploaded.
 
-            # Wait for all uploads to be finished.
-            concurrent.futures.wait(futures)
+        Files uploaded by a previous run are looked up together, those missing or
+        no longer visible are uploaded again.
+        """
+        stale = {}
+        for content_hash in content_hashes:
+            key = "file-%s" % content_hash
+            if cache.needs_revalidation(key):
+                stale[cache.get(key)] = key
+        if not stale:
+            return
 
-            # Check that all went well. If not, propagate the first error here
-            # by calling the future's result() method.
-            for upload in futures:
-                upload.result()
+        api_call_args = {"constraints": {"phids": sorted(stale)}}
+        found = {
+            f["phid"]
+            for page in self.search_pages(
+                "file.search", api_call_args, chunk_by="phids"
+            )
+            for f in page.get("data", [])
+        }
+        for phid, key in stale.items():
+            if phid in found:
+                cache.set(key, phid)
+            else:
+                cache.delete(key)
+
+    def _forget_uploaded_files(self, diff: Diff):
+        """Forget the cached files of a diff rejected by Phabricator."""
+        for change in diff.changes.values():
+            for upload in change.uploads:
+                key = self._file_keys.pop(upload["phid"], None)
+                if key:
+                    cache.delete(key)
 
     def upload_file(self, upload: dict, path: str):
-        data: bytes = upload["value"]
-        if not data:
+        if not upload["value"]:
             return
+
+        # Contents already uploaded to this Phabricator don't need to be allocated.
+        content_hash = self.content_hash(upload)
+        key = "file-%s" % content_hash
+        if key in cache:
+            upload["phid"] = cache.get(key)
+            self._file_keys[upload["phid"]] = key
+            return
+
         name = os.path.basename(path)
         allocation = self.call(
             "file.allocate",
             {
                 "name": name,
-                "contentLength": len(data),
-                "contentHash": hashlib.sha256(data).hexdigest(),
+                "contentLength": len(upload["value"]),
+                "contentHash": content_hash,
             },
         )
         file_phid = allocation["filePHID"]
         if allocation["upload"]:
-            if not file_phid:
-                data_base64 = base64.standard_b64encode(data)
-                file_phid = self.call(
-                    "file.upload", {"data_base64": data_base64.decode(), "name": name}
-                )
-            else:
-                chunks = self.call("file.querychunks", {"filePHID": file_phid})
-                for chunk in chunks:
-                    if chunk["complete"]:
-                        continue
-                    byte_start = int(chunk["byteStart"])
-                    byte_end = int(chunk["byteEnd"])
-                    data_base64 = base64.standard_b64encode(data[byte_start:byte_end])
-                    self.call(
-                        "file.uploadchunk",
-                        {
-                            "filePHID": file_phid,
-                            "byteStart": byte_start,
-                            "data": data_base64.decode(),
-                            "dataEncoding": "base64",
-                        },
+            with contents_view(upload["value"]) as data:
+                if not file_phid:
+                    file_phid = self.call(
+                        "file.upload",
+                        {"data_base64": encode_base64(data), "name": name},
                     )
+                else:
+                    self.upload_chunks(file_phid, data)
 
         upload["phid"] = str(file_phid)
+        cache.set(key, upload["phid"])
+        self._file_keys[upload["phid"]] = key
+
+    def content_hash(self, upload: dict) -> str:
+        """Return the SHA-256 of the upload contents.
+
+        Contents with a `key` are hashed only once, even if they're a part of
+        multiple commits in the stack.
+        """
+        content_key = upload.get("key")
+        if content_key in self._content_hashes:
+            return self._content_hashes[content_key]
+
+        with contents_view(upload["value"]) as data:
+            content_hash = hashlib.sha256(data).hexdigest()
+        if content_key:
+            self._content_hashes[content_key] = content_hash
+        return content_hash
+
+    def upload_chunks(self, file_phid: str, data: bytes):
+        """Upload the chunks of an allocated file which are not complete yet.
+
+        Chunks are uploaded in parallel. If any of them fails, the chunks are
+        queried again and only those still incomplete are uploaded again.
+        """
+        view = memoryview(data)
+
+        def upload_chunk(chunk: dict):
+            byte_start = int(chunk["byteStart"])
+            byte_end = int(chunk["byteEnd"])
+            self.call(
+                "file.uploadchunk",
+                {
+                    "filePHID": file_phid,
+                    "byteStart": byte_start,
+                    "data": encode_base64(view[byte_start:byte_end]),
+                    "dataEncoding": "base64",
+                },
+            )
+
+        for attempt in range(UPLOAD_CHUNK_ATTEMPTS):
+            chunks = self.call("file.querychunks", {"filePHID": file_phid})
+            missing = [chunk for chunk in chunks if not chunk["complete"]]
+            if not missing:
+                return
+
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=UPLOAD_CHUNK_WORKERS
+            ) as executor:
+                futures = [executor.submit(upload_chunk, chunk) for chunk in missing]
+                errors = [f.exception() for f in futures if f.exception()]
+
+            if not errors:
+                return
+
+            if attempt + 1 == UPLOAD_CHUNK_ATTEMPTS:
+                raise errors[0]
+
+            logger.debug(
+                "Failed to upload %s of %s chunks of %s, resuming: %s",
+                len(errors),
+                len(missing),
+                file_phid,
+                errors[0],
+            )
 
     def whoami(self, *, api_token: Optional[str] = None) -> dict:
-        if "whoami" in cache:
+        # Always check with Phabricator when validating a specific token.
+        if "whoami" in cache and not api_token:
             return dict(cache.get("whoami"))
 
         who = self.call("user.whoami", {}, api_token=api_token)
@@ -49,6 +49,7 @@ class Config(object):
             auto_submit = False
             always_blocking = False
             warn_untracked = True
+            pipeline_depth = 2
 
             [patch]
             apply_to = base
@@ -87,6 +88,7 @@ class Config(object):
         self.auto_submit = self._getboolean("submit", "auto_submit")
         self.always_blocking = self._getboolean("submit", "always_blocking")
         self.warn_untracked = self._getboolean("submit", "warn_untracked")
+        self.pipeline_depth = self._getint("submit", "pipeline_depth")
         self.apply_patch_to = self._config.get("patch", "apply_to")
         self.create_bookmark = self._getboolean("patch", "create_bookmark")
         self.create_topic = self._getboolean("patch", "create_topic")
@@ -157,6 +159,7 @@ class Config(object):
             self._set("submit", "auto_submit", self.auto_submit)
             self._set("submit", "always_blocking", self.always_blocking)
             self._set("submit", "warn_untracked", self.warn_untracked)
+            self._set("submit", "pipeline_depth", self.pipeline_depth)
             self._set("patch", "apply_to", self.apply_patch_to)
             self._set("patch", "create_bookmark", self.create_bookmark)
             self._set("patch", "create_topic", self.create_topic)
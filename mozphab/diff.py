@@ -9,13 +9,59 @@ from typing import (
     List,
     Optional,
     Tuple,
+    Union,
 )
 
+# Header starting each hunk of a unified diff, with the line break ending it.
+HUNK_HEADER = re.compile(
+    rb"^@@ -(?P<old_off>\d+)(?:,(?P<old_len>\d+))? "
+    rb"\+(?P<new_off>\d+)(?:,(?P<new_len>\d+))? @@[^\n]*(?:\n|\Z)",
+    re.MULTILINE,
+)
+
+# Pieces of a diff fed to `HunkParser` are buffered up to this size before being
+# parsed.
+HUNK_PARSER_CHUNK_SIZE = 64 * 1024
+
+NO_NEWLINE_MARKER = "\\ No newline at end of file"
+
+
+class _Named:
+    """Named value of which a single instance exists for each name."""
+
+    __slots__ = ("value", "name")
+
+    values: Dict[str, int] = {}
+    _instances: Dict[Tuple[type, str], "_Named"] = {}
+
+    def __new__(cls, name: str):
+        instance = _Named._instances.get((cls, name))
+        if instance is None:
+            instance = super().__new__(cls)
+            instance.value = cls.values[name]
+            instance.name = name
+            _Named._instances[(cls, name)] = instance
+        return instance
+
 
 class Diff:
     """Representation of the Diff used to submit to the Phabricator."""
 
     class Hunk:
+        __slots__ = (
+            "old_off",
+            "old_len",
+            "new_off",
+            "new_len",
+            "added",
+            "deleted",
+            "old_eof_newline",
+            "new_eof_newline",
+            "_buffer",
+            "_start",
+            "_end",
+        )
+
         def __init__(
             self,
             *,
@@ -23,7 +69,10 @@ class Diff:
             old_len: int,
             new_off: int,
             new_len: int,
-            lines: List[str],
+            lines: Optional[List[str]] = None,
+            buffer: str = "",
+            start: int = 0,
+            end: Optional[int] = None,
         ):
             """
             Hunk object, encapsulates hunk metadata and diff lines.
@@ -44,32 +93,72 @@ class Diff:
             :param int new_len: new length (eg. 7)
             :param list[str] lines: list of diff lines, starting with "+", "-", or " ",
                    including the trailing "\n".  (eg. the 7 lines following the @@ line)
+            :param str buffer: text holding the diff lines instead of `lines`, it
+                   may be shared by all the hunks of a file
+            :param int start: offset of the first diff line in `buffer`
+            :param int end: offset after the last diff line in `buffer`, defaults
+                   to the end of `buffer`
             """
+            if lines is not None:
+                buffer = "".join(lines)
+                start, end = 0, None
+
             self.old_off = old_off
             self.old_len = old_len
             self.new_off = new_off
             self.new_len = new_len
-            self.corpus = "".join(lines)
+            self._buffer = buffer
+            self._start = start
+            self._end = len(buffer) if end is None else end
+
+            self.added = self._count_lines("+")
+            self.deleted = self._count_lines("-")
 
             self.old_eof_newline = True
             self.new_eof_newline = True
-            self.added = 0
-            self.deleted = 0
+            if buffer.startswith(NO_NEWLINE_MARKER, start, self._end):
+                self.old_eof_newline = False
+                self.new_eof_newline = False
+
+            marker = buffer.find("\n" + NO_NEWLINE_MARKER, start, self._end)
+            while marker != -1:
+                line_start = buffer.rfind("\n", start, marker) + 1 or start
+                prefix = buffer[line_start : line_start + 1]
+                if prefix != "+":
+                    self.old_eof_newline = False
+                if prefix != "-":
+                    self.new_eof_newline = False
+                marker = buffer.find("\n" + NO_NEWLINE_MARKER, marker + 1, self._end)
 
-            prev_line = " "
-            for line in lines:
-                if line[0] == "+":
-                    self.added += 1
-                elif line[0] == "-":
-                    self.deleted += 1
-                if line.endswith("No newline at end of file\n"):
-                    if prev_line[0] != "+":
-                        self.old_eof_newline = False
-                    if prev_line[0] != "-":
-                        self.new_eof_newline = False
-                prev_line = line
+        @property
+        def corpus(self) -> str:
+            """The diff lines of the hunk."""
+            # Slicing the whole buffer returns it without a copy.
+            return self._buffer[self._start : self._end]
+
+        def _count_lines(self, prefix: str) -> int:
+            """Return the number of diff lines starting with the `prefix`."""
+            count = self._buffer.count("\n" + prefix, self._start, self._end)
+            if self._buffer.startswith(prefix, self._start, self._end):
+                count += 1
+            return count
 
     class Change:
+        __slots__ = (
+            "old_mode",
+            "cur_mode",
+            "old_path",
+            "cur_path",
+            "away_paths",
+            "kind",
+            "binary",
+            "file_type",
+            "uploads",
+            "hunks",
+            "added",
+            "deleted",
+        )
+
         def __init__(self, path: str):
             self.old_mode: Optional[str] = None
             self.cur_mode: Optional[str] = None
@@ -81,56 +170,60 @@ class Diff:
             self.file_type = Diff.FileType("TEXT")
             self.uploads = []
             self.hunks = []
+            self.added = 0
+            self.deleted = 0
 
-        @property
-        def added(self) -> int:
-            return sum(hunk.added for hunk in self.hunks)
+        def add_hunk(self, hunk: "Diff.Hunk"):
+            self.hunks.append(hunk)
+            self.added += hunk.added
+            self.deleted += hunk.deleted
 
-        @property
-        def deleted(self) -> int:
-            return sum(hunk.deleted for hunk in self.hunks)
-
-        def from_git_diff(self, git_diff: str):
-            """Generate hunks from the provided git_diff output."""
-
-            # Process each hunk
-            hunk = {}
-            in_header = True
-            for line in git_diff.splitlines(keepends=True):
-                # Skip lines before the start of the first hunk header
-                if in_header:
-                    if not line.startswith("@@"):
-                        continue
-                    in_header = False
-
-                # Start of hunk
-                if line.startswith("@@"):
-                    # Store previously collected hunk
-                    if hunk and hunk["lines"]:
-                        self.hunks.append(Diff.Hunk(**hunk))
-
-                    # Start a new collection
-                    (old_off, new_off, old_len, new_len) = Diff.parse_git_diff(line)
-                    hunk = {
-                        "old_off": old_off,
-                        "new_off": new_off,
-                        "old_len": old_len,
-                        "new_len": new_len,
-                        "lines": [],
-                    }
-
-                else:
-                    hunk["lines"].append(line)
-            if hunk and hunk["lines"]:
-                self.hunks.append(Diff.Hunk(**hunk))
-
-        def set_as_binary(self, *, a_body: str, a_mime: str, b_body: str, b_mime: str):
-            """Updates Change contents to the provided binary data."""
+        def from_git_diff(self, git_diff: Union[bytes, str]):
+            """Generate hunks from the provided git_diff output.
+
+            Raises `UnicodeDecodeError`, without adding any hunk, if the diff
+            isn't valid UTF-8.
+            """
+            if isinstance(git_diff, str):
+                git_diff = git_diff.encode("utf-8")
+
+            for hunk in HunkParser.parse(git_diff):
+                self.add_hunk(hunk)
+
+        def set_as_binary(
+            self,
+            *,
+            a_body: str,
+            a_mime: str,
+            b_body: str,
+            b_mime: str,
+            a_key: Optional[str] = None,
+            b_key: Optional[str] = None,
+        ):
+            """Updates Change contents to the provided binary data.
+
+            The bodies are bytes, or `SpooledContents` for files too big to be
+            read. `a_key` and `b_key` identify the contents in the repository
+            (like a blob hash), they are used to avoid hashing the same content
+            twice.
+            """
             self.binary = True
 
             self.uploads = [
-                {"type": "old", "value": a_body, "mime": a_mime, "phid": None},
-                {"type": "new", "value": b_body, "mime": b_mime, "phid": None},
+                {
+                    "type": "old",
+                    "value": a_body,
+                    "mime": a_mime,
+                    "phid": None,
+                    "key": a_key,
+                },
+                {
+                    "type": "new",
+                    "value": b_body,
+                    "mime": b_mime,
+                    "phid": None,
+                    "key": b_key,
+                },
             ]
 
             if a_mime.startswith("image/") or b_mime.startswith("image/"):
@@ -178,7 +271,9 @@ class Diff:
                 "hunks": hunks,
             }
 
-    class Kind:
+    class Kind(_Named):
+        __slots__ = ()
+
         values = {
             "ADD": 1,
             "CHANGE": 2,
@@ -190,10 +285,6 @@ class Diff:
             "MULTICOPY": 8,
         }
 
-        def __init__(self, name: str):
-            self.value = self.values[name]
-            self.name = name
-
         def short(self):
             if self.name == "ADD":
                 return "A "
@@ -212,7 +303,9 @@ class Diff:
             elif self.name == "MULTICOPY":
                 return "C*"
 
-    class FileType:
+    class FileType(_Named):
+        __slots__ = ()
+
         values = {
             "TEXT": 1,
             "IMAGE": 2,
@@ -223,10 +316,6 @@ class Diff:
             "NORMAL": 7,
         }
 
-        def __init__(self, name: str):
-            self.value = self.values[name]
-            self.name = name
-
     def __init__(self):
         self.changes = {}
         self.phid = None
@@ -297,13 +386,181 @@ class Diff:
 
     @staticmethod
     def parse_git_diff(hdr: str) -> Tuple[int, int, int, int]:
-        m = re.match(
-            r"@@ -(?P<old_off>\d+)(?:,(?P<old_len>\d+))? "
-            r"\+(?P<new_off>\d+)(?:,(?P<new_len>\d+))? @@",
-            hdr,
-        )
+        m = HUNK_HEADER.match(hdr.encode("utf-8"))
         old_off = int(m.group("old_off"))
         old_len = int(m.group("old_len") or 1)
         new_off = int(m.group("new_off"))
         new_len = int(m.group("new_len") or 1)
         return old_off, new_off, old_len, new_len
+
+
+class HunkParser:
+    """Incremental parser of the hunks of a unified diff.
+
+    The diff is fed in `bytes` pieces as it is read, like the lines of the output
+    of a diff process. Small pieces are buffered up to `HUNK_PARSER_CHUNK_SIZE`
+    before being parsed. Hunk headers are found with a precompiled pattern. The
+    hunks completed by a parsed piece are decoded at once, into a text they share
+    as their buffer. The diff isn't split into lines, and the lines before the
+    first hunk are dropped as they come.
+
+    Hunks completed by the pieces fed so far are returned by `feed`, the last
+    ones by `close`. The hunks of a whole diff given to `parse` share one text.
+    """
+
+    def __init__(self):
+        self._data: Union[bytes, bytearray] = b""
+        self._pieces: List[bytes] = []
+        self._pieces_size = 0
+        # Start of the current hunk, and end of the lines searched for headers.
+        self._start = 0
+        self._scanned = 0
+        self._header: Optional[Tuple[bytes, ...]] = None
+
+    @classmethod
+    def parse(cls, data: bytes) -> List[Diff.Hunk]:
+        """Return the hunks of the whole diff."""
+        parser = cls()
+        parser._pieces.append(data)
+        return parser.close()
+
+    def feed(self, data: bytes) -> List[Diff.Hunk]:
+        """Add a piece of the diff and return the hunks completed so far."""
+        self._pieces.append(data)
+        self._pieces_size += len(data)
+        if self._pieces_size < HUNK_PARSER_CHUNK_SIZE:
+            return []
+
+        self._add_pieces()
+        # Headers are only searched in complete lines.
+        return self._parse(self._data.rfind(b"\n") + 1)
+
+    def close(self) -> List[Diff.Hunk]:
+        """Return the hunks left at the end of the diff."""
+        self._add_pieces()
+        hunks = self._parse(len(self._data), last=True)
+
+        self._data = b""
+        self._start = self._scanned = 0
+        self._header = None
+        return hunks
+
+    def _add_pieces(self):
+        """Append the buffered pieces to the data left to parse."""
+        pieces = self._pieces
+        if not pieces:
+            return
+        self._pieces = []
+        self._pieces_size = 0
+
+        if self._start == len(self._data):
+            # Nothing is left, a single piece is parsed without being copied.
+            self._data = pieces[0] if len(pieces) == 1 else b"".join(pieces)
+            self._start = self._scanned = 0
+            return
+
+        if isinstance(self._data, bytearray):
+            del self._data[: self._start]
+        else:
+            self._data = bytearray(memoryview(self._data)[self._start :])
+        self._scanned -= self._start
+        self._start = 0
+        for piece in pieces:
+            self._data += piece
+
+    def _parse(self, end: int, last: bool = False) -> List[Diff.Hunk]:
+        """Return the hunks completed by the lines up to `end`.
+
+        The current hunk is completed too if it's the `last` one.
+        """
+        # Headers of the completed hunks, with the bounds of their lines.
+        bounds = []
+        scanned = self._scanned
+        while True:
+            header = self._search_header(scanned, end)
+            if header is None:
+                break
+
+            if self._header is not None and header.start() != self._start:
+                bounds.append((self._header, self._start, header.start()))
+            self._header = header.groups()
+            self._start = scanned = header.end()
+
+        if last and self._header is not None and end != self._start:
+            bounds.append((self._header, self._start, end))
+        if self._header is None:
+            # The lines before the first hunk aren't needed.
+            self._start = end
+        self._scanned = end
+        return self._hunks(bounds) if bounds else []
+
+    def _search_header(self, pos: int, end: int) -> Optional[re.Match]:
+        """Return the first hunk header in the lines between `pos` and `end`."""
+        data = self._data
+        if not data.startswith(b"@@", pos, end):
+            pos = data.find(b"\n@@", pos, end)
+            if pos == -1:
+                return None
+            pos += 1
+
+        while True:
+            header = HUNK_HEADER.match(data, pos, end)
+            if header:
+                return header
+            pos = data.find(b"\n@@", pos, end)
+            if pos == -1:
+                return None
+            pos += 1
+
+    def _hunks(
+        self, bounds: List[Tuple[Tuple[bytes, ...], int, int]]
+    ) -> List[Diff.Hunk]:
+        """Return the hunks from their headers and the bounds of their lines.
+
+        The data from the lines of the first hunk to the end of the last one is
+        decoded once, the hunks share this text.
+        """
+        base, stop = bounds[0][1], bounds[-1][2]
+        with memoryview(self._data) as view:
+            text = str(view[base:stop], "utf-8")
+            if len(text) == stop - base:
+                # Without multi-byte characters the offsets are the same.
+                offsets = [(start - base, end - base) for _, start, end in bounds]
+            else:
+                offsets = self._text_offsets(view, text, bounds)
+
+        hunks = []
+        for ((old_off, old_len, new_off, new_len), _, _), (start, end) in zip(
+            bounds, offsets
+        ):
+            hunks.append(
+                Diff.Hunk(
+                    old_off=int(old_off),
+                    old_len=int(old_len or 1),
+                    new_off=int(new_off),
+                    new_len=int(new_len or 1),
+                    buffer=text,
+                    start=start,
+                    end=end,
+                )
+            )
+        return hunks
+
+    @staticmethod
+    def _text_offsets(
+        view: memoryview, text: str, bounds: List[Tuple[Tuple[bytes, ...], int, int]]
+    ) -> List[Tuple[int, int]]:
+        """Return the offsets of the lines of the hunks in the decoded `text`.
+
+        Each hunk ends with the line before the headers following it, which are
+        searched for in the text.
+        """
+        offsets = []
+        start = 0
+        for (_, _, end), (_, next_start, _) in zip(bounds, bounds[1:]):
+            headers = "\n" + str(view[end:next_start], "utf-8")
+            end = text.index(headers, start) + 1
+            offsets.append((start, end))
+            start = end + len(headers) - 1
+        offsets.append((start, len(text)))
+        return offsets
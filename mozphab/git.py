@@ -3,17 +3,24 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import argparse
-import mimetypes
+import hashlib
+import json
 import os
 import re
 import subprocess
 import sys
+import tempfile
 import uuid
+from contextlib import suppress
 from datetime import datetime
 from functools import lru_cache
 from typing import (
+    Dict,
+    Iterable,
     List,
     Optional,
+    Set,
+    Tuple,
     Union,
 )
 
@@ -21,11 +28,13 @@ from mozphab import environment
 
 from .commits import Commit
 from .config import config
-from .diff import Diff
+from .diff import Diff, HunkParser
 from .exceptions import CommandError, Error, NotFoundError
 from .gitcommand import GitCommand
 from .helpers import (
-    create_hunk_lines,
+    SpooledContents,
+    create_hunk_corpus,
+    guess_mime_type,
     is_valid_email,
     prompt,
     short_node,
@@ -34,12 +43,63 @@ from .helpers import (
 )
 from .logger import logger
 from .repository import Repository
+from .simplecache import content_cache
 from .spinner import wait_message
 from .telemetry import telemetry
 
 NULL_SHA1 = "0" * 40
 
 
+def split_patches(lines: Iterable[bytes]) -> Dict[Tuple[str, str], List[Diff.Hunk]]:
+    """Split the output of `git diff-tree -p --full-index` into patches.
+
+    Lines are consumed as they come, the hunks of each file are parsed as soon
+    as they're complete. Files without hunks (binaries, mode changes and pure
+    renames) are skipped, as are files which aren't UTF-8 text or contain a NUL
+    byte.
+
+    Returns the hunks of the patches identified by the old and new blob SHA1.
+    """
+    patches = {}
+    blobs = None
+    parser = None
+    hunks: List[Diff.Hunk] = []
+
+    def add_patch():
+        if blobs and parser:
+            with suppress(UnicodeDecodeError):
+                hunks.extend(parser.close())
+                if hunks:
+                    patches[blobs] = hunks
+
+    for line in lines:
+        if line.startswith(b"diff --git "):
+            add_patch()
+            blobs = None
+            parser = None
+            hunks = []
+        elif parser or line.startswith(b"@@"):
+            if b"\0" in line:
+                # Git only looks for NUL bytes at the start of a file, it is
+                # classified from its contents instead.
+                blobs = None
+                parser = None
+                continue
+            parser = parser or HunkParser()
+            try:
+                hunks.extend(parser.feed(line))
+            except UnicodeDecodeError:
+                # The file is classified from its contents instead.
+                blobs = None
+                parser = None
+        elif blobs is None and line.startswith(b"index "):
+            a_blob, b_blob = line[6:].split(b" ", 1)[0].split(b"..")
+            blobs = (a_blob.decode(), b_blob.rstrip().decode())
+
+    add_patch()
+    return patches
+
+
 class Git(Repository):
     def __init__(self, path: str):
         dot_path = os.path.join(path, ".git")
@@ -66,6 +126,16 @@ class Git(Repository):
         self.vcs_version = m.group(0)
         self.revset = None
         self.branch = None
+        # Commits created by `_commit_tree` and not yet written to the repository,
+        # as their parent and raw object contents.
+        self._new_commits: Dict[str, Tuple[str, bytes]] = {}
+        # New commits mapped to an existing commit with the same changes.
+        self._rewritten: Dict[str, str] = {}
+        # Git to Mercurial nodes, `None` for the commits not published yet.
+        self._hg_nodes: Optional[Dict[str, Optional[str]]] = None
+        self._hg_nodes_modified = False
+        # Sizes of the blobs read with `_file_size`.
+        self._blob_sizes: Dict[str, int] = {}
 
     @property
     def is_cinnabar_installed(self) -> bool:
@@ -84,14 +154,85 @@ class Git(Repository):
 
         return self.git_out(["cinnabar", "hg2git", node], split=False)
 
-    @lru_cache(maxsize=None)  # noqa: B019
+    @property
+    def _hg_nodes_path(self) -> str:
+        return os.path.join(self.dot_path, "moz-phab", "git2hg.json")
+
+    def _get_hg_nodes(self) -> Dict[str, Optional[str]]:
+        """Return the Git to Mercurial mapping, loaded from the disk first."""
+        if self._hg_nodes is None:
+            self._hg_nodes = {}
+            try:
+                with open(self._hg_nodes_path, encoding="utf-8") as f:
+                    hg_nodes = json.load(f)
+                if isinstance(hg_nodes, dict):
+                    self._hg_nodes.update(hg_nodes)
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError) as e:
+                logger.debug("Ignoring %s: %s", self._hg_nodes_path, e)
+
+        return self._hg_nodes
+
+    def _save_hg_nodes(self):
+        """Store the mapping of the published commits, which never changes."""
+        if not self._hg_nodes_modified:
+            return
+
+        hg_nodes = {
+            node: hg_node for node, hg_node in self._hg_nodes.items() if hg_node
+        }
+        temp_name = None
+        try:
+            os.makedirs(os.path.dirname(self._hg_nodes_path), exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                "w",
+                encoding="utf-8",
+                dir=os.path.dirname(self._hg_nodes_path),
+                delete=False,
+            ) as f:
+                temp_name = f.name
+                json.dump(hg_nodes, f, separators=(",", ":"))
+            os.replace(temp_name, self._hg_nodes_path)
+        except OSError as e:
+            logger.debug("Failed to save %s: %s", self._hg_nodes_path, e)
+            if temp_name and os.path.exists(temp_name):
+                os.remove(temp_name)
+            return
+
+        self._hg_nodes_modified = False
+
     def _git_to_hg(self, node: str) -> Optional[str]:
         """Convert Git hashtag to Mercurial."""
         if not self.is_cinnabar_required:
             return None
 
-        hg_node = self.git_out(["cinnabar", "git2hg", node], split=False)
-        return hg_node if hg_node != NULL_SHA1 else None
+        hg_nodes = self._get_hg_nodes()
+        if node not in hg_nodes:
+            self.load_public_nodes([node])
+
+        return hg_nodes[node]
+
+    def load_public_nodes(self, nodes: List[str]):
+        if not self.is_cinnabar_required:
+            return
+
+        hg_nodes = self._get_hg_nodes()
+        missing = []
+        for node in nodes:
+            if node in self._new_commits:
+                # Commits created by moz-phab are not published.
+                hg_nodes[node] = None
+            elif node not in hg_nodes and node not in missing:
+                missing.append(node)
+
+        if not missing:
+            return
+
+        found = self.git_out(["cinnabar", "git2hg"] + missing)
+        for node, hg_node in zip(missing, found):
+            hg_nodes[node] = hg_node if hg_node != NULL_SHA1 else None
+            self._hg_nodes_modified |= hg_nodes[node] is not None
 
     @lru_cache(maxsize=128)  # noqa: B019
     def get_public_node(self, node: str) -> str:
@@ -159,27 +300,68 @@ class Git(Repository):
         )
 
     def cleanup(self):
+        try:
+            self._write_commits()
+            self._save_hg_nodes()
+        finally:
+            self.git.close()
         self.git_call(["gc", "--auto", "--quiet"])
         if self.branch:
             self.checkout(self.branch)
 
     def _find_branches_to_rebase(self, commits: List[Commit]) -> dict:
-        """Create a list of branches to rebase."""
-        branches_to_rebase = {}
-        for commit in commits:
-            if commit.node == commit.orig_node:
-                continue
-            branches = self.git_out(
-                ["branch", "--contains", commit.orig_node, "--format=%(refname)"]
-            )
-            for branch in branches:
-                if branch.startswith(("* (", "+ ")):
-                    # Omit `* (detached from {SHA1})`
-                    # and `+ {anything}` (indicating a checkout in another worktree)
-                    continue
+        """Create a list of branches to rebase.
 
-                branch = branch.lstrip("* ")
+        Branches containing the first rewritten commit are listed at once, their
+        history is then walked down to that commit to find the last rewritten
+        commit each of them contains.
+        """
+        rewritten = {
+            commit.orig_node: index
+            for index, commit in enumerate(commits)
+            if commit.node != commit.orig_node
+        }
+        if not rewritten:
+            return {}
+
+        first_node = commits[min(rewritten.values())].orig_node
+        tips = {}
+        for line in self.git_out(
+            [
+                "for-each-ref",
+                "--contains",
+                first_node,
+                "--format=%(objectname) %(refname)",
+                "refs/heads/",
+            ]
+        ):
+            tip, branch = line.split(" ", 1)
+            tips[branch] = tip
+
+        if not tips:
+            return {}
+
+        # Index of the last rewritten commit contained by each commit of the walk.
+        # Parents are listed after their children, so the walk is read backwards.
+        last_rewritten = {}
+        walk = self.git_out(
+            ["rev-list", "--topo-order", "--parents"]
+            + sorted(set(tips.values()))
+            + ["--not", "%s^@" % first_node]
+        )
+        for line in reversed(walk):
+            node, *parents = line.split(" ")
+            indexes = [last_rewritten[p] for p in parents if p in last_rewritten]
+            if node in rewritten:
+                indexes.append(rewritten[node])
+            if indexes:
+                last_rewritten[node] = max(indexes)
+
+        branches_to_rebase = {}
+        for branch, tip in tips.items():
+            if tip in last_rewritten:
                 # Rebase the branch to the last commit from the stack .
+                commit = commits[last_rewritten[tip]]
                 branches_to_rebase[branch] = [commit.node, commit.orig_node]
 
         return branches_to_rebase
@@ -188,8 +370,17 @@ class Git(Repository):
         """Rebase all branches based on changed commits from the stack."""
         branches_to_rebase = self._find_branches_to_rebase(commits)
 
-        for branch, (newbase, upstream) in branches_to_rebase.items():
-            self._rebase_branch(branch, newbase, upstream)
+        ref_updates = {
+            branch: self._rebase_branch(branch, newbase, upstream)
+            for branch, (newbase, upstream) in branches_to_rebase.items()
+        }
+
+        # Write all the new commits and move the branches in one transaction.
+        self._write_commits(
+            list(ref_updates.values()) + [commit.node for commit in commits]
+        )
+        if ref_updates:
+            self._update_refs(ref_updates)
 
         # Return to the newly-updated branch. This should be a noop file-mtime-wise
         self.checkout(self.branch)
@@ -283,40 +474,47 @@ class Git(Repository):
             end = start_rev if is_single else self.args.end_rev
             self.revset = (start, end)
 
-    def _git_get_children(self, node: str) -> str:
-        """Get commits SHA1 with their children.
+    def _git_get_children(self, node: str, end: str) -> Dict[str, List[str]]:
+        """Index the children of the commits between `node` and `end`.
+
+        Only the commits reachable from `end` and not from the parents of `node`
+        are listed, the size of the index doesn't depend on the repository.
 
         Args:
-            node: The SHA1 of a node to check for all children
+            node: The SHA1 of the first commit of the stack
+            end: The last revision of the stack
 
-        Returns: A list of "aaaa bbbb cccc"" strings, where bbbb and cccc are
-            SHA1 of direct children of aaaa
+        Returns: A dict of SHA1 to the list of SHA1 of its direct children
         """
+        children = {}
+        for line in self.git_out(
+            ["rev-list", "--parents", end, "--not", "%s^@" % node]
+        ):
+            child, *parents = line.split(" ")
+            for parent in parents:
+                children.setdefault(parent, []).append(child)
 
-        # Logging is disabled for this command as it can generate a _lot_ of
-        # results, especially on mozilla-central.
-        return self.git_out(
-            ["rev-list", "--all", "--children", "--not", "%s^@" % node], never_log=True
-        )
+        return children
 
     @staticmethod
-    def _get_direct_children(node: str, rev_list: List[str]) -> List[str]:
-        """Return direct children of the commit.
+    def _get_descendants(node: str, children: Dict[str, List[str]]) -> Set[str]:
+        """Return all the direct and indirect children of the commit.
 
         Args:
-            node: The SHA1 of a node to check for direct children
-            rev_list: A list of SHA1 strings - result of the _git_get_children method
+            node: The SHA1 of a node to collect the children of
+            children: A result of the _git_get_children method
 
-        Returns: A list of SHA1 representing direct children of a commit
+        Returns: A set of SHA1 of the descendants of the commit
         """
-        # Find the line containing the node to extract its commit's children
-        for line in rev_list:
-            if line.startswith(node):
-                children = line.split(" ")
-                children.remove(node)
-                return children
+        descendants = set()
+        to_visit = list(children.get(node, []))
+        while to_visit:
+            child = to_visit.pop()
+            if child not in descendants:
+                descendants.add(child)
+                to_visit.extend(children.get(child, []))
 
-        return []
+        return descendants
 
     def _get_commits_info(self, start: str, end: str) -> List[str]:
         """Log useful info about the commits within the desired range.
@@ -342,7 +540,7 @@ class Git(Repository):
                 "--reverse",
                 "--ancestry-path",
                 "--quiet",
-                "--format=%aD%n%an%n%ae%n%p%n%T%n%H%n%s%n%n%b{}".format(boundary),
+                "--format=%aD%n%an%n%ae%n%P%n%T%n%H%n%s%n%n%b{}".format(boundary),
                 "{}..{}".format(start, end),
             ],
             split=False,
@@ -351,28 +549,6 @@ class Git(Repository):
         # We have split=False above, so log is indeed a string.
         return log.split("%s\n" % boundary)
 
-    def _is_child(self, parent: str, node: str, rev_list: List[str]) -> bool:
-        """Check if `node` is a direct or indirect child of the `parent`.
-
-        Args:
-            parent: The parent node whose children will be searched
-            node: The string we check if it's in parent-child relation to the `parent`
-            rev_list: A response from the git _git_get_children method - a list of
-                "aaaa bbbb cccc"" strings, where "bbbb" and cccc" are SHA1 of direct
-                children of "aaaa"
-
-        Returns: a Boolean True if the `node` represents a child of the `parent`.
-        """
-        direct_children = self._get_direct_children(parent, rev_list)
-        if node in direct_children:
-            return True
-
-        for child in direct_children:
-            if self._is_child(child, node, rev_list):
-                return True
-
-        return False
-
     def commit_stack(self, single: bool = False) -> Optional[List[Commit]]:
         """Collect all the info about commits."""
         if not self.revset:
@@ -380,27 +556,29 @@ class Git(Repository):
             return None
 
         commits = []
-        rev_list = None
         first_node = None
         for log_line in self._get_commits_info(*self.revset):
             if not log_line:
                 continue
 
             commit = self._commit_from_info(log_line, first_node)
+            if not single and first_node is None:
+                first_node = commit.node
+
+            commits.append(commit)
 
-            if not single:
-                # Check if the commit is a child of the first one
-                if rev_list is None:
-                    rev_list = self._git_get_children(commit.node)
-                    first_node = commit.node
-                elif not self._is_child(first_node, commit.node, rev_list):
+        if not single and len(commits) > 1:
+            # Check if the commits are children of the first one
+            descendants = self._get_descendants(
+                first_node, self._git_get_children(first_node, commits[-1].node)
+            )
+            for commit in commits[1:]:
+                if commit.node not in descendants:
                     raise Error(
                         "Commit %s is not a child of %s, unable to continue"
                         % (short_node(commit.node), short_node(first_node))
                     )
 
-            commits.append(commit)
-
         return commits
 
     def _commit_from_info(
@@ -579,6 +757,50 @@ class Git(Repository):
         """Return the SHA1 of given branch."""
         return self.git_out(["rev-parse", branch], split=False)
 
+    @lru_cache(maxsize=None)  # noqa: B019
+    def _get_object_format(self) -> str:
+        """Return the name of the hash algorithm used by the repository."""
+        try:
+            return self.git_out(
+                ["rev-parse", "--show-object-format"],
+                split=False,
+                stderr=subprocess.DEVNULL,
+            )
+        except CommandError:
+            # Git versions before 2.25 only support SHA1.
+            return "sha1"
+
+    @lru_cache(maxsize=None)  # noqa: B019
+    def _get_committer_ident(self) -> str:
+        """Return the committer of the new commits with the current date."""
+        return self.git_out(["var", "GIT_COMMITTER_IDENT"], split=False)
+
+    @lru_cache(maxsize=None)  # noqa: B019
+    def _get_author_ident(self, author_name: str, author_email: str) -> str:
+        """Return the author as Git writes it, without the characters it drops."""
+        ident = self.git_out(
+            ["var", "GIT_AUTHOR_IDENT"],
+            split=False,
+            extra_env={
+                "GIT_AUTHOR_NAME": author_name,
+                "GIT_AUTHOR_EMAIL": author_email,
+                "GIT_AUTHOR_DATE": "@0 +0000",
+            },
+        )
+        return ident.rsplit(" ", 2)[0]
+
+    @lru_cache(maxsize=None)  # noqa: B019
+    def _signs_commits(self) -> bool:
+        """Return `True` if the new commits must be signed, see `commit.gpgSign`."""
+        try:
+            return (
+                self.git_out(["config", "--bool", "commit.gpgSign"], split=False)
+                == "true"
+            )
+        except CommandError:
+            # The setting is missing.
+            return False
+
     def _commit_tree(
         self,
         parent: str,
@@ -588,9 +810,11 @@ class Git(Repository):
         author_email: str,
         author_date: str,
     ) -> str:
-        """Prepare and run `commit-tree` command.
+        """Prepare a commit object like `commit-tree` would.
 
-        Creates a new commit for the tree_hash.
+        Creates a new commit for the tree_hash. The commit is only hashed, it's
+        written to the repository with all the other new commits by
+        `_write_commits`. Signed commits are created with `commit-tree` directly.
         Args:
             parent: SHA1 of the parent commit
             tree_hash: SHA1 of the tree_hash to use for the commit
@@ -599,23 +823,91 @@ class Git(Repository):
         Returns:
             str: SHA1 of the new commit.
         """
-        with temporary_file(message) as message_file:
-            return self.git_out(
-                ["commit-tree", "-p", parent, "-F", message_file, tree_hash],
-                split=False,
-                extra_env={
-                    "GIT_AUTHOR_NAME": author_name,
-                    "GIT_AUTHOR_EMAIL": author_email,
-                    "GIT_AUTHOR_DATE": author_date,
-                },
-            )
+        if self._signs_commits():
+            with temporary_file(message) as message_file:
+                return self.git_out(
+                    ["commit-tree", "-S", "-p", parent, "-F", message_file]
+                    + [tree_hash],
+                    split=False,
+                    extra_env={
+                        "GIT_AUTHOR_NAME": author_name,
+                        "GIT_AUTHOR_EMAIL": author_email,
+                        "GIT_AUTHOR_DATE": author_date,
+                    },
+                )
+
+        date = datetime.strptime(author_date, "%a, %d %b %Y %H:%M:%S %z")
+        contents = (
+            f"tree {tree_hash}\n"
+            f"parent {parent}\n"
+            f"author {self._get_author_ident(author_name, author_email)} "
+            f"{int(date.timestamp())} {date:%z}\n"
+            f"committer {self._get_committer_ident()}\n"
+            f"\n{message}"
+        ).encode("utf-8")
+        header = b"commit %d\0" % len(contents)
+        node = hashlib.new(self._get_object_format(), header + contents).hexdigest()
+        self._new_commits[node] = (parent, contents)
+        return node
+
+    def _write_commits(self, tips: Optional[List[str]] = None):
+        """Write the new commits with a single `git` process.
+
+        Args:
+            tips: Only the new commits reachable from these SHA1 are written,
+                all of them if not provided. The others are forgotten.
+        """
+        if tips is None:
+            nodes = list(self._new_commits)
+        else:
+            nodes = []
+            for node in tips:
+                while node in self._new_commits and node not in nodes:
+                    nodes.append(node)
+                    node = self._new_commits[node][0]
+
+        if nodes:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                paths = []
+                for node in nodes:
+                    path = os.path.join(temp_dir, node)
+                    with open(path, "wb") as f:
+                        f.write(self._new_commits[node][1])
+                    paths.append(path)
+
+                with temporary_file("\n".join(paths) + "\n") as paths_file, open(
+                    paths_file
+                ) as stdin:
+                    written = self.git_out(
+                        [
+                            "hash-object",
+                            "-t",
+                            "commit",
+                            "-w",
+                            "--no-filters",
+                            "--stdin-paths",
+                        ],
+                        stdin=stdin,
+                    )
+
+            if written != nodes:
+                raise Error("Failed to write the updated commits.")
+
+        self._new_commits = {}
+        self._rewritten = {}
+
+    def _update_refs(self, refs: Dict[str, str]):
+        """Point all the `refs` to their new SHA1 in a single transaction."""
+        updates = "".join(f"update {ref} {node}\n" for ref, node in refs.items())
+        with temporary_file(updates) as updates_file, open(updates_file) as stdin:
+            self.git_call(["update-ref", "--stdin"], stdin=stdin)
 
     def amend_commit(self, commit: Commit, commits: List[Commit]):
         """Amend the commit with an updated message.
 
         Changing commit's message changes also its SHA1.
         All the children within the stack and branches are then updated
-        to keep the history.
+        to keep the history. The new commits are written in `finalize`.
 
         Args:
             commit: Information about the commit to be amended
@@ -623,9 +915,14 @@ class Git(Repository):
         """
         updated_body = f"{commit.title}\n{commit.body}"
 
-        current_body = self.git_out(
-            ["show", "-s", "--format=%s%n%b", commit.node], split=False
-        )
+        if commit.node in self._new_commits:
+            current_body = (
+                self._new_commits[commit.node][1].split(b"\n\n", 1)[1].decode("utf-8")
+            )
+        else:
+            current_body = self.git_out(
+                ["show", "-s", "--format=%s%n%b", commit.node], split=False
+            )
         if current_body == updated_body:
             logger.debug("not amending commit %s, unchanged", commit.name)
             return
@@ -641,6 +938,7 @@ class Git(Repository):
         )
 
         # Update commit info
+        self._rewritten[new_parent_sha] = self._rewritten.get(commit.node, commit.node)
         commit.node = new_parent_sha
         # Update parent for all the children of the `commit` within the stack
         has_children = False
@@ -661,6 +959,9 @@ class Git(Repository):
                 stack_commit.author_email,
                 stack_commit.author_date,
             )
+            self._rewritten[new_parent_sha] = self._rewritten.get(
+                stack_commit.node, stack_commit.node
+            )
             stack_commit.node = new_parent_sha
 
     def rebase_commit(self, source_commit: dict, dest_commit: dict):
@@ -733,14 +1034,14 @@ class Git(Repository):
     def _rebase(self, newbase: str, upstream: str):
         self.git_call(["rebase", "--quiet", "--onto", newbase, upstream])
 
-    def _rebase_branch(self, branch: str, newbase: str, upstream: str):
+    def _rebase_branch(self, branch: str, newbase: str, upstream: str) -> str:
         """Rebase `branch` from `upstream` onto `newbase` without checking it out.
 
         This rewrites all the commits in `usptream..branch` into new commits rooted in `newbase`,
         reusing the git tree object of the original commit.
 
-        The branch reference is then updated to the last-rewritten commit.
-
+        Returns the SHA1 of the last-rewritten commit, the branch reference is
+        updated to it by `finalize`.
         """
         # Get list of commits from upstream.
         commits = self._get_commits_info(upstream, branch)
@@ -761,20 +1062,76 @@ class Git(Repository):
                 commit.author_email,
                 commit.author_date,
             )
-        # Update the branch ref to use the updated commit tree.
-        self.git_call(["update-ref", branch, base])
+        return base
 
-    @lru_cache(maxsize=128)  # noqa: B019
     def _file_size(self, blob: str) -> int:
-        return int(self.git_out(["cat-file", "-s", blob], split=False))
+        if blob not in self._blob_sizes:
+            self._blob_sizes[blob] = self.git.object_size(blob, cwd=self.path)
+        return self._blob_sizes[blob]
+
+    def _cat_file(self, blob: str) -> bytes:
+        key = ("git-blob", blob)
+        body = content_cache.get(key)
+        if body is None:
+            body = self.git.object_contents(blob, cwd=self.path)
+            content_cache.set(key, body)
+        return body
+
+    def _spool_blob(self, blob: str) -> SpooledContents:
+        """Write the blob to a temporary file instead of reading it."""
+        return SpooledContents(
+            lambda path: self.git.write_object(blob, path, cwd=self.path)
+        )
 
-    @lru_cache(maxsize=128)  # noqa: B019
-    def _cat_file(self, blob: str) -> str:
-        return self.git_out(["cat-file", "blob", blob], split=False, expect_binary=True)
+    def _context_size(self, file_size: int) -> int:
+        """Return the number of context lines to diff a file with."""
+        if self.args.lesscontext or file_size > environment.MAX_CONTEXT_SIZE:
+            return 100
+        return environment.MAX_CONTEXT_SIZE
+
+    def _get_patches(self, node: str) -> Dict[Tuple[str, str], List[Diff.Hunk]]:
+        """Diff all the text files changed in the commit with a single process.
+
+        Files bigger than `MAX_CONTEXT_SIZE` are skipped as they're diffed with
+        less context. Added and deleted files are skipped too, their hunks are
+        built from their contents.
 
-    def _parse_diff_change(self, raw: str, diff: Diff) -> Diff.Change:
+        Returns the hunks of the patches identified by the old and new blob SHA1.
+        """
+        context_size = self._context_size(0)
+        lines = self.git.output_lines(
+            ["-c", f"core.bigFileThreshold={environment.MAX_CONTEXT_SIZE}"]
+            + [
+                "diff-tree",
+                "-r",
+                "-p",
+                "-M",
+                "-C",
+                "--no-commit-id",
+                "--full-index",
+                "--diff-filter=MRCT",
+                "--submodule=short",
+                "--no-ext-diff",
+                "--no-color",
+                "--no-textconv",
+                f"-U{context_size}",
+                node,
+            ],
+            cwd=self.path,
+        )
+        return split_patches(lines)
+
+    def _parse_diff_change(
+        self,
+        raw: str,
+        diff: Diff,
+        patches: Optional[Dict[Tuple[str, str], List[Diff.Hunk]]] = None,
+    ) -> Diff.Change:
         """Parse the changes provided in raw `git` response.
 
+        Modified files are diffed on their own unless their patch is found in
+        `patches`.
+
         Returns a Diff.Change object.
         """
         # find changed path
@@ -791,113 +1148,113 @@ class Git(Repository):
         # create a Change object
         change = diff.change_for(b_path)
 
+        # Check the sizes of the blobs before reading them.
+        a_size = 0 if a_blob == NULL_SHA1 else self._file_size(a_blob)
+        b_size = 0 if b_blob == NULL_SHA1 else self._file_size(b_blob)
+        file_size = max(a_size, b_size)
+        telemetry().submission.files_size.accumulate(file_size)
+
+        # Files too big to be diffed are binary from their size alone, their
+        # contents are only needed for the upload and aren't read.
+        if file_size > environment.MAX_TEXT_SIZE:
+            change.binary = True
+            read_blob = self._spool_blob
+        else:
+            read_blob = self._cat_file
+
         # Extract the bodies of blobs to compare
         if a_blob == NULL_SHA1:
-            a_blob, a_body, a_size = None, b"", 0
+            a_blob, a_body = None, b""
         else:
-            a_body = self._cat_file(a_blob)
-            a_size = self._file_size(a_blob)
+            a_body = read_blob(a_blob)
 
         if b_blob == NULL_SHA1:
-            b_blob, b_body, b_size = None, b"", 0
+            b_blob, b_body = None, b""
         else:
-            b_body = self._cat_file(b_blob)
-            b_size = self._file_size(b_blob)
+            b_body = read_blob(b_blob)
 
-        file_size = max(a_size, b_size)
-        telemetry().submission.files_size.accumulate(file_size)
-
-        # Detect if we're binary, and generate a unified diff
-        if b"\0" in a_body or b"\0" in b_body or file_size > environment.MAX_TEXT_SIZE:
-            change.binary = True
-
-        if not change.binary and a_body:
-            try:
-                a_body = str(a_body, "utf-8")
-            except UnicodeDecodeError:
-                change.binary = True
+        # Detect if we're binary, and only decode text.
+        if not change.binary:
+            change.binary = b"\0" in a_body or b"\0" in b_body
 
-        if not change.binary and b_body:
+        if not change.binary:
             try:
-                b_body = str(b_body, "utf-8")
+                # Both bodies are kept as bytes if either isn't text.
+                a_body, b_body = str(a_body, "utf-8"), str(b_body, "utf-8")
             except UnicodeDecodeError:
                 change.binary = True
 
         if change.binary:
             change.set_as_binary(
                 a_body=a_body,
-                a_mime=mimetypes.guess_type(a_path)[0] or "",
+                a_mime=guess_mime_type(a_path, a_body),
                 b_body=b_body,
-                b_mime=mimetypes.guess_type(b_path)[0] or "",
+                b_mime=guess_mime_type(b_path, b_body),
+                a_key=a_blob,
+                b_key=b_blob,
             )
 
         else:
             # We can only diff changed blobs.
             if a_blob == b_blob:
                 # No changes in the file contents.
-                lines = create_hunk_lines(a_body, " ", False)[0]
-                if lines:
-                    change.hunks.append(
+                corpus, line_count, _ = create_hunk_corpus(a_body, " ", False)
+                if corpus:
+                    change.add_hunk(
                         Diff.Hunk(
                             old_off=1,
-                            old_len=len(lines),
+                            old_len=line_count,
                             new_off=1,
-                            new_len=len(lines),
-                            lines=lines,
+                            new_len=line_count,
+                            buffer=corpus,
                         )
                     )
             elif a_blob is None:
                 # The file is created.
-                lines, eof_missing_newline = create_hunk_lines(b_body, "+")
-                if lines:
-                    new_len = len(lines)
-                    if eof_missing_newline:
-                        new_len -= 1
-                    change.hunks.append(
+                corpus, line_count, _ = create_hunk_corpus(b_body, "+")
+                if corpus:
+                    change.add_hunk(
                         Diff.Hunk(
                             old_off=0,
                             old_len=0,
                             new_off=1,
-                            new_len=new_len,
-                            lines=lines,
+                            new_len=line_count,
+                            buffer=corpus,
                         )
                     )
 
             elif b_blob is None and file_size:
                 # The file is removed.
-                lines, eof_missing_newline = create_hunk_lines(a_body, "-")
-                if lines:
-                    old_len = len(lines)
-                    if eof_missing_newline:
-                        old_len -= 1
-                    change.hunks.append(
+                corpus, line_count, _ = create_hunk_corpus(a_body, "-")
+                if corpus:
+                    change.add_hunk(
                         Diff.Hunk(
                             old_off=1,
-                            old_len=old_len,
+                            old_len=line_count,
                             new_off=0,
                             new_len=0,
-                            lines=lines,
+                            buffer=corpus,
                         )
                     )
             elif b_blob is not None:
                 # There are changes in the file.
-                if self.args.lesscontext or file_size > environment.MAX_CONTEXT_SIZE:
-                    context_size = 100
+                hunks = (patches or {}).get((a_blob, b_blob))
+                if hunks is None:
+                    diff_args = [
+                        "diff",
+                        "--submodule=short",
+                        "--no-ext-diff",
+                        "--no-color",
+                        "--no-textconv",
+                        "-U%s" % self._context_size(file_size),
+                        a_blob,
+                        b_blob,
+                    ]
+                    git_diff = self.git_out(diff_args, expect_binary=True)
+                    change.from_git_diff(git_diff)
                 else:
-                    context_size = environment.MAX_CONTEXT_SIZE
-
-                diff_args = [
-                    "diff",
-                    "--submodule=short",
-                    "--no-ext-diff",
-                    "--no-color",
-                    "--no-textconv",
-                    "-U%s" % context_size,
-                    a_blob,
-                    b_blob,
-                ]
-                git_diff = self.git_out(diff_args, expect_binary=True).decode("utf-8")
-                change.from_git_diff(git_diff)
+                    for hunk in hunks:
+                        change.add_hunk(hunk)
 
         diff.set_change_kind(change, kind_l[0], a_mode, b_mode, a_path, b_path)
 
@@ -905,6 +1262,9 @@ class Git(Repository):
 
     def get_diff(self, commit: Commit) -> Diff:
         """Create a Diff object with changes."""
+        # Commits amended during the submission are not written yet, their
+        # changes are the same as the commits they replace.
+        node = self._rewritten.get(commit.node, commit.node)
         raw = self.git_out(
             [
                 "diff-tree",
@@ -914,17 +1274,32 @@ class Git(Repository):
                 "-M",
                 "-C",
                 "--no-abbrev",
-                commit.node,
+                node,
             ],
             split=False,
         )
 
+        patches = self._get_patches(node)
+
         diff = Diff()
         for raw_change in raw[:-1].split("\0:")[1:]:
-            self._parse_diff_change(raw_change, diff)
+            self._parse_diff_change(raw_change, diff, patches)
 
         return diff
 
+    def set_diff_fingerprints(self, commits: List[Commit]):
+        try:
+            parent_trees = self.git_out(
+                ["rev-parse"] + [f"{commit.node}^^{{tree}}" for commit in commits],
+                stderr=subprocess.DEVNULL,
+            )
+        except CommandError:
+            # The first commit of the stack is a root commit.
+            return
+
+        for commit, parent_tree in zip(commits, parent_trees):
+            commit.fingerprint = self._diff_fingerprint(parent_tree, commit.tree_hash)
+
     def check_vcs(self) -> bool:
         if self.args.force_vcs:
             return True
@@ -6,18 +6,94 @@
 import argparse
 import os
 import re
+import subprocess
+import threading
 from pathlib import Path
 from shutil import which
 from typing import (
+    Dict,
+    Iterator,
     List,
     Optional,
+    Tuple,
     Union,
 )
 
 from .config import config
-from .exceptions import Error
+from .exceptions import CommandError, Error
 from .helpers import parse_config, which_path
-from .subprocess_wrapper import check_call, check_output
+from .logger import logger
+from .subprocess_wrapper import check_call, check_output, debug_log_command
+
+UNICODE_ARGS = [
+    "-c",
+    "i18n.logOutputEncoding=UTF-8",
+    "-c",
+    "i18n.commitEncoding=UTF-8",
+]
+
+
+class CatFile:
+    """A long-lived `git cat-file --batch` or `--batch-check` process.
+
+    Objects are requested one per line on its stdin, their headers (and contents
+    with `--batch`) are read back from its stdout.
+    """
+
+    def __init__(self, command: List[str], mode: str, cwd: str, env: dict):
+        self.mode = mode
+        full_command = command + ["cat-file", f"--{mode}"]
+        debug_log_command(full_command)
+        self._lock = threading.Lock()
+        self._process = subprocess.Popen(
+            full_command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            cwd=cwd,
+            env=env,
+        )
+
+    def query(self, obj: str) -> Tuple[int, Optional[bytes]]:
+        """Return the size of the object, and its contents in `batch` mode."""
+        with self._lock:
+            try:
+                self._process.stdin.write(obj.encode() + b"\n")
+                self._process.stdin.flush()
+                header = self._process.stdout.readline().decode().split()
+                if len(header) != 3:
+                    raise CommandError(
+                        (
+                            f"object {obj} is missing"
+                            if header[-1:] == ["missing"]
+                            else f"git cat-file --{self.mode} stopped unexpectedly"
+                        ),
+                        self._process.poll() or 128,
+                    )
+
+                size = int(header[2])
+                if self.mode != "batch":
+                    return size, None
+
+                contents = self._process.stdout.read(size)
+                # Contents are followed by a newline.
+                self._process.stdout.read(1)
+                return size, contents
+            except (OSError, ValueError) as e:
+                raise CommandError(f"git cat-file --{self.mode} failed: {e}", 128)
+
+    @property
+    def alive(self) -> bool:
+        return self._process.poll() is None
+
+    def close(self):
+        if self.alive:
+            self._process.stdin.close()
+            try:
+                self._process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+                self._process.wait()
+        self._process.stdout.close()
 
 
 class GitCommand:
@@ -34,15 +110,12 @@ class GitCommand:
         self._cinnabar_installed = None
         self.safe_mode = config.safe_mode
         self.email = ""
+        self._cat_files: Dict[Tuple[str, str], CatFile] = {}
+        # The processes are shared by the threads creating diffs and uploads.
+        self._cat_files_lock = threading.Lock()
 
     def call(self, git_args: List[str], **kwargs):
-        unicode_args = [
-            "-c",
-            "i18n.logOutputEncoding=UTF-8",
-            "-c",
-            "i18n.commitEncoding=UTF-8",
-        ]
-        check_call(self.command + unicode_args + git_args, env=self._env, **kwargs)
+        check_call(self.command + UNICODE_ARGS + git_args, env=self._env, **kwargs)
 
     def output(
         self, git_args: List[str], extra_env: Optional[dict] = None, **kwargs
@@ -57,13 +130,61 @@ class GitCommand:
         if extra_env:
             env.update(extra_env)
 
-        unicode_args = [
-            "-c",
-            "i18n.logOutputEncoding=UTF-8",
-            "-c",
-            "i18n.commitEncoding=UTF-8",
-        ]
-        return check_output(self.command + unicode_args + git_args, env=env, **kwargs)
+        return check_output(self.command + UNICODE_ARGS + git_args, env=env, **kwargs)
+
+    def output_lines(self, git_args: List[str], cwd: str) -> Iterator[bytes]:
+        """Run git command and yield its output line by line, as it's produced."""
+        command = self.command + UNICODE_ARGS + git_args
+        debug_log_command(command)
+        process = subprocess.Popen(
+            command, stdout=subprocess.PIPE, cwd=cwd, env=self._env
+        )
+        try:
+            yield from process.stdout
+        finally:
+            process.stdout.close()
+            process.wait()
+
+        if process.returncode:
+            raise CommandError(
+                "command '%s' failed to complete successfully" % command[0],
+                process.returncode,
+            )
+
+    def object_size(self, obj: str, cwd: str) -> int:
+        """Return the size of the object in bytes, without reading its contents."""
+        size, _contents = self._cat_file("batch-check", cwd).query(obj)
+        return size
+
+    def object_contents(self, obj: str, cwd: str) -> bytes:
+        """Return the contents of the object."""
+        size, contents = self._cat_file("batch", cwd).query(obj)
+        logger.debug("%s bytes of data received", size)
+        return contents
+
+    def write_object(self, obj: str, path: str, cwd: str):
+        """Write the contents of the object to `path`, without reading them."""
+        with open(path, "wb") as f:
+            self.call(["cat-file", "blob", obj], cwd=cwd, stdout=f)
+
+    def _cat_file(self, mode: str, cwd: str) -> CatFile:
+        """Return a running `git cat-file` process, starting it if needed."""
+        with self._cat_files_lock:
+            cat_file = self._cat_files.get((mode, cwd))
+            if cat_file is None or not cat_file.alive:
+                if cat_file is not None:
+                    cat_file.close()
+                cat_file = CatFile(self.command + UNICODE_ARGS, mode, cwd, self._env)
+                self._cat_files[(mode, cwd)] = cat_file
+            return cat_file
+
+    def close(self):
+        """Stop the `git cat-file` processes."""
+        with self._cat_files_lock:
+            cat_files = list(self._cat_files.values())
+            self._cat_files.clear()
+        for cat_file in cat_files:
+            cat_file.close()
 
     def set_args(self, args: argparse.Namespace):
         """Read and set the configuration."""
@@ -6,16 +6,19 @@
 from __future__ import annotations
 
 import json
+import mimetypes
+import mmap
 import os
 import re
 import stat
 import sys
 import tempfile
-from contextlib import contextmanager
+from contextlib import contextmanager, suppress
 from itertools import zip_longest
 from shutil import which
 from typing import (
     Callable,
+    Iterator,
     List,
     Optional,
     Tuple,
@@ -70,6 +73,17 @@ BLOCKING_REVIEWERS_RE = re.compile(r"\b(r!)([" + IRC_NICK_CHARS_WITH_PERIOD + ",
 DEPENDS_ON_RE = re.compile(r"^\s*Depends on\s*D(\d+)\s*$", flags=re.MULTILINE)
 
 
+# Line added to a hunk when the file doesn't end with a newline.
+NO_NEWLINE_AT_EOF = "\\ No newline at end of file\n"
+
+# Images recognised from their first bytes when their name has no known extension.
+IMAGE_SIGNATURES = {
+    b"\x89PNG\r\n\x1a\n": "image/png",
+    b"GIF87a": "image/gif",
+    b"GIF89a": "image/gif",
+    b"\xff\xd8\xff": "image/jpeg",
+}
+
 VALID_EMAIL_RE = re.compile(r"[^@ \t\r\n]+@[^@ \t\r\n]+\.[^@ \t\r\n]+")
 
 
@@ -166,6 +180,92 @@ def temporary_binary_file(content: bytes):
         os.remove(f.name)
 
 
+class SpooledContents:
+    """Contents of a file written to a temporary file instead of being read.
+
+    `write` is called with the path of the temporary file to fill, usually by a
+    command writing the file directly. The contents are mapped in memory when
+    viewed, so they're paged in by the system as they're read instead of being
+    copied. The temporary file is removed by `close`, or once the object is gone.
+    """
+
+    __slots__ = ("path", "size")
+
+    def __init__(self, write: Callable[[str], None]):
+        f = tempfile.NamedTemporaryFile(delete=False, prefix="moz-phab-")
+        f.close()
+        self.path: Optional[str] = f.name
+        try:
+            write(f.name)
+            self.size = os.path.getsize(f.name)
+        except BaseException:
+            self.close()
+            raise
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __del__(self):
+        self.close()
+
+    def head(self, size: int) -> bytes:
+        """Read the first `size` bytes of the contents."""
+        with open(self.path, "rb") as f:
+            return f.read(size)
+
+    @contextmanager
+    def view(self) -> Iterator[memoryview]:
+        """Map the contents in memory and yield a read-only view of them."""
+        if not self.size:
+            yield memoryview(b"")
+            return
+
+        with open(self.path, "rb") as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mapping)
+        try:
+            yield view
+        finally:
+            # Slices of the view kept by a traceback keep the mapping open, it's
+            # then unmapped once they're collected.
+            with suppress(BufferError):
+                view.release()
+                mapping.close()
+
+    def close(self):
+        """Remove the temporary file."""
+        path = getattr(self, "path", None)
+        if path is not None:
+            self.path = None
+            with suppress(OSError):
+                os.remove(path)
+
+
+@contextmanager
+def contents_view(contents: bytes | str | SpooledContents) -> Iterator:
+    """Yield a bytes-like view of file contents, mapping spooled contents."""
+    if isinstance(contents, SpooledContents):
+        with contents.view() as view:
+            yield view
+    else:
+        yield contents
+
+
+def guess_mime_type(path: str, contents: bytes | str | SpooledContents) -> str:
+    """Return the MIME type of a binary file from its name, or its first bytes."""
+    mime = mimetypes.guess_type(path)[0]
+    if mime:
+        return mime
+
+    if isinstance(contents, SpooledContents):
+        contents = contents.head(max(len(s) for s in IMAGE_SIGNATURES))
+    if isinstance(contents, bytes):
+        for signature, image_mime in IMAGE_SIGNATURES.items():
+            if contents.startswith(signature):
+                return image_mime
+    return ""
+
+
 def get_arcrc_path() -> str:
     """Return a path to the user's Arcanist configuration file."""
     if "arcrc" in cache:
@@ -448,8 +548,69 @@ def short_node(text: str) -> str:
     return text
 
 
+def create_hunk_corpus(
+    body: bytes | str, prefix: str, check_eof: bool = True
+) -> Tuple[str, int, Optional[bool]]:
+    """Build the corpus of a hunk showing all the lines of a text body.
+
+    Lines are split on POSIX and DOS style line endings like `split_lines` does,
+    but in a single pass: the prefix is inserted after every line separator. A
+    `bytes` body is decoded once, after being prefixed.
+
+    Args:
+        body: The raw content of the file.
+        prefix: A character (e.g. "+") indicating whether the lines are to be
+            added or removed or are unchanged.
+        check_eof: Whether to check or not to check the end of the file for the
+            newline character. If set to True and the newline character is
+            missing, it is added to the last line along with a message.
+
+    Returns:
+        A tuple containing the corpus, the number of lines of the body, and a
+            boolean representing whether the file terminated without a new line
+            if `check_eof` is True, `None` if not.
+
+    Raises:
+        UnicodeDecodeError if a `bytes` body isn't valid UTF-8.
+    """
+    allowed_prefixes = ("+", "-", " ")
+    if prefix not in allowed_prefixes:
+        raise ValueError(f"Prefix should be one of {allowed_prefixes}")
+
+    if not body:
+        # `body` has absolutely nothing in it, return values accordingly.
+        if check_eof and prefix != "+":
+            return NO_NEWLINE_AT_EOF, 0, True
+        return "", 0, None
+
+    if isinstance(body, bytes):
+        newline, line_prefix = b"\n", prefix.encode()
+    else:
+        newline, line_prefix = "\n", prefix
+
+    separators = body.count(newline)
+    eof_missing_newline = not body.endswith(newline)
+    # Prefix the line following each separator, but the end of the body.
+    corpus = (line_prefix + body).replace(
+        newline,
+        newline + line_prefix,
+        separators if eof_missing_newline else separators - 1,
+    )
+    if isinstance(corpus, bytes):
+        corpus = corpus.decode("utf-8")
+
+    if eof_missing_newline and check_eof:
+        corpus += "\n" + NO_NEWLINE_AT_EOF
+
+    return (
+        corpus,
+        separators + eof_missing_newline,
+        eof_missing_newline if check_eof else None,
+    )
+
+
 def create_hunk_lines(
-    body: str, prefix: str, check_eof: bool = True
+    body: bytes | str, prefix: str, check_eof: bool = True
 ) -> Tuple[List[str], Optional[bool]]:
     """Parse a text body into a list of lines to be used in hunks.
 
@@ -472,38 +633,14 @@ def create_hunk_lines(
         POSIX line terminator regardless of what line separators are already used in the
         body.
     """
-    allowed_prefixes = ("+", "-", " ")
-    if prefix not in allowed_prefixes:
-        raise ValueError(f"Prefix should be one of {allowed_prefixes}")
-
-    empty_file = body in ("", b"")
-
-    if empty_file:
-        # `body` has absolutely nothing in it, return values accordingly.
-        if check_eof and prefix != "+":
-            return ["\\ No newline at end of file\n"], True
-        else:
-            return [], None
-
-    # Split lines on line separators
-    lines = split_lines(body)
-    eof_missing_newline = lines[-1] != ""
-
-    # Re-add line separators for all lines except the last line.
+    corpus, _count, eof_missing_newline = create_hunk_corpus(body, prefix, check_eof)
+    lines = corpus.split("\n")
     last_line = lines.pop()
-    lines = join_lineseps(lines)
-    lines = [f"{prefix}{line}" for line in lines]
-    if eof_missing_newline:
-        if check_eof:
-            # Re-add the last line with the line separator, and another line
-            # indicating that no new line was at the EOF.
-            lines.append(f"{prefix}{last_line}\n")
-            lines.append("\\ No newline at end of file\n")
-        else:
-            # Re-add the last line as is since we weren't supposed to touch it.
-            lines.append(f"{prefix}{last_line}")
+    lines = [f"{line}\n" for line in lines]
+    if last_line:
+        lines.append(last_line)
 
-    return lines, eof_missing_newline if check_eof else None
+    return lines, eof_missing_newline
 
 
 def split_lines(body: bytes | str) -> List[bytes | str]:
@@ -6,14 +6,13 @@ from __future__ import annotations
 
 import argparse
 import json
-import mimetypes
 import os
 import re
 import sys
+import tempfile
 import time
 import uuid
 from contextlib import suppress
-from functools import lru_cache
 from typing import (
     Dict,
     List,
@@ -31,7 +30,9 @@ from .config import config
 from .diff import Diff
 from .exceptions import CommandError, Error, NotFoundError
 from .helpers import (
-    create_hunk_lines,
+    SpooledContents,
+    create_hunk_corpus,
+    guess_mime_type,
     is_valid_email,
     parse_config,
     short_node,
@@ -41,12 +42,64 @@ from .helpers import (
 )
 from .logger import logger
 from .repository import Repository
+from .simplecache import content_cache
 from .spinner import clear_terminal_line, wait_message
 from .subprocess_wrapper import debug_log_command
 from .telemetry import telemetry
 
 MINIMUM_MERCURIAL_VERSION = Version("4.3.3")
 
+PATCH_START = re.compile(rb"^(?=diff --git a/)", re.MULTILINE)
+PATCH_TARGET = re.compile(rb"^(?:rename|copy) to (.*)$", re.MULTILINE)
+PATCH_BINARY = re.compile(rb"^Binary file .* has changed$", re.MULTILINE)
+
+# Diff options of the user which would change the patches of the rewritten
+# commits. `[defaults]` and aliases are already ignored as hglib sets `HGPLAIN`.
+EXACT_DIFF_CONFIG = [
+    "diff.git=true",
+    "diff.ignorews=false",
+    "diff.ignorewsamount=false",
+    "diff.ignoreblanklines=false",
+    "diff.ignorewseol=false",
+    "diff.nobinary=false",
+    "diff.noprefix=false",
+    "diff.word-diff=false",
+    "diff.merge=false",
+]
+
+
+def split_patches(git_diff: bytes) -> Dict[str, bytes]:
+    """Split the output of `hg diff --git` into patches.
+
+    Returns the patches identified by the name of the file after the change.
+    """
+    patches = {}
+    for patch in PATCH_START.split(git_diff):
+        if not patch:
+            continue
+
+        header = patch.split(b"\n@@", 1)[0]
+        m = PATCH_TARGET.search(header)
+        if m:
+            filename = m.group(1)
+        else:
+            # Both names are the same: "diff --git a/<name> b/<name>".
+            names = header.split(b"\n", 1)[0][len(b"diff --git a/") :]
+            filename = names[: (len(names) - len(b" b/")) // 2]
+        patches[filename.decode("utf-8")] = patch
+
+    return patches
+
+
+def patch_body(git_diff: str) -> str:
+    """Read the contents of an added or removed file from its patch."""
+    hunk = git_diff.split("\n@@", 1)[1].split("\n", 1)[1]
+    lines = hunk.split("\n")[:-1]
+    if lines and lines[-1].startswith("\\"):
+        return "".join(line[1:] + "\n" for line in lines[:-1])[:-1]
+
+    return "".join(line[1:] + "\n" for line in lines)
+
 
 class Mercurial(Repository):
     def __init__(self, path: str):
@@ -68,7 +121,11 @@ class Mercurial(Repository):
         self.has_mq = False
         self.has_shelve = False
         self.previous_bookmark = None
+        # Sizes of the files read with `_get_file_sizes`, by revision and name.
+        self._file_sizes: Dict[Tuple[str, str], int] = {}
         self.has_temporary_bookmark = False
+        # Commits to amend with their stack and new description.
+        self._amends: List[Tuple[Commit, List[Commit], str]] = []
         self.username = ""
 
         # Check for `hg` presence
@@ -253,10 +310,17 @@ class Mercurial(Repository):
             self.hg(["bookmark", self.previous_bookmark])
 
     def after_submit(self):
+        # `finalize` isn't called for uplifts.
+        self._amend_commits()
+
         # Restore the previously active commit.
         self.hg(["update", self.previous_bookmark, "--quiet"])
 
     def cleanup(self):
+        # Amend the commits left if the submission stopped before `finalize`.
+        if self._amends:
+            self.finalize(self._amends[0][1])
+
         # Remove the store of obsolescence markers; if the user doesn't have evolve
         # installed mercurial will warn if this exists.
         if not self.use_evolve and self.unlink_obsstore:
@@ -300,34 +364,63 @@ class Mercurial(Repository):
         commit.node = node
         commit.name = f"{rev}:{short_node(node)}"
 
-    def _get_successor(self, node: str) -> Tuple[Optional[str], Optional[str]]:
-        """Get the successor of the commit represented by its node.
+    def _get_successors(self, nodes: List[str]) -> Dict[str, Tuple[str, str]]:
+        """Get the successors of the commits represented by their nodes.
 
-        Returns: a tuple containing rev and node.
+        Returns: a dict of tuples containing rev and node of the successor, by the
+        node of each rewritten commit. Commits which aren't rewritten, or have
+        been pruned, are not included.
         """
-        hg_log = self.hg_out(
+        successors = {}
+        for line in self.hg_out(
             ["log"]
-            + ["-T", "{rev} {node}\n"]
+            + [
+                "-T",
+                "{node}{successorssets % "
+                "\"|{join(successorset % '{rev}:{node}', ',')}\"}\n",
+            ]
             + ["--hidden"]
-            + ["-r", "successors(%s) and not obsolete()" % node]
-        )
-        if not hg_log:
-            return None, None
+            + ["-r", "obsolete() and (%s)" % " + ".join(nodes)]
+        ):
+            node, *successor_sets = line.split("|")
+            if not successor_sets:
+                continue
+
+            # Not sure the best way to handle multiple successors, so just bail out.
+            if len(successor_sets) > 1 or "," in successor_sets[0]:
+                raise Error(
+                    "Multiple successors found for %s, unable to continue" % node
+                )
+
+            successors[node] = tuple(successor_sets[0].split(":", 1))
 
-        # Not sure the best way to handle multiple successors, so just bail out.
-        if len(hg_log) > 1:
-            raise Error("Multiple successors found for %s, unable to continue" % node)
+        return successors
 
-        return hg_log[0].split(" ", 1)
+    def _get_successor(self, node: str) -> Tuple[Optional[str], Optional[str]]:
+        """Get the successor of the commit represented by its node.
+
+        Returns: a tuple containing rev and node.
+        """
+        return self._get_successors([node]).get(node, (None, None))
 
     def refresh_commit_stack(self, commits: List[Commit]):
         """Update all commits to point to their superseded commit."""
+        self._refresh_commits(commits)
+        self.revset = "%s::%s" % (commits[0].node, commits[-1].node)
+
+    def _refresh_commits(self, commits: List[Commit]):
+        """Update the commits to point to their superseded commit."""
+        successors = self._get_successors([commit.node for commit in commits])
+        previous_commit = None
         for commit in commits:
-            (rev, node) = self._get_successor(commit.node)
-            if rev and node:
+            if commit.node in successors:
+                (rev, node) = successors[commit.node]
                 self._refresh_commit(commit, node, rev)
-
-        self.revset = "%s::%s" % (commits[0].node, commits[-1].node)
+                # Rewritten commits are rebased onto the previous commit in the
+                # stack, a parent found before the rewrite is outdated.
+                if previous_commit and commit.parent:
+                    commit.parent = previous_commit.node
+            previous_commit = commit
 
     def set_args(self, args: argparse.Namespace):
         """Sets up the right environment for hg, prior to running it.
@@ -467,6 +560,7 @@ class Mercurial(Repository):
             + [
                 "-T",
                 "{rev}\n{node}\n{date|hgdate}\n{author|person}\n{author|email}\n"
+                "{join(revset('children(%%d)', rev) %% '{node}', ' ')}\n"
                 "{desc}%s" % boundary,
             ]
             + ["-r", self.revset],
@@ -482,12 +576,18 @@ class Mercurial(Repository):
         nodes = []
         branching_children = []
         for log_line in hg_log.split(boundary):
-            rev, node, author_date, author_name, author_email, desc = log_line.split(
-                "\n", 5
-            )
+            (
+                rev,
+                node,
+                author_date,
+                author_name,
+                author_email,
+                children,
+                desc,
+            ) = log_line.split("\n", 6)
             desc = desc.splitlines()
 
-            children = self.hg_log("children(%s)" % node)
+            children = children.split()
             if len(children) > 1 and not self.use_evolve:
                 branching_children.extend(children)
 
@@ -600,8 +700,12 @@ class Mercurial(Repository):
 
     def _amend_commit_body(self, node: str, body: str):
         with temporary_file(body) as body_file:
-            self.checkout(node)
-            self.hg(["commit", "--amend", "--logfile", body_file])
+            if self.use_evolve:
+                # Rewrite the commit without updating the working directory to it.
+                self.hg(["metaedit", "--rev", node, "--logfile", body_file])
+            else:
+                self.checkout(node)
+                self.hg(["commit", "--amend", "--logfile", body_file])
 
     def _get_parent(self, node: str) -> Optional[str]:
         return self.hg_out(
@@ -609,8 +713,10 @@ class Mercurial(Repository):
         )
 
     def finalize(self, commits: List[Commit]):
-        """Rebase stack children commits if needed."""
-        # Currently we do all rebases in `amend_commit` if the evolve extension
+        """Amend the commits and rebase stack children commits if needed."""
+        self._amend_commits()
+
+        # Currently we do all rebases in `_amend_commit` if the evolve extension
         # is not installed.
 
         if not self.use_evolve:
@@ -636,13 +742,132 @@ class Mercurial(Repository):
             logger.debug("not amending commit %s, unchanged", commit.name)
             return
 
+        # Amending may need to update the working directory, so all the commits are
+        # amended at once by `finalize` (or `after_submit`).
+        self._amends.append((commit, commits, updated_body))
+
+    def _amend_commits(self):
+        """Amend the commits queued by `amend_commit`, in order."""
+        amends, self._amends = self._amends, []
+        if not amends:
+            return
+
+        if not self.use_evolve and self._rewrite_stack(amends):
+            return
+
+        for commit, commits, updated_body in amends:
+            self._amend_commit(commit, commits, updated_body)
+
+    def _rewrite_stack(self, amends: List[Tuple[Commit, List[Commit], str]]) -> bool:
+        """Rewrite the stack from the first amended commit in a single pass.
+
+        Without evolve only the working directory parent can be amended. The
+        commits are imported again with their updated descriptions instead, with
+        `hg import --bypass` which doesn't touch the working directory. The
+        original commits are stripped by `cleanup`.
+
+        Returns `False` if the stack can't be imported as it has empty commits.
+        """
+        commits = amends[0][1]
+        bodies = {commit.node: updated_body for commit, _, updated_body in amends}
+        position = next(
+            index for index, commit in enumerate(commits) if commit.node in bodies
+        )
+        rewritten = commits[position:]
+        revset = "%s::%s" % (rewritten[0].node, rewritten[-1].node)
+        changesets = {
+            changeset["node"]: changeset
+            for changeset in json.loads(
+                self.hg_out(
+                    ["log", "-r", revset]
+                    + [
+                        "-T",
+                        "json(node, user, date, branch, desc, files, bookmarks, extras)",
+                    ],
+                    split=False,
+                )
+            )
+        }
+        if not all(
+            changesets[commit.node]["files"]
+            and set(changesets[commit.node]["extras"]) <= {"branch"}
+            for commit in rewritten
+        ):
+            return False
+
+        # Children of the rewritten commits which aren't part of the stack.
+        non_stack_children = {}
+        for line in self.hg_out(
+            ["log", "-r", f"children({revset}) - ({revset})", "-T", "{p1node} {node}\n"]
+        ):
+            parent_node, node = line.split()
+            non_stack_children.setdefault(parent_node, []).append(node)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            patches = []
+            for index, commit in enumerate(rewritten):
+                changeset = changesets[commit.node]
+                header = [
+                    "# HG changeset patch",
+                    "# User %s" % changeset["user"],
+                    "# Date %d %d" % tuple(changeset["date"]),
+                ]
+                if changeset["branch"] != "default":
+                    header.append("# Branch %s" % changeset["branch"])
+                body = bodies.get(commit.node, changeset["desc"])
+                path = os.path.join(temp_dir, "%d.patch" % index)
+                with open(path, "wb") as f:
+                    f.write(("\n".join(header + [body, "", ""])).encode("utf-8"))
+                    f.write(
+                        self.hg_out(
+                            ["diff", "--change", commit.node]
+                            + [
+                                arg
+                                for option in EXACT_DIFF_CONFIG
+                                for arg in ("--config", option)
+                            ],
+                            expect_binary=True,
+                        )
+                    )
+                patches.append(path)
+
+            # Each patch is committed on top of the previous one.
+            first_rev = int(self.hg_log("tip", select="rev", split=False)) + 1
+            if position:
+                self.checkout(commits[position - 1].node)
+            else:
+                self.checkout(self._get_parent(commits[0].node) or "null")
+            self.hg(["import", "--bypass", "--quiet"] + patches)
+
+        # The original commits and their descendants are stripped together.
+        self.strip_nodes.append(rewritten[0].node)
+        imported = self.hg_out(["log", "-r", f"{first_rev}:", "-T", "{rev} {node}\n"])
+        for index, (commit, line) in enumerate(zip(rewritten, imported)):
+            rev, node = line.split()
+            original_node = commit.node
+            self._refresh_commit(commit, node, rev)
+            if index:
+                commit.parent = rewritten[index - 1].node
+
+            bookmarks = changesets[original_node]["bookmarks"]
+            if bookmarks:
+                self.hg(["bookmark", "--force", "--rev", node] + bookmarks)
+            for child in non_stack_children.get(original_node, []):
+                self.hg(["rebase", "--source", child, "--dest", node])
+
+        self.revset = "%s::%s" % (commits[0].node, commits[-1].node)
+        return True
+
+    def _amend_commit(self, commit: Commit, commits: List[Commit], updated_body: str):
         # Find our position in the stack.
         parent_node = None
         first_child = None
         is_parent = True
-        for stack_commit in commits:
+        position = 0
+        for index, stack_commit in enumerate(commits):
             if stack_commit.node == commit.node:
                 is_parent = False
+                position = index
             elif is_parent:
                 parent_node = stack_commit.node
             elif not first_child:
@@ -713,8 +938,10 @@ class Mercurial(Repository):
             if first_child:
                 self.rebase_commit(first_child, commit)
 
-        # Ensure our view of the stack is up to date.
-        self.refresh_commit_stack(commits)
+        # Ensure our view of the stack is up to date, only this commit and its
+        # descendants are rewritten.
+        self._refresh_commits(commits[position:])
+        self.revset = "%s::%s" % (commits[0].node, commits[-1].node)
 
         # Commits that aren't part of the stack need to be re-parented.
         for node in non_stack_children:
@@ -849,70 +1076,32 @@ class Mercurial(Repository):
 
         super().check_commits_for_submit(commits, require_bug=require_bug)
 
-    def _get_file_modes(self, commit: Commit) -> dict:
-        """Get modes of the modified files."""
-
-        # build list of modified files
-        # using a -T template here doesn't output all files (eg. source files from
-        # a copy operation are skipped), so we have to parse the default output
-        modified_files = [
-            line[2:].replace("\\", "/")  # strip leading status char and space
-            for line in self.hg_out(["status", "--change", commit.node, "--copies"])
-        ]
-
-        def _to_mode_dict(mode_list):
-            mode_dict = {}
-            for line in mode_list:
-                flag, mode_path = line.split(":", 1)
-                mode_dict[mode_path] = "100755" if flag == "x" else "100644"
-            return mode_dict
+    def set_diff_fingerprints(self, commits: List[Commit]):
+        first, last = commits[0].node, commits[-1].node
+        manifests = {}
+        parents = {}
+        for line in self.hg_out(
+            ["log"]
+            + ["-r", f"{first}::{last} + p1({first})"]
+            + ["-T", "{node} {p1node} {manifest % '{node}'}\n"]
+        ):
+            node, parent, manifest = line.split(" ")
+            manifests[node] = manifest
+            parents[node] = parent
 
-        # get before/after file modes
-        # .arcconfig is added to the file list to try to avoid the situation where
-        # none of the files specified by -I are present in the commit.
-        try:
-            old_modes = _to_mode_dict(
-                self.hg_out(
-                    ["files"]
-                    + ["--rev", commit.parent]
-                    + ["-T", "{flags}:{path}\n"]
-                    + ["-I%s" % f for f in modified_files]
-                    + ["-I.arcconfig"]
+        for commit in commits:
+            if commit.node in manifests:
+                parent = parents[commit.node]
+                commit.fingerprint = self._diff_fingerprint(
+                    manifests.get(parent, parent), manifests[commit.node]
                 )
-            )
-        except CommandError:
-            # Mercurial will return an error if none of the files on the -I list are
-            # valid for the specified revision.  Treat any error here as an empty
-            # result.
-            old_modes = {}
-
-        new_modes = _to_mode_dict(
-            self.hg_out(
-                ["files"]
-                + ["--rev", commit.node]
-                + ["-T", "{flags}:{path}\n"]
-                + ["-I%s" % f for f in modified_files]
-                + ["-I.arcconfig"]
-            )
-        )
-
-        # build response
-        file_modes = {}
-        for path in modified_files:
-            if path in old_modes:
-                file_modes.setdefault(path, {})
-                file_modes[path]["old_mode"] = old_modes[path]
-            if path in new_modes:
-                file_modes.setdefault(path, {})
-                file_modes[path]["new_mode"] = new_modes[path]
-
-        return file_modes
 
     def get_diff(self, commit: Commit) -> Diff:
-        """Create a Diff object containing all changes for this commit."""
-        self.checkout(commit.node)
+        """Create a Diff object containing all changes for this commit.
+
+        The files are read from the store, the working directory is left as is.
+        """
         commit.parent = self._get_parent(commit.node)
-        file_modes = self._get_file_modes(commit)
 
         # Get changed files.
         file_divider = "--%s--" % uuid.uuid4().hex
@@ -974,65 +1163,192 @@ class Mercurial(Repository):
             [{"fn": fn, "kind": "M", "func": self._change_mod} for fn in fn_mods]
         )
 
+        # Read the sizes and modes of all the files, and diff the text files not
+        # needing less context at once.
+        old_files, new_files = {}, {}
+        if changes:
+            # A root commit has no parent, all its files are added.
+            if commit.parent:
+                old_files = self.hg_files(
+                    commit.parent,
+                    [c.get("old_fn", c["fn"]) for c in changes if c["kind"] != "A"],
+                )
+            new_files = self.hg_files(
+                commit.node, [c["fn"] for c in changes if c["kind"] != "D"]
+            )
+        big_files = [
+            fn
+            for fn, info in list(old_files.items()) + list(new_files.items())
+            if info["size"] > environment.MAX_CONTEXT_SIZE
+        ]
+        patches = self._get_patches(commit.node, big_files) if changes else {}
+
         # Create changes.
         diff = Diff()
         for c in changes:
             change = diff.change_for(c["fn"])
             old_fn = c["old_fn"] if "old_fn" in c else c["fn"]
-            c["func"](change, c["fn"], old_fn, commit.parent, commit.node)
-            a_mode = (
-                file_modes[old_fn]["old_mode"]
-                if old_fn in file_modes and "old_mode" in file_modes[old_fn]
-                else "000000"
-            )
-            b_mode = (
-                file_modes[c["fn"]]["new_mode"]
-                if c["fn"] in file_modes and "new_mode" in file_modes[c["fn"]]
-                else "000000"
+            old_file = old_files.get(old_fn, {"size": 0, "mode": "000000"})
+            new_file = new_files.get(c["fn"], {"size": 0, "mode": "000000"})
+            file_size = max(old_file["size"], new_file["size"])
+            patch = patches.get(c["fn"])
+            if patch is None or not self._change_from_patch(
+                change, c["kind"], patch, file_size
+            ):
+                c["func"](change, c["fn"], old_fn, commit.parent, commit.node)
+            diff.set_change_kind(
+                change, c["kind"], old_file["mode"], new_file["mode"], old_fn, c["fn"]
             )
-            diff.set_change_kind(change, c["kind"], a_mode, b_mode, old_fn, c["fn"])
 
         return diff
 
-    @lru_cache(maxsize=None)  # noqa: B019
     def hg_cat(self, filename: str, node: str) -> Optional[bytes]:
-        return self.hg_out(
-            ["cat", "-r", node, filename], split=False, expect_binary=True
-        )
+        key = ("hg-cat", node, filename)
+        body = content_cache.get(key)
+        if body is None:
+            body = self.hg_out(
+                ["cat", "-r", node, filename], split=False, expect_binary=True
+            )
+            content_cache.set(key, body)
+        return body
 
-    @lru_cache(maxsize=None)  # noqa: B019
-    def _file_size(self, filename: str, rev: str) -> int:
-        """Get the file size of the file."""
-        return int(
+    def _spool_file(self, filename: str, node: str) -> SpooledContents:
+        """Write the file to a temporary file instead of reading it."""
+
+        def write(path: str):
+            # `hg cat --output` takes a format string.
+            output = path.replace("%", "%%")
             self.hg_out(
-                [
-                    "files",
-                    "-v",
-                    "-r",
-                    rev,
-                    os.path.join(self.path, filename),
-                    "-T",
-                    "{size}",
-                ],
+                ["cat", "-r", node, "--output", output, filename],
+                expect_binary=True,
                 split=False,
             )
+
+        return SpooledContents(write)
+
+    def hg_files(self, rev: str, filenames: List[str]) -> Dict[str, dict]:
+        """Get the size and mode of the files in the revision.
+
+        The files are read from the manifest with a single call. They're listed
+        in a file, which keeps the command short however many files there are.
+        """
+        if not filenames:
+            return {}
+
+        patterns = "".join("path:%s\0" % fn for fn in filenames)
+        try:
+            with temporary_file(patterns) as patterns_file:
+                lines = self.hg_out(
+                    ["files", "-r", rev, "-T", "{size}\t{flags}\t{path}\n"]
+                    + ["listfile0:%s" % patterns_file]
+                )
+        except CommandError as e:
+            # `hg files` exits with 1 if none of the files are found.
+            if e.status != 1:
+                raise
+            lines = []
+
+        files = {}
+        for line in lines:
+            size, flags, path = line.split("\t", 2)
+            files[path] = {
+                "size": int(size),
+                "mode": "100755" if "x" in flags else "100644",
+            }
+            self._file_sizes[(rev, path)] = files[path]["size"]
+
+        return files
+
+    def _get_patches(self, node: str, exclude: List[str]) -> Dict[str, bytes]:
+        """Diff all the files changed in the commit, except `exclude`, at once.
+
+        Binary files are only reported as changed.
+        """
+        if self.args.lesscontext:
+            context_size = 100
+        else:
+            context_size = environment.MAX_CONTEXT_SIZE
+
+        git_diff = self.hg_out(
+            ["diff", "--git", "--config", "diff.nobinary=true"]
+            + ["--unified", str(context_size)]
+            + ["-c", node]
+            + [arg for fn in exclude for arg in ("-X", "path:%s" % fn)],
+            expect_binary=True,
         )
+        return split_patches(git_diff)
+
+    def _change_from_patch(
+        self, change: Diff.Change, kind: str, patch: bytes, file_size: int
+    ) -> bool:
+        """Create the hunks of a text file from its patch.
+
+        Returns `False` if the contents of the file are needed instead: for
+        binaries, and for changes without hunks to show the file with.
+        """
+        if PATCH_BINARY.search(patch.split(b"\n@@", 1)[0]):
+            return False
+
+        try:
+            if kind in ("A", "D"):
+                # Show the whole file the same way as when reading its contents.
+                if file_size:
+                    if b"\n@@" not in patch:
+                        return False
+
+                    body = patch_body(patch.decode("utf-8"))
+                    if kind == "A":
+                        self._add_hunk(change, body)
+                    else:
+                        self._del_hunk(change, body)
+            else:
+                change.from_git_diff(patch)
+                if file_size and not change.hunks:
+                    return False
+        except UnicodeDecodeError:
+            return False
+
+        telemetry().submission.files_size.accumulate(file_size)
+        return True
+
+    def _file_size(self, filename: str, rev: str) -> int:
+        """Get the file size of the file."""
+        if (rev, filename) not in self._file_sizes:
+            self._file_sizes[(rev, filename)] = int(
+                self.hg_out(
+                    [
+                        "files",
+                        "-v",
+                        "-r",
+                        rev,
+                        os.path.join(self.path, filename),
+                        "-T",
+                        "{size}",
+                    ],
+                    split=False,
+                )
+            )
+
+        return self._file_sizes[(rev, filename)]
 
-    @lru_cache(maxsize=128)  # noqa: B019
     def _get_file_meta(self, filename: str, rev: str) -> dict:
-        """Collect information about the file."""
-        binary = False
-        body = self.hg_cat(filename, rev)
-        meta = {"mime": "TEXT", "bin_body": body}
+        """Collect information about the file.
 
+        Files too big to be shown as text are binary from their size alone, they
+        are written to a temporary file for the upload instead of being read.
+        Others are binary if they contain a NUL byte, only the text files are
+        decoded.
+        """
+        meta = {"mime": "TEXT", "key": f"{rev}:{filename}"}
         meta["file_size"] = self._file_size(filename, rev)
         if meta["file_size"] > environment.MAX_TEXT_SIZE:
+            body = self._spool_file(filename, rev)
             binary = True
+        else:
+            body = self.hg_cat(filename, rev)
+            binary = b"\0" in body
 
-        if not binary:
-            if b"\0" in body:
-                binary = True
-
+        meta["bin_body"] = body
         if not binary:
             try:
                 body = str(body, "utf-8")
@@ -1043,7 +1359,7 @@ class Mercurial(Repository):
         meta["binary"] = binary
 
         if binary:
-            meta["mime"] = mimetypes.guess_type(filename)[0] or ""
+            meta["mime"] = guess_mime_type(filename, body)
 
         return meta
 
@@ -1065,6 +1381,7 @@ class Mercurial(Repository):
                 a_mime="",
                 b_body=meta["bin_body"],
                 b_mime=meta["mime"],
+                b_key=meta["key"],
             )
             return
 
@@ -1072,18 +1389,19 @@ class Mercurial(Repository):
         if meta["file_size"] == 0:
             return
 
-        lines, eof_missing_newline = create_hunk_lines(meta["body"], "+")
-        new_len = len(lines)
-        if eof_missing_newline:
-            new_len -= 1
+        self._add_hunk(change, meta["body"])
 
-        change.hunks.append(
+    @staticmethod
+    def _add_hunk(change: Diff.Change, body: str):
+        """Add the hunk showing the whole `body` as added."""
+        corpus, line_count, _ = create_hunk_corpus(body, "+")
+        change.add_hunk(
             Diff.Hunk(
                 old_off=0,
                 new_off=1,
                 old_len=0,
-                new_len=new_len,
-                lines=lines,
+                new_len=line_count,
+                buffer=corpus,
             )
         )
 
@@ -1105,6 +1423,7 @@ class Mercurial(Repository):
                 a_mime=meta["mime"],
                 b_body="",
                 b_mime="",
+                a_key=meta["key"],
             )
             return
 
@@ -1112,16 +1431,22 @@ class Mercurial(Repository):
         if meta["file_size"] == 0:
             return
 
-        lines = create_hunk_lines(meta["body"], "-")[0]
-        old_len = len(lines)
+        self._del_hunk(change, meta["body"])
+
+    @staticmethod
+    def _del_hunk(change: Diff.Change, body: str):
+        """Add the hunk showing the whole `body` as removed."""
+        corpus, line_count, eof_missing_newline = create_hunk_corpus(body, "-")
+        # The line noting the missing newline at the end of the file is counted.
+        old_len = line_count + 1 if eof_missing_newline else line_count
 
-        change.hunks.append(
+        change.add_hunk(
             Diff.Hunk(
                 old_off=1,
                 new_off=0,
                 old_len=old_len,
                 new_len=0,
-                lines=lines,
+                buffer=corpus,
             )
         )
 
@@ -1146,6 +1471,8 @@ class Mercurial(Repository):
                 a_mime=a_meta["mime"],
                 b_body=b_meta["bin_body"],
                 b_mime=b_meta["mime"],
+                a_key=a_meta["key"],
+                b_key=b_meta["key"],
             )
             return
 
@@ -1155,14 +1482,16 @@ class Mercurial(Repository):
 
         if a_meta["body"] == b_meta["body"]:
             # File contents unchanged.
-            lines = create_hunk_lines(a_meta["body"], " ", check_eof=False)[0]
-            change.hunks.append(
+            corpus, line_count, _ = create_hunk_corpus(
+                a_meta["body"], " ", check_eof=False
+            )
+            change.add_hunk(
                 Diff.Hunk(
                     old_off=1,
                     new_off=1,
-                    old_len=len(lines),
-                    new_len=len(lines),
-                    lines=lines,
+                    old_len=line_count,
+                    new_len=line_count,
+                    buffer=corpus,
                 )
             )
             return
@@ -1183,10 +1512,12 @@ class Mercurial(Repository):
                 str(context_size),
                 "--rev",
                 parent,
+                "--rev",
+                node,
                 filename,
             ],
             expect_binary=True,
-        ).decode("utf-8")
+        )
         change.from_git_diff(git_diff)
 
         if file_size > environment.MAX_CONTEXT_SIZE / 2:
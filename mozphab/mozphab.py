@@ -30,6 +30,7 @@ from .exceptions import Error
 from .logger import init_logging, logger, stop_logging
 from .repository import Repository
 from .sentry import init_sentry, report_to_sentry
+from .simplecache import cache, content_cache, persistent_cache_path
 from .spinner import wait_message
 from .telemetry import configure_telemetry, telemetry
 from .updater import (
@@ -121,6 +122,8 @@ def main(argv: List[str], *, is_development: bool):
                 repo = repo_from_args(args)
 
             conduit.set_repo(repo)
+            if not args.no_cache:
+                cache.enable_persistence(persistent_cache_path(repo.api_url))
 
         if not is_development:
             configure_telemetry(args)
@@ -133,6 +136,8 @@ def main(argv: List[str], *, is_development: bool):
                 args.func(repo, args)
             finally:
                 repo.cleanup()
+                cache.save()
+                content_cache.log_stats()
 
         else:
             args.func(args)
@@ -2,6 +2,7 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import hashlib
 import json
 import os
 import urllib.parse
@@ -24,6 +25,9 @@ from .helpers import (
 from .logger import logger
 from .spinner import wait_message
 
+# Bump when a change to the diff creation alters the diffs of unchanged commits.
+DIFF_FINGERPRINT_VERSION = "1"
+
 MOZILLA_DOMAINS = {
     ".mozilla.org",
     ".mozilla.com",
@@ -152,6 +156,24 @@ class Repository(object):
     def get_diff(self, commit: Commit) -> Diff:
         """Create a Diff object with changes."""
 
+    def set_diff_fingerprints(self, commits: List[Commit]):
+        """Set the `fingerprint` of the commits.
+
+        Commits with the same fingerprint have the same diff, whatever their
+        description or SHA1. The fingerprint isn't set if it can't be computed.
+        """
+
+    def _diff_fingerprint(self, parent_tree: str, tree: str) -> str:
+        """Hash the trees a diff is created from along with the diff settings."""
+        parts = [
+            DIFF_FINGERPRINT_VERSION,
+            self.vcs,
+            str(bool(self.args.lesscontext)),
+            parent_tree,
+            tree,
+        ]
+        return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
     def refresh_commit_stack(self, commits):
         """Update the stack following an altering change (eg rebase)."""
 
@@ -407,5 +429,11 @@ class Repository(object):
         """Hashtag in a remote VCS."""
         return node
 
+    def load_public_nodes(self, nodes: List[str]):
+        """Look up the hashtags of all the `nodes` in the remote VCS at once.
+
+        `get_public_node` answers from the results afterwards.
+        """
+
     def validate_email(self):
         """Validate a user's configured email address."""
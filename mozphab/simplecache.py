@@ -2,30 +2,269 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-from typing import Any
+import json
+import os
+import re
+import tempfile
+import time
+import urllib.parse as url_parse
+from collections import OrderedDict
+from pathlib import Path
+from typing import (
+    Any,
+    Dict,
+    Hashable,
+    Optional,
+    Set,
+)
+
+from .environment import MOZBUILD_PATH
+from .logger import logger
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+
+# Keys stored on disk between runs, matched by prefix, with the number of seconds
+# they stay valid. Keys without a match (like the API token) are never written.
+PERSISTENT_KEYS = (
+    # Revision ID to PHID mapping never changes.
+    ("rev-id-", 30 * DAY),
+    # Revisions are revalidated with their `dateModified` before use.
+    ("rev-phid-", 7 * DAY),
+    ("user-", 4 * HOUR),
+    ("phid-user-", 4 * HOUR),
+    ("group-", 12 * HOUR),
+    ("whoami", 7 * DAY),
+    # Content hash to the PHID of the file uploaded with it, revalidated before
+    # use as the file may have been deleted.
+    ("file-", 30 * DAY),
+)
+REVALIDATED_KEYS = ("rev-phid-", "file-")
+
+# Least recently used entries are evicted above this number of entries.
+PERSISTENT_MAX_ENTRIES = 5000
+
+# Least recently used file contents are evicted above this number of bytes.
+CONTENT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+
+def _ttl(key: str) -> Optional[int]:
+    for prefix, ttl in PERSISTENT_KEYS:
+        if key.startswith(prefix):
+            return ttl
+    return None
+
+
+def persistent_cache_path(api_url: str) -> Path:
+    """Return the path of the cache file for the Phabricator instance."""
+    host = re.sub(r"[^\w.-]", "_", url_parse.urlsplit(api_url).netloc)
+    return Path(MOZBUILD_PATH) / "cache" / f"{host}.json"
 
 
 class SimpleCache:
-    """Simple key/value store with all lowercase keys."""
+    """Simple key/value store with all lowercase keys.
+
+    Selected keys can be persisted in a JSON file with `enable_persistence`.
+    """
 
     def __init__(self):
         self._cache = {}
+        self._path = None
+        # Persisted keys updated (or deleted) in this process.
+        self._dirty: Set[str] = set()
+        # Keys loaded from the disk and their last access time.
+        self._accessed: Dict[str, float] = {}
+        # Keys loaded from the disk which need to be revalidated before use.
+        self._stale: Set[str] = set()
 
     def __contains__(self, key: str) -> bool:
         return key.lower() in self._cache
 
     def get(self, key: str) -> Any:
-        return self._cache.get(key.lower())
+        key = key.lower()
+        if key in self._accessed:
+            self._accessed[key] = time.time()
+        return self._cache.get(key)
 
     def set(self, key: str, value: Any):
-        self._cache[key.lower()] = value
+        key = key.lower()
+        self._cache[key] = value
+        self._stale.discard(key)
+        if self._path and _ttl(key):
+            self._dirty.add(key)
 
     def delete(self, key: str):
         if key in self:
-            del self._cache[key.lower()]
+            key = key.lower()
+            del self._cache[key]
+            self._stale.discard(key)
+            if self._path and _ttl(key):
+                self._dirty.add(key)
 
     def reset(self):
         self._cache = {}
+        self._path = None
+        self._dirty = set()
+        self._accessed = {}
+        self._stale = set()
+
+    def needs_revalidation(self, key: str) -> bool:
+        """Return `True` if the value was loaded from the disk and may be outdated."""
+        return key.lower() in self._stale
+
+    def enable_persistence(self, path: Path):
+        """Load the persisted entries from `path` and save updates there."""
+        self._path = Path(path)
+        now = time.time()
+        for key, entry in self._read().items():
+            if key in self._cache or now - entry["stored"] > (_ttl(key) or 0):
+                continue
+
+            self._cache[key] = entry["value"]
+            self._accessed[key] = entry["accessed"]
+            if key.startswith(REVALIDATED_KEYS):
+                self._stale.add(key)
+
+        logger.debug("Loaded %s cache entries from %s", len(self._accessed), path)
+
+    def save(self):
+        """Write the persisted entries updated in this process.
+
+        Entries written by other processes since we loaded the file are kept, the
+        file is replaced atomically.
+        """
+        if not self._path or not (self._dirty or self._accessed):
+            return
+
+        now = time.time()
+        entries = self._read()
+        for key in self._dirty:
+            if key in self._cache:
+                entries[key] = {
+                    "value": self._cache[key],
+                    "stored": now,
+                    "accessed": now,
+                }
+            else:
+                entries.pop(key, None)
+
+        for key, accessed in self._accessed.items():
+            if key in entries and key not in self._dirty:
+                entries[key]["accessed"] = max(accessed, entries[key]["accessed"])
+
+        entries = {
+            key: entry
+            for key, entry in entries.items()
+            if now - entry["stored"] <= (_ttl(key) or 0)
+        }
+        if len(entries) > PERSISTENT_MAX_ENTRIES:
+            keys = sorted(entries, key=lambda k: entries[k]["accessed"])
+            for key in keys[: len(entries) - PERSISTENT_MAX_ENTRIES]:
+                del entries[key]
+
+        temp_name = None
+        try:
+            self._path.parent.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                "w",
+                encoding="utf-8",
+                dir=self._path.parent,
+                prefix=self._path.name,
+                delete=False,
+            ) as f:
+                temp_name = f.name
+                json.dump(entries, f, separators=(",", ":"))
+            os.replace(temp_name, self._path)
+        except (OSError, TypeError, ValueError) as e:
+            logger.debug("Failed to save the cache to %s: %s", self._path, e)
+            if temp_name and os.path.exists(temp_name):
+                os.remove(temp_name)
+            return
+
+        self._dirty = set()
+
+    def _read(self) -> Dict[str, dict]:
+        try:
+            with self._path.open(encoding="utf-8") as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.debug("Ignoring the cache file %s: %s", self._path, e)
+            return {}
+
+        return entries if isinstance(entries, dict) else {}
+
+
+class ContentCache:
+    """In memory cache of file contents, bounded by their total size.
+
+    The contents are identified by a key built by the repository, like a blob ID
+    or a node and path. The least recently used contents are evicted first.
+    """
+
+    def __init__(self, max_bytes: int = CONTENT_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._sizes: Dict[Hashable, int] = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def get(self, key: Hashable) -> Any:
+        """Return the contents stored with `key`, or `None`."""
+        if key not in self._entries:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def set(self, key: Hashable, value: Any, size: Optional[int] = None):
+        """Store `value`, of `size` bytes (its length by default)."""
+        self.delete(key)
+        size = len(value) if size is None else size
+        if size > self.max_bytes:
+            return
+
+        self._entries[key] = value
+        self._sizes[key] = size
+        self.size += size
+        while self.size > self.max_bytes:
+            evicted, _value = self._entries.popitem(last=False)
+            self.size -= self._sizes.pop(evicted)
+            self.evictions += 1
+
+    def delete(self, key: Hashable):
+        if key in self._entries:
+            del self._entries[key]
+            self.size -= self._sizes.pop(key)
+
+    def clear(self):
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def log_stats(self):
+        if self.hits or self.misses:
+            logger.debug(
+                "Content cache: %s hits, %s misses, %s evictions, %s bytes in %s "
+                "entries",
+                self.hits,
+                self.misses,
+                self.evictions,
+                self.size,
+                len(self._entries),
+            )
 
 
 cache = SimpleCache()
+content_cache = ContentCache()
@@ -0,0 +1,333 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Pooled keep-alive HTTP(S) transport shared by the Conduit and BMO clients.
+
+`urllib.request.urlopen` opens (and TLS handshakes) a new connection for every
+request. A single `submit` issues dozens of Conduit calls, so we keep idle
+connections around and reuse them for subsequent requests to the same host.
+"""
+
+import base64
+import http.client
+import io
+import select
+import ssl
+import threading
+import urllib.error as url_error
+import urllib.parse as url_parse
+import urllib.request as url_request
+from collections import defaultdict
+from typing import (
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from .logger import logger
+
+# Maximum number of simultaneous connections to a single host. Requests made
+# when all connections are busy wait for one to be released.
+MAX_CONNECTIONS_PER_HOST = 5
+
+MAX_REDIRECTS = 5
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+# Requests which may be sent again when a keep-alive connection was closed by the
+# server after they were sent, as they have the same effect if received twice.
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE", "TRACE")
+
+# Errors raised when the server has closed an idle keep-alive connection.
+STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.BadStatusLine,
+    ConnectionResetError,
+    ConnectionAbortedError,
+    BrokenPipeError,
+)
+
+# (scheme, host, port, proxy)
+PoolKey = Tuple[str, str, int, Optional[str]]
+
+# Request body, `bytes` or a sized iterable of `bytes` chunks.
+Body = Union[bytes, Iterable[bytes]]
+
+
+class PooledResponse(io.BytesIO):
+    """Fully read HTTP response, mimicking the object returned by `urlopen`."""
+
+    def __init__(self, url: str, status: int, reason: str, headers, body: bytes):
+        super().__init__(body)
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+
+    def getcode(self) -> int:
+        return self.status
+
+    def geturl(self) -> str:
+        return self.url
+
+    def info(self):
+        return self.headers
+
+
+class HTTPConnectionPool:
+    """Thread-safe pool of keep-alive connections, bounded per host."""
+
+    def __init__(
+        self,
+        maxsize: int = MAX_CONNECTIONS_PER_HOST,
+        timeout: Optional[float] = None,
+    ):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.connections_created = 0
+        self.requests_made = 0
+        self._lock = threading.Lock()
+        self._idle: Dict[PoolKey, List[http.client.HTTPConnection]] = defaultdict(list)
+        self._slots: Dict[PoolKey, threading.BoundedSemaphore] = {}
+        self._ssl_context = None
+
+    def urlopen(
+        self, request: url_request.Request, replayable: bool = False
+    ) -> PooledResponse:
+        """Send the `Request` and return the response.
+
+        Behaves like `urllib.request.urlopen`: redirects are followed,
+        `HTTPError` is raised for error responses and `URLError` for network
+        failures.
+
+        The request data may be `bytes`, or an object with a length yielding
+        the body in `bytes` chunks each time it is iterated. It is then written
+        to the connection chunk by chunk.
+
+        If a reused connection turns out to be closed once the request is sent,
+        the request is only sent again on a new connection if its method is
+        idempotent, or if the caller knows it's `replayable`.
+        """
+        url = request.full_url
+        method = request.get_method()
+        body = request.data
+        headers = dict(request.header_items())
+
+        for _redirect in range(MAX_REDIRECTS + 1):
+            status, reason, response_headers, content = self._request(
+                method, url, body, headers, replayable or method in IDEMPOTENT_METHODS
+            )
+            if status not in REDIRECT_CODES or "Location" not in response_headers:
+                break
+
+            url = url_parse.urljoin(url, response_headers["Location"])
+            if status == 303 or (status in (301, 302) and method != "HEAD"):
+                method = "GET"
+                body = None
+                headers = {
+                    k: v
+                    for k, v in headers.items()
+                    if k.lower() not in ("content-length", "content-type")
+                }
+        else:
+            raise url_error.HTTPError(
+                url, status, "Too many redirects", response_headers, None
+            )
+
+        if not 200 <= status < 300:
+            raise url_error.HTTPError(
+                url, status, reason, response_headers, io.BytesIO(content)
+            )
+
+        return PooledResponse(url, status, reason, response_headers, content)
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle = [conn for conns in self._idle.values() for conn in conns]
+            self._idle.clear()
+        for conn in idle:
+            conn.close()
+
+    def _request(
+        self,
+        method: str,
+        url: str,
+        body: Optional[Body],
+        headers: dict,
+        replayable: bool,
+    ) -> Tuple[int, str, http.client.HTTPMessage, bytes]:
+        parsed = url_parse.urlsplit(url)
+        if parsed.scheme not in ("http", "https"):
+            raise url_error.URLError(f"unknown url type: {parsed.scheme}")
+
+        proxy = self._get_proxy(parsed)
+        key = (parsed.scheme, parsed.hostname or "", self._port(parsed), proxy)
+        if proxy and parsed.scheme == "http":
+            # Plain HTTP proxies expect the absolute URL as the request target.
+            target = url
+        else:
+            target = url_parse.urlunsplit(
+                ("", "", parsed.path or "/", parsed.query, "")
+            )
+
+        headers = {"Host": parsed.netloc, **headers}
+        if proxy and parsed.scheme == "http":
+            headers.update(self._proxy_headers(proxy))
+        if body is not None:
+            # `urlopen` adds these when the request carries data.
+            present = {k.lower() for k in headers}
+            if "content-type" not in present:
+                headers["Content-Type"] = "application/x-www-form-urlencoded"
+            if "content-length" not in present:
+                headers["Content-Length"] = str(len(body))
+
+        slot = self._get_slot(key)
+        with slot:
+            conn, reused = self._get_connection(key)
+            try:
+                sent = False
+                try:
+                    self._send(conn, method, target, body, headers)
+                    sent = True
+                    response = conn.getresponse()
+                except STALE_CONNECTION_ERRORS:
+                    # The server dropped the idle connection. If it failed once
+                    # the request was sent, the server may have received it.
+                    if not reused or (sent and not replayable):
+                        raise
+                    logger.debug("Stale connection to %s, reconnecting", key[1])
+                    conn.close()
+                    conn, reused = self._new_connection(key), False
+                    self._send(conn, method, target, body, headers)
+                    response = conn.getresponse()
+
+                content = response.read()
+            except (OSError, http.client.HTTPException) as err:
+                conn.close()
+                if isinstance(err, url_error.URLError):
+                    raise
+                raise url_error.URLError(err)
+
+            if response.will_close:
+                conn.close()
+            else:
+                self._release_connection(key, conn)
+
+        return response.status, response.reason, response.headers, content
+
+    def _send(
+        self,
+        conn: http.client.HTTPConnection,
+        method: str,
+        target: str,
+        body: Optional[Body],
+        headers: dict,
+    ):
+        conn.request(method, target, body=body, headers=headers)
+        with self._lock:
+            self.requests_made += 1
+
+    def _get_slot(self, key: PoolKey) -> threading.BoundedSemaphore:
+        with self._lock:
+            if key not in self._slots:
+                self._slots[key] = threading.BoundedSemaphore(self.maxsize)
+            return self._slots[key]
+
+    def _get_connection(self, key: PoolKey) -> Tuple[http.client.HTTPConnection, bool]:
+        """Return an idle connection for the `key` or open a new one.
+
+        Idle connections already closed by the server are discarded.
+        """
+        with self._lock:
+            idle = self._idle[key]
+            while idle:
+                conn = idle.pop()
+                if not self._is_dropped(conn):
+                    return conn, True
+                logger.debug("Idle connection to %s was closed", key[1])
+                conn.close()
+        return self._new_connection(key), False
+
+    def _release_connection(self, key: PoolKey, conn: http.client.HTTPConnection):
+        with self._lock:
+            self._idle[key].append(conn)
+
+    def _new_connection(self, key: PoolKey) -> http.client.HTTPConnection:
+        scheme, host, port, proxy = key
+        kwargs = {}
+        if self.timeout is not None:
+            kwargs["timeout"] = self.timeout
+
+        if proxy:
+            proxy_url = url_parse.urlsplit(proxy)
+            connect_host = proxy_url.hostname
+            connect_port = proxy_url.port
+        else:
+            connect_host, connect_port = host, port
+
+        if scheme == "https":
+            if self._ssl_context is None:
+                self._ssl_context = ssl.create_default_context()
+            conn = http.client.HTTPSConnection(
+                connect_host, connect_port, context=self._ssl_context, **kwargs
+            )
+            if proxy:
+                conn.set_tunnel(host, port, headers=self._proxy_headers(proxy))
+        else:
+            conn = http.client.HTTPConnection(connect_host, connect_port, **kwargs)
+
+        with self._lock:
+            self.connections_created += 1
+        logger.debug("Opening new connection to %s:%s", host, port)
+        return conn
+
+    @staticmethod
+    def _is_dropped(conn: http.client.HTTPConnection) -> bool:
+        """Return `True` if the server has closed the idle connection.
+
+        Nothing is expected from the server between requests, so a readable
+        socket means it was closed (or is in an unknown state).
+        """
+        if conn.sock is None:
+            return False
+        try:
+            readable, _, _ = select.select([conn.sock], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        return bool(readable)
+
+    @staticmethod
+    def _proxy_headers(proxy: str) -> Dict[str, str]:
+        """Return the headers authenticating with the credentials in `proxy`."""
+        proxy_url = url_parse.urlsplit(proxy)
+        if proxy_url.username is None or proxy_url.password is None:
+            return {}
+        credentials = "%s:%s" % (
+            url_parse.unquote(proxy_url.username),
+            url_parse.unquote(proxy_url.password),
+        )
+        token = base64.b64encode(credentials.encode()).decode("ascii")
+        return {"Proxy-Authorization": f"Basic {token}"}
+
+    @staticmethod
+    def _port(parsed: url_parse.SplitResult) -> int:
+        if parsed.port:
+            return parsed.port
+        return 443 if parsed.scheme == "https" else 80
+
+    @staticmethod
+    def _get_proxy(parsed: url_parse.SplitResult) -> Optional[str]:
+        """Return the proxy URL configured in the environment for the host."""
+        proxy = url_request.getproxies().get(parsed.scheme)
+        if not proxy or url_request.proxy_bypass(parsed.hostname or ""):
+            return None
+        if "://" not in proxy:
+            proxy = f"http://{proxy}"
+        return proxy
+
+
+http_pool = HTTPConnectionPool()
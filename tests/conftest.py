@@ -126,6 +126,7 @@ def init_sha(in_process, git_repo_path, git_sha):
 @pytest.fixture(autouse=True)
 def reset_cache():
     simplecache.cache.reset()
+    simplecache.content_cache.clear()
 
 
 @pytest.fixture()
@@ -336,6 +337,8 @@ def in_process(monkeypatch, safe_environ, request, config):
     # Disable update checking.  It modifies the program on disk which we do /not/ want
     # to do during a test run.
     monkeypatch.setattr(mozphab, "check_for_updates", mock.Mock(return_value=None))
+    # Don't load or save the persistent cache in the user's `.mozbuild`.
+    monkeypatch.setattr(simplecache.cache, "enable_persistence", mock.Mock())
 
     # Disable calls to sys.exit() at the end of the script.  Re-raise errors instead
     # to make test debugging easier.
@@ -52,7 +52,7 @@ def test_sanitised_req():
     }
 
 
-@mock.patch("urllib.request.urlopen")
+@mock.patch("mozphab.transport.HTTPConnectionPool.urlopen")
 @mock.patch("mozphab.bmo.conduit")
 def test_get(m_conduit, m_urlopen):
     m_conduit.repo.bmo_url = "https://bmo.test"
@@ -3,16 +3,20 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import base64
+import hashlib
 import json
+import urllib.parse as url_parse
 from contextlib import contextmanager
+from pathlib import Path
 from unittest import mock
 
 import pytest
 from immutabledict import immutabledict
 
-from mozphab import exceptions, mozphab, repository, simplecache
+from mozphab import exceptions, helpers, mozphab, repository, simplecache
 from mozphab.commits import Commit
-from mozphab.conduit import ConduitAPIError, conduit
+from mozphab.conduit import ConduitAPIError, ConduitRequestBody, conduit
 from mozphab.diff import Diff
 from tests.conftest import search_rev
 
@@ -48,8 +52,13 @@ def test_build_request(m_load_api_token):
     m_load_api_token.return_value = "saved-token"
     mozphab.conduit.set_repo(Repo())
 
+    def build_request(**kwargs):
+        request = mozphab.conduit._build_request(**kwargs)
+        assert len(request["data"]) == len(b"".join(request["data"]))
+        return {**request, "data": b"".join(request["data"])}
+
     # default token
-    assert mozphab.conduit._build_request(
+    assert build_request(
         method="method",
         args={"call": "args"},
         token=None,
@@ -68,7 +77,7 @@ def test_build_request(m_load_api_token):
     }
 
     # provided token
-    assert mozphab.conduit._build_request(
+    assert build_request(
         method="method",
         args={"call": "args"},
         token="my-token",
@@ -87,7 +96,7 @@ def test_build_request(m_load_api_token):
     }
 
     # unicode
-    assert mozphab.conduit._build_request(
+    assert build_request(
         method="method",
         args={"call": "ćwikła"},
         token=None,
@@ -106,7 +115,7 @@ def test_build_request(m_load_api_token):
     }
 
     # empty dict, empty list
-    assert mozphab.conduit._build_request(
+    assert build_request(
         method="method",
         args={"empty_dict": {}, "empty_list": []},
         token=None,
@@ -125,7 +134,36 @@ def test_build_request(m_load_api_token):
     }
 
 
-@mock.patch("urllib.request.urlopen")
+@mock.patch("mozphab.conduit.REQUEST_BODY_CHUNK_SIZE", 16)
+def test_conduit_request_body():
+    params = {
+        "changes": [
+            {
+                "hunks": [{"corpus": '+ą b\\n\t"%&=+~\n' * 10, "addLines": 10}],
+                "oldPath": None,
+                "metadata": {},
+            }
+        ],
+        "__conduit__": {"token": "token"},
+    }
+    expected = url_parse.urlencode(
+        {
+            "params": json.dumps(params, separators=(",", ":")),
+            "output": "json",
+            "__conduit__": True,
+        }
+    ).encode()
+
+    body = ConduitRequestBody(params)
+    chunks = list(body)
+    assert len(chunks) > 1
+    assert b"".join(chunks) == expected
+    assert len(body) == len(expected)
+    # The body is encoded again when it is resent.
+    assert b"".join(body) == expected
+
+
+@mock.patch("mozphab.transport.HTTPConnectionPool.urlopen")
 @mock.patch("mozphab.conduit.ConduitAPI.load_api_token")
 def test_call(m_load_api_token, m_urlopen):
     m_load_api_token.return_value = "token"
@@ -141,6 +179,13 @@ def test_call(m_load_api_token, m_urlopen):
     cm.read.return_value = json.dumps({"result": "result", "error_code": False})
     assert mozphab.conduit.call("method", {"call": "args"}) == "result"
 
+    # Only the requests of methods reading data are sent again on a new connection.
+    assert m_urlopen.call_args.kwargs == {"replayable": False}
+    mozphab.conduit.call("differential.revision.search", {})
+    assert m_urlopen.call_args.kwargs == {"replayable": True}
+    mozphab.conduit.call("differential.revision.edit", {})
+    assert m_urlopen.call_args.kwargs == {"replayable": False}
+
     # error
     cm.read.return_value = json.dumps({"error_info": "aieee", "error_code": 1})
     with pytest.raises(ConduitAPIError) as conduit_error:
@@ -387,35 +432,157 @@ def test_get_diffs_search_by_diffids_missing(get_diffs, m_call):
     assert not diff_dict.get("PHID-4"), "Should not return dict of non-existent diff"
 
 
+def test_search_pages_follows_cursor(m_call):
+    m_call.side_effect = [
+        {"data": [1, 2], "cursor": {"after": "2"}},
+        {"data": [3], "cursor": {"after": None}},
+    ]
+    args = {"constraints": {"ids": [1, 2, 3]}}
+    pages = list(mozphab.conduit.search_pages("x.search", args))
+    assert [page["data"] for page in pages] == [[1, 2], [3]]
+    assert m_call.call_args_list == [
+        mock.call("x.search", args),
+        mock.call("x.search", {"constraints": {"ids": [1, 2, 3]}, "after": "2"}),
+    ]
+
+
+@mock.patch("mozphab.conduit.SEARCH_CHUNK_SIZE", 2)
+def test_search_pages_chunks(m_call):
+    def call(method, args):
+        ids = args["constraints"]["ids"]
+        if ids == [1, 2] and "after" not in args:
+            return {"data": [1], "cursor": {"after": "1"}}
+        return {"data": [i for i in ids if i > int(args.get("after", 0))]}
+
+    m_call.side_effect = call
+    args = {"constraints": {"ids": [1, 2, 3, 4, 5]}, "attachments": {}}
+    pages = list(mozphab.conduit.search_pages("x.search", args, chunk_by="ids"))
+    assert [page["data"] for page in pages] == [[1], [2], [3, 4], [5]]
+    assert m_call.call_count == 4
+    m_call.assert_any_call("x.search", {"constraints": {"ids": [5]}, "attachments": {}})
+
+    # Constraints within the limit are passed unchanged.
+    m_call.reset_mock()
+    m_call.side_effect = None
+    m_call.return_value = {"data": [1, 2]}
+    args = {"constraints": {"ids": [1, 2]}}
+    assert len(list(mozphab.conduit.search_pages("x.search", args, chunk_by="ids")))
+    m_call.assert_called_once_with("x.search", args)
+
+
+def test_get_revisions_revalidates_persisted(get_revs, m_call, tmp_path):
+    def rev(modified, title):
+        return {
+            "id": 1,
+            "phid": "PHID-1",
+            "fields": {"dateModified": modified, "title": title},
+        }
+
+    cache_path = tmp_path / "cache.json"
+    simplecache.cache.enable_persistence(cache_path)
+    m_call.return_value = {"data": [rev(10, "old")]}
+    get_revs(ids=[1])
+    simplecache.cache.save()
+
+    # Unmodified revision, served from the cache after revalidation.
+    simplecache.cache.reset()
+    simplecache.cache.enable_persistence(cache_path)
+    m_call.reset_mock()
+    m_call.return_value = {"data": []}
+    assert get_revs(ids=[1]) == [rev(10, "old")]
+    m_call.assert_called_once_with(
+        "differential.revision.search",
+        {
+            "constraints": {"phids": ["PHID-1"], "modifiedStart": 10},
+            "attachments": {"reviewers": True},
+        },
+    )
+    assert get_revs(phids=["PHID-1"]) == [rev(10, "old")]
+    m_call.assert_called_once()
+
+    # Modified revision is replaced.
+    simplecache.cache.reset()
+    simplecache.cache.enable_persistence(cache_path)
+    m_call.return_value = {"data": [rev(20, "new")]}
+    assert get_revs(phids=["PHID-1"]) == [rev(20, "new")]
+
+
+@mock.patch("mozphab.conduit.SEARCH_CHUNK_SIZE", 2)
+def test_get_revisions_chunks(get_revs, m_call):
+    def call(method, args):
+        return {
+            "data": [
+                {"id": i, "phid": "PHID-%s" % i} for i in args["constraints"]["ids"]
+            ]
+        }
+
+    m_call.side_effect = call
+    assert [r["id"] for r in get_revs(ids=[5, 4, 3, 2, 1])] == [5, 4, 3, 2, 1]
+    assert m_call.call_count == 3
+
+
 @mock.patch("mozphab.conduit.ConduitAPI.call")
 def test_get_related_phids(m_call):
     get_related_phids = mozphab.conduit.get_related_phids
 
-    m_call.return_value = {}
-    assert [] == get_related_phids("aaa", include_abandoned=True)
+    def rev(phid, stack_graph, status="needs-review"):
+        return {
+            "id": int(phid[-1]),
+            "phid": phid,
+            "fields": {"status": {"value": status}, "stackGraph": stack_graph},
+        }
+
+    m_call.return_value = {"data": [rev("PHID-1", {})]}
+    assert [] == get_related_phids("PHID-1", include_abandoned=True)
     m_call.assert_called_once_with(
-        "edge.search", {"sourcePHIDs": ["aaa"], "types": ["revision.parent"]}
+        "differential.revision.search",
+        {"constraints": {"phids": ["PHID-1"]}, "attachments": {"reviewers": True}},
     )
 
+    # The whole stack is fetched with the second call and then cached.
+    simplecache.cache.reset()
+    m_call.reset_mock()
+    stack_graph = {"PHID-3": ["PHID-2"], "PHID-2": ["PHID-1"], "PHID-1": []}
     m_call.side_effect = [
-        {"data": [{"destinationPHID": "bbb"}]},
-        {"data": [{"destinationPHID": "aaa"}]},
-        {},
-    ]
-    assert ["bbb", "aaa"] == get_related_phids("ccc", include_abandoned=True)
-
-    m_call.side_effect = [
-        {"data": [{"destinationPHID": "bbb"}]},
-        {"data": [{"destinationPHID": "aaa"}]},
-        {},
+        {"data": [rev("PHID-3", stack_graph)]},
         {
             "data": [
-                {"id": 1, "phid": "aaa", "fields": {"status": {"value": "-"}}},
-                {"id": 2, "phid": "bbb", "fields": {"status": {"value": "abandoned"}}},
+                rev("PHID-1", stack_graph),
+                rev("PHID-2", stack_graph, status="abandoned"),
             ]
         },
     ]
-    assert ["aaa"] == get_related_phids("ccc", include_abandoned=False)
+    assert ["PHID-2", "PHID-1"] == get_related_phids("PHID-3", include_abandoned=True)
+    assert ["PHID-1"] == get_related_phids("PHID-3", include_abandoned=False)
+    assert ["PHID-2", "PHID-3"] == get_related_phids(
+        "PHID-1", relation="child", include_abandoned=True
+    )
+    assert m_call.call_count == 2
+
+    # Branching on the path raises, branching elsewhere in the stack is ignored.
+    simplecache.cache.reset()
+    m_call.reset_mock()
+    stack_graph = {
+        "PHID-4": ["PHID-2"],
+        "PHID-3": ["PHID-2"],
+        "PHID-2": ["PHID-1"],
+        "PHID-1": [],
+    }
+    m_call.side_effect = [
+        {"data": [rev("PHID-3", stack_graph)]},
+        {"data": [rev(phid, stack_graph) for phid in stack_graph]},
+    ]
+    assert ["PHID-2", "PHID-1"] == get_related_phids("PHID-3", include_abandoned=True)
+    with pytest.raises(exceptions.NonLinearException):
+        get_related_phids("PHID-1", relation="child")
+    with pytest.raises(exceptions.NonLinearException):
+        get_related_phids("PHID-2", relation="child")
+    assert ["PHID-2", "PHID-1"] == get_related_phids("PHID-4", include_abandoned=True)
+
+    simplecache.cache.reset()
+    m_call.side_effect = [{"data": []}]
+    with pytest.raises(exceptions.NotFoundError):
+        get_related_phids("PHID-5")
 
 
 def test_has_revision_reviewers(m_call):
@@ -582,6 +749,29 @@ def test_diff_property(m_call, git, hg):
         },
     )
 
+    m_call.reset_mock()
+    commit.fingerprint = "fff"
+    mozphab.conduit.set_diff_property("1", commit, "message")
+    data = json.loads(m_call.call_args[0][1]["data"])
+    assert data["abc"]["fingerprint"] == "fff"
+
+
+@mock.patch("mozphab.repository.conduit.call")
+def test_get_diff_fingerprints(m_call):
+    m_call.return_value = {
+        "1": {"id": "1", "properties": {"local:commits": {"aaa": {"author": "A"}}}},
+        "2": {"id": "2", "properties": []},
+        "3": {
+            "id": "3",
+            "properties": {"local:commits": {"ccc": {"fingerprint": "fff"}}},
+        },
+    }
+    assert conduit.get_diff_fingerprints([3, 1, 2, 3]) == {3: "fff"}
+    m_call.assert_called_once_with("differential.querydiffs", {"ids": [1, 2, 3]})
+
+    m_call.return_value = []
+    assert conduit.get_diff_fingerprints([4]) == {}
+
 
 @mock.patch("mozphab.repository.conduit.call")
 def test_get_projects(m_call):
@@ -857,3 +1047,160 @@ class TestEditRevision:
                 "objectIdentifier": 1,
             },
         )
+
+
+def test_upload_chunks(m_call):
+    data = b"0123456789"
+    chunks = {
+        0: {"byteStart": "0", "byteEnd": "4", "complete": True},
+        4: {"byteStart": "4", "byteEnd": "8", "complete": False},
+        8: {"byteStart": "8", "byteEnd": "10", "complete": False},
+    }
+    uploaded = {}
+    failures = [8]
+
+    def call(method, args):
+        if method == "file.querychunks":
+            return [dict(chunk) for chunk in chunks.values()]
+
+        assert method == "file.uploadchunk"
+        if args["byteStart"] in failures:
+            failures.remove(args["byteStart"])
+            raise ConduitAPIError("timeout")
+        uploaded[args["byteStart"]] = base64.b64decode(args["data"])
+        chunks[args["byteStart"]]["complete"] = True
+        return {}
+
+    m_call.side_effect = call
+    conduit.upload_chunks("PHID-FILE-1", data)
+
+    # The first chunk was already complete, the failed one is resumed.
+    assert uploaded == {4: b"4567", 8: b"89"}
+    assert [c.args[0] for c in m_call.call_args_list].count("file.querychunks") == 2
+
+    # Errors are raised after the last attempt.
+    chunks[8]["complete"] = False
+    failures.extend([8, 8, 8])
+    with pytest.raises(ConduitAPIError):
+        conduit.upload_chunks("PHID-FILE-1", data)
+
+
+@mock.patch("mozphab.conduit.hashlib.sha256", wraps=hashlib.sha256)
+def test_upload_file_dedup(m_sha256, m_call):
+    conduit._content_hashes.clear()
+    m_call.side_effect = [{"filePHID": "PHID-FILE-1", "upload": False}]
+
+    # Same blob as the "new" side of a commit and the "old" side of its child.
+    new = {"type": "new", "value": b"\0abc", "phid": None, "key": "blob-1"}
+    old = {"type": "old", "value": b"\0abc", "phid": None, "key": "blob-1"}
+    conduit.upload_file(new, "a.bin")
+    conduit.upload_file(old, "a.bin")
+    assert new["phid"] == old["phid"] == "PHID-FILE-1"
+    m_sha256.assert_called_once()
+    m_call.assert_called_once_with(
+        "file.allocate",
+        {
+            "name": "a.bin",
+            "contentLength": 4,
+            "contentHash": hashlib.sha256(b"\0abc").hexdigest(),
+        },
+    )
+
+    # Same content without a key is hashed, but not allocated again.
+    other = {"type": "new", "value": b"\0abc", "phid": None, "key": None}
+    conduit.upload_file(other, "b.bin")
+    assert other["phid"] == "PHID-FILE-1"
+    assert m_call.call_count == 1
+
+
+def test_upload_files_revalidated(m_call, tmp_path):
+    conduit._content_hashes.clear()
+    kept_hash = hashlib.sha256(b"\0kept").hexdigest()
+    deleted_hash = hashlib.sha256(b"\0deleted").hexdigest()
+    cache_path = tmp_path / "cache.json"
+    simplecache.cache.enable_persistence(cache_path)
+    simplecache.cache.set("file-%s" % kept_hash, "PHID-FILE-KEPT")
+    simplecache.cache.set("file-%s" % deleted_hash, "PHID-FILE-DELETED")
+    simplecache.cache.save()
+    simplecache.cache.reset()
+    simplecache.cache.enable_persistence(cache_path)
+
+    def call(method, args):
+        if method == "file.search":
+            return {"data": [{"phid": "PHID-FILE-KEPT"}]}
+        return {"filePHID": "PHID-FILE-NEW", "upload": False}
+
+    m_call.side_effect = call
+    diff = Diff()
+    change = diff.change_for("a.bin")
+    change.old_path = "a.bin"
+    change.set_as_binary(
+        a_body=b"\0deleted", a_mime="", b_body=b"\0kept", b_mime="", a_key="blob-1"
+    )
+    conduit.upload_files_from_diff(diff)
+
+    # The files uploaded by a previous run are looked up together, the deleted
+    # one is uploaded again.
+    assert [upload["phid"] for upload in change.uploads] == [
+        "PHID-FILE-NEW",
+        "PHID-FILE-KEPT",
+    ]
+    assert [c.args[0] for c in m_call.call_args_list] == [
+        "file.search",
+        "file.allocate",
+    ]
+    assert m_call.call_args_list[0].args[1] == {
+        "constraints": {"phids": ["PHID-FILE-DELETED", "PHID-FILE-KEPT"]}
+    }
+
+    # They're only looked up once.
+    m_call.reset_mock()
+    conduit.upload_files_from_diff(diff)
+    m_call.assert_not_called()
+
+    # The files of a rejected diff are forgotten.
+    conduit._forget_uploaded_files(diff)
+    assert "file-%s" % kept_hash not in simplecache.cache
+    assert "file-%s" % deleted_hash not in simplecache.cache
+
+
+def test_upload_spooled_file(m_call):
+    conduit._content_hashes.clear()
+    contents = helpers.SpooledContents(
+        lambda path: Path(path).write_bytes(b"0123456789")
+    )
+    spooled_path = contents.path
+    uploaded = {}
+
+    def call(method, args):
+        if method == "file.allocate":
+            return {"filePHID": "PHID-FILE-1", "upload": True}
+        if method == "file.querychunks":
+            return [
+                {"byteStart": "0", "byteEnd": "6", "complete": bool(uploaded)},
+                {"byteStart": "6", "byteEnd": "10", "complete": bool(uploaded)},
+            ]
+        uploaded[args["byteStart"]] = base64.b64decode(args["data"])
+        return {}
+
+    m_call.side_effect = call
+    diff = Diff()
+    change = diff.change_for("large.bin")
+    change.set_as_binary(
+        a_body=b"", a_mime="", b_body=contents, b_mime="", b_key="blob-1"
+    )
+    conduit.upload_files_from_diff(diff)
+
+    assert change.uploads[1]["phid"] == "PHID-FILE-1"
+    assert uploaded == {0: b"012345", 6: b"6789"}
+    assert m_call.call_args_list[0].args == (
+        "file.allocate",
+        {
+            "name": "large.bin",
+            "contentLength": 10,
+            "contentHash": hashlib.sha256(b"0123456789").hexdigest(),
+        },
+    )
+    # The temporary file is removed once uploaded, its size is still known.
+    assert not Path(spooled_path).exists()
+    assert change.to_conduit("node")["metadata"]["new:file:size"] == 10
@@ -21,6 +21,7 @@ def test_defaults(config):
     assert config.auto_submit is False
     assert config.always_blocking is False
     assert config.warn_untracked is True
+    assert config.pipeline_depth == 2
     assert config.apply_patch_to == "base"
     assert config.create_bookmark is True
     assert config.create_topic is False
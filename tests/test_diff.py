@@ -7,9 +7,11 @@
 import textwrap
 from unittest import mock
 
+import pytest
+
 from mozphab import environment
 from mozphab.commits import Commit
-from mozphab.diff import Diff
+from mozphab.diff import Diff, HunkParser
 
 from .conftest import assert_attributes
 
@@ -168,11 +170,8 @@ def test_change_empty(m_git_out, m_cat_file, m_file_size, git):
 @mock.patch("mozphab.mercurial.Mercurial.hg_out")
 @mock.patch("mozphab.mercurial.Mercurial._get_file_meta")
 @mock.patch("mozphab.mercurial.Mercurial._get_parent")
-@mock.patch("mozphab.mercurial.Mercurial._get_file_modes")
 @mock.patch("uuid.uuid4")
-def test_change_empty_hg(
-    m_uuid4, m_get_file_modes, m_get_parent, m_get_file_meta, m_hg_out, hg
-):
+def test_change_empty_hg(m_uuid4, m_get_parent, m_get_file_meta, m_hg_out, hg):
     commit = Commit(
         name="78981922613b",
         node="78981922613b2afb6025042ff6bd878ac1994e85",
@@ -182,21 +181,19 @@ def test_change_empty_hg(
         body="test",
     )
     m_get_parent.return_value = "422c2b7ab3b3c668038da977e4e93a5fc623169c"
-    m_get_file_modes.return_value = {
-        "fn": {
-            "old_mode": "100644",
-            "new_mode": "100755",
-        },
-    }
     m_uuid4.side_effect = [
         mock.Mock(hex="abc123"),
         mock.Mock(hex="def456"),
     ]
     m_hg_out.side_effect = [
-        # hg checkout
-        "",
         # hg log
         "--abc123----def456----abc123----def456--fn--abc123----def456----abc123--",
+        # hg files (parent)
+        ["0\t\tfn"],
+        # hg files (node)
+        ["0\tx\tfn"],
+        # hg diff
+        b"",
     ]
     m_get_file_meta.side_effect = [
         {
@@ -300,37 +297,56 @@ def test_recognize_binary(m_git_out, m_cat_file, m_file_size, git):
     m_git_out.assert_not_called()
     assert change.file_type.name == "BINARY"
     assert change.uploads == [
-        {"type": "old", "value": b"", "mime": "application/octet-stream", "phid": None},
+        {
+            "type": "old",
+            "value": b"",
+            "mime": "application/octet-stream",
+            "phid": None,
+            "key": None,
+        },
         {
             "type": "new",
             "value": content,
             "mime": "application/octet-stream",
             "phid": None,
+            "key": "21be03052ed0c8dc31dff33eeb9275430241a727",
         },
     ]
     assert not change.hunks
 
 
 @mock.patch("mozphab.git.Git._file_size")
+@mock.patch("mozphab.git.Git._spool_blob")
 @mock.patch("mozphab.git.Git._cat_file")
 @mock.patch("mozphab.git.Git.git_out")
-def test_recognize_long_text_as_binary(m_git_out, m_cat_file, m_file_size, git):
+def test_recognize_long_text_as_binary(
+    m_git_out, m_cat_file, m_spool_blob, m_file_size, git
+):
     raw = (
         "000000 100644 0000000000000000000000000000000000000000 "
         "78981922613b2afb6025042ff6bd878ac1994e85 A\x00a"
     )
     diff = Diff()
     content = b"a\n"
-    m_cat_file.side_effect = (content,)
+    m_spool_blob.return_value = content
     m_file_size.return_value = environment.MAX_TEXT_SIZE + 1
     git.args = Args()
 
     change = git._parse_diff_change(raw, diff)
     m_git_out.assert_not_called()
+    # The contents of files too big to be text aren't read.
+    m_cat_file.assert_not_called()
+    m_spool_blob.assert_called_once_with("78981922613b2afb6025042ff6bd878ac1994e85")
     assert change.file_type.name == "BINARY"
     assert change.uploads == [
-        {"type": "old", "value": b"", "mime": "", "phid": None},
-        {"type": "new", "value": content, "mime": "", "phid": None},
+        {"type": "old", "value": b"", "mime": "", "phid": None, "key": None},
+        {
+            "type": "new",
+            "value": content,
+            "mime": "",
+            "phid": None,
+            "key": "78981922613b2afb6025042ff6bd878ac1994e85",
+        },
     ]
     assert not change.hunks
 
@@ -459,6 +475,109 @@ def test_multiple_hunks():
             "corpus": "y\n-z\n",
         },
     )
+    assert change.added == 0
+    assert change.deleted == 3
+    # The hunks share one buffer.
+    assert len({id(hunk._buffer) for hunk in change.hunks}) == 1
+
+
+def test_from_git_diff_single_hunk():
+    git_diff = (
+        "diff --git a/x b/x\n"
+        "--- a/x\n"
+        "+++ b/x\n"
+        "@@ -1,2 +1,2 @@\n"
+        " a\n"
+        "-b\n"
+        "\\ No newline at end of file\n"
+        "+b\n"
+    )
+    change = Diff.Change("x")
+    change.from_git_diff(git_diff)
+
+    assert len(change.hunks) == 1
+    assert_attributes(
+        change.hunks[0],
+        {
+            "old_off": 1,
+            "old_len": 2,
+            "new_off": 1,
+            "new_len": 2,
+            "old_eof_newline": False,
+            "new_eof_newline": True,
+            "added": 1,
+            "deleted": 1,
+            "corpus": " a\n-b\n\\ No newline at end of file\n+b\n",
+        },
+    )
+    # The only hunk of a file is the whole shared buffer.
+    assert change.hunks[0].corpus is change.hunks[0]._buffer
+
+
+@mock.patch("mozphab.diff.HUNK_PARSER_CHUNK_SIZE", 8)
+def test_hunk_parser():
+    git_diff = (
+        b"diff --git a/x b/x\n"
+        b"--- a/x\n"
+        b"+++ b/x\n"
+        b"@@ -1,2 +1,2 @@ context\n"
+        b" \xc4\x85\n"
+        b"-b\n"
+        b"+c\n"
+        b"@@ -10 +10,2 @@\n"
+        b" x\n"
+        b"+y\n"
+        b"\\ No newline at end of file"
+    )
+
+    def parse(pieces):
+        parser = HunkParser()
+        hunks = [hunk for piece in pieces for hunk in parser.feed(piece)]
+        hunks.extend(parser.close())
+        return summary(hunks)
+
+    def summary(hunks):
+        return [
+            (h.old_off, h.old_len, h.new_off, h.new_len, h.added, h.deleted, h.corpus)
+            for h in hunks
+        ]
+
+    expected = [
+        (1, 2, 1, 2, 1, 1, " ą\n-b\n+c\n"),
+        (10, 1, 10, 2, 1, 0, " x\n+y\n\\ No newline at end of file"),
+    ]
+    assert parse([git_diff]) == expected
+    assert parse(git_diff.splitlines(keepends=True)) == expected
+    # Pieces may split headers and characters apart.
+    assert parse([git_diff[i : i + 5] for i in range(0, len(git_diff), 5)]) == expected
+    assert parse([b"diff --git a/x b/x\n", b"Binary files differ\n"]) == []
+
+    # The hunks of a whole diff share their buffer, even with multi-byte
+    # characters.
+    hunks = HunkParser.parse(git_diff)
+    assert summary(hunks) == expected
+    assert hunks[0]._buffer is hunks[1]._buffer
+    hunks = HunkParser.parse(git_diff.replace(b" x\n", b" \xc4\x85\n"))
+    assert summary(hunks) == [
+        expected[0],
+        (10, 1, 10, 2, 1, 0, " ą\n+y\n\\ No newline at end of file"),
+    ]
+    assert hunks[0]._buffer is hunks[1]._buffer
+
+
+def test_from_git_diff_invalid_utf8():
+    change = Diff.Change("x")
+    with pytest.raises(UnicodeDecodeError):
+        change.from_git_diff(b"@@ -1 +1 @@\n-a\n+b\n@@ -5 +5 @@\n-\xff\n")
+    assert change.hunks == []
+
+
+def test_kind_file_type_singletons():
+    assert Diff.Kind("ADD") is Diff.Kind("ADD")
+    assert Diff.Kind("ADD") is not Diff.Kind("DELETE")
+    assert Diff.FileType("TEXT") is Diff.FileType("TEXT")
+    assert Diff.FileType("TEXT").value == 1
+    assert Diff.Change("x").kind is Diff.Change("y").kind
 
 
 def test_set_as_binary():
@@ -471,8 +590,8 @@ def test_set_as_binary():
     )
     assert change.binary
     assert change.uploads == [
-        {"type": "old", "value": b"a", "mime": "pdf/", "phid": None},
-        {"type": "new", "value": b"b", "mime": "pdf/", "phid": None},
+        {"type": "old", "value": b"a", "mime": "pdf/", "phid": None, "key": None},
+        {"type": "new", "value": b"b", "mime": "pdf/", "phid": None, "key": None},
     ]
     assert change.file_type.name == "BINARY"
 
@@ -3,15 +3,209 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import hashlib
+import json
+import os
+import subprocess
+import threading
+import time
 from pathlib import Path
 from unittest import mock
 
 import pytest
 
-from mozphab import environment, exceptions, mozphab
+from mozphab import environment, exceptions, helpers, mozphab
 from mozphab.commits import Commit
+from mozphab.git import split_patches
+from mozphab.gitcommand import CatFile, GitCommand
+
+from .conftest import create_temp_fn, git_out
+
+
+def test_cat_file(git_command, git_repo_path):
+    (git_repo_path / "X").write_bytes(b"a\0b\n")
+    blob = git_out("hash-object", "-w", "X").strip()
+    cwd = str(git_repo_path)
+
+    git = GitCommand()
+    assert git.object_size(blob, cwd) == 4
+    assert git.object_contents(blob, cwd) == b"a\0b\n"
+    assert git.object_contents(blob, cwd) == b"a\0b\n"
+    git.write_object(blob, str(git_repo_path / "Y"), cwd)
+    assert (git_repo_path / "Y").read_bytes() == b"a\0b\n"
+    processes = list(git._cat_files.values())
+    assert [p.mode for p in processes] == ["batch-check", "batch"]
+
+    with pytest.raises(exceptions.CommandError, match="missing"):
+        git.object_contents("0" * 40, cwd)
+
+    # The same processes keep answering after an error.
+    assert git.object_size(blob, cwd) == 4
+    assert list(git._cat_files.values()) == processes
+
+    git.close()
+    assert not any(p.alive for p in processes)
+    assert git.object_size(blob, cwd) == 4
+    git.close()
+
+
+def test_cat_file_threads(git_command, git_repo_path):
+    (git_repo_path / "X").write_text("x\n")
+    blob = git_out("hash-object", "-w", "X").strip()
+    cwd = str(git_repo_path)
+    git = GitCommand()
+    barrier = threading.Barrier(4)
+
+    def cat_file(*args):
+        # Let the other threads look for the process while it's started.
+        time.sleep(0.1)
+        return CatFile(*args)
+
+    with mock.patch("mozphab.gitcommand.CatFile", side_effect=cat_file) as m_cat_file:
+
+        def query():
+            barrier.wait()
+            assert git.object_size(blob, cwd) == 2
+
+        threads = [threading.Thread(target=query) for _i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    # A single process is started for all the threads.
+    assert m_cat_file.call_count == 1
+    git.close()
+
+
+@mock.patch("mozphab.git.Git._write_commits")
+def test_cleanup_closes_cat_files(m_write_commits, git):
+    m_write_commits.side_effect = exceptions.Error("failed")
+    with mock.patch.object(git.git, "close") as m_close, pytest.raises(
+        exceptions.Error
+    ):
+        git.cleanup()
+    m_close.assert_called_once_with()
+
+
+def test_output_lines(git_command, git_repo_path):
+    git = GitCommand()
+    cwd = str(git_repo_path)
+    lines = list(git.output_lines(["log", "--format=%s"], cwd))
+    assert lines == [b"initial commit\n"]
+
+    with pytest.raises(exceptions.CommandError):
+        list(git.output_lines(["log", "missing-branch"], cwd))
+
+
+def test_split_patches():
+    a, b, c = "a" * 40, "b" * 40, "c" * 40
+    lines = [
+        b"diff --git a/X b/X\n",
+        b"index %s..%s 100644\n" % (a.encode(), b.encode()),
+        b"--- a/X\n",
+        b"+++ b/X\n",
+        b"@@ -1 +1 @@\n",
+        b"-a\r\n",
+        b"+b\r\n",
+        b"diff --git a/bin b/bin\n",
+        b"index %s..%s\n" % (a.encode(), c.encode()),
+        b"Binary files a/bin and b/bin differ\n",
+        b"diff --git a/Y b/Y\n",
+        b"new file mode 100644\n",
+        b"index %s..%s\n" % (("0" * 40).encode(), c.encode()),
+        b"--- /dev/null\n",
+        b"+++ b/Y\n",
+        b"@@ -0,0 +1 @@\n",
+        b"+index 1..2\n",
+        b"diff --git a/latin1 b/latin1\n",
+        b"index %s..%s 100644\n" % (b.encode(), c.encode()),
+        b"--- a/latin1\n",
+        b"+++ b/latin1\n",
+        b"@@ -1 +1 @@\n",
+        b"-a\n",
+        b"+\xe9\n",
+        b"diff --git a/nul b/nul\n",
+        b"index %s..%s 100644\n" % (c.encode(), a.encode()),
+        b"--- a/nul\n",
+        b"+++ b/nul\n",
+        b"@@ -1 +1,2 @@\n",
+        b" a\n",
+        b"+\0\n",
+    ]
+    patches = split_patches(iter(lines))
+    assert {
+        blobs: [(h.old_off, h.new_off, h.new_len, h.corpus) for h in hunks]
+        for blobs, hunks in patches.items()
+    } == {
+        (a, b): [(1, 1, 1, "-a\r\n+b\r\n")],
+        ("0" * 40, c): [(0, 1, 1, "+index 1..2\n")],
+    }
+
 
-from .conftest import create_temp_fn
+def test_get_diff_single_process(git, git_command, git_repo_path):
+    git.path = str(git_repo_path)
+    git.args = mock.Mock(lesscontext=False)
+    (git_repo_path / "X").write_text("a\nb\nc\n")
+    (git_repo_path / "Y").write_text("y\n")
+    (git_repo_path / "R").write_text("r\n" * 10)
+    git_out("add", "X", "Y", "R")
+    git_out("commit", "-m", "first")
+    (git_repo_path / "X").write_text("a\nB\nc\n")
+    (git_repo_path / "Y").unlink()
+    (git_repo_path / "R").unlink()
+    (git_repo_path / "R2").write_text("r\n" * 9 + "R\n")
+    (git_repo_path / "Z").write_bytes(b"z\r\n")
+    (git_repo_path / "bin").write_bytes(b"\0\1")
+    # Git only finds NUL bytes at the start of a file.
+    (git_repo_path / "late_nul").write_bytes(b"text\n" * 2000 + b"\0")
+    git_out("add", "-A")
+    git_out("commit", "-m", "second")
+    commit = Commit(node=git_out("rev-parse", "HEAD").strip())
+
+    with mock.patch("mozphab.git.Git.git_out", wraps=git.git_out) as m_git_out:
+        diff = git.get_diff(commit)
+    # Only the raw listing is read with `git_out`, patches come from one process.
+    assert m_git_out.call_count == 1
+
+    with mock.patch("mozphab.git.Git._get_patches", return_value={}):
+        expected = git.get_diff(commit)
+
+    def hunks(diff):
+        return {
+            path: [(h.old_off, h.new_off, h.corpus) for h in change.hunks]
+            for path, change in diff.changes.items()
+        }
+
+    assert hunks(diff) == hunks(expected)
+    assert sorted(diff.changes) == ["R", "R2", "X", "Y", "Z", "bin", "late_nul"]
+    # Only the changes of existing files are diffed by the single process.
+    assert len(git._get_patches(commit.node)) == 2
+    assert diff.changes["bin"].binary
+    assert diff.changes["late_nul"].binary
+
+
+@mock.patch("mozphab.environment.MAX_TEXT_SIZE", 16)
+def test_get_diff_large_file(git, git_command, git_repo_path):
+    git.path = str(git_repo_path)
+    git.args = mock.Mock(lesscontext=False)
+    (git_repo_path / "large").write_bytes(b"\x89PNG\r\n\x1a\n" + b"text\n" * 10)
+    git_out("add", "large")
+    git_out("commit", "-m", "large")
+    commit = Commit(node=git_out("rev-parse", "HEAD").strip())
+
+    with mock.patch("mozphab.git.Git._cat_file") as m_cat_file:
+        diff = git.get_diff(commit)
+    # Files too big to be text aren't read, they're written to a temporary file.
+    m_cat_file.assert_not_called()
+    change = diff.changes["large"]
+    assert change.binary
+    assert change.file_type.name == "IMAGE"
+    contents = change.uploads[1]["value"]
+    assert isinstance(contents, helpers.SpooledContents)
+    with contents.view() as view:
+        assert view == (git_repo_path / "large").read_bytes()
+    contents.close()
 
 
 @mock.patch("mozphab.git.Git.git_out")
@@ -26,6 +220,35 @@ def test_cherry(m_git_git_out, git):
     )
 
 
+@mock.patch("mozphab.git.Git.git_out")
+def test_set_diff_fingerprints(m_git_git_out, git):
+    git.args = mock.Mock(lesscontext=False)
+    commits = [
+        Commit(node="aaa", tree_hash="tree-a"),
+        Commit(node="bbb", tree_hash="tree-b"),
+    ]
+    m_git_git_out.return_value = ["tree-0", "tree-a"]
+    git.set_diff_fingerprints(commits)
+    assert m_git_git_out.call_args[0][0] == ["rev-parse", "aaa^^{tree}", "bbb^^{tree}"]
+    assert commits[0].fingerprint == git._diff_fingerprint("tree-0", "tree-a")
+    assert commits[1].fingerprint == git._diff_fingerprint("tree-a", "tree-b")
+
+    # The fingerprint depends only on the trees and diff settings.
+    amended = [Commit(node="ccc", tree_hash="tree-a")]
+    m_git_git_out.return_value = ["tree-0"]
+    git.set_diff_fingerprints(amended)
+    assert amended[0].fingerprint == commits[0].fingerprint
+    git.args.lesscontext = True
+    git.set_diff_fingerprints(amended)
+    assert amended[0].fingerprint != commits[0].fingerprint
+
+    # Root commits don't get a fingerprint.
+    root = [Commit(node="ddd", tree_hash="tree-d")]
+    m_git_git_out.side_effect = exceptions.CommandError
+    git.set_diff_fingerprints(root)
+    assert root[0].fingerprint is None
+
+
 @mock.patch("mozphab.git.Git.git_out")
 @mock.patch("mozphab.git.Git._cherry")
 @mock.patch("mozphab.git.config")
@@ -73,44 +296,77 @@ def test_branches_to_rebase(m_git_git_out, git):
     assert {} == git_find([Commit(orig_node="_aaa", node="aaa")])
 
     # No amend, no branches to rebase
-    m_git_git_out.return_value = ["branch"]
+    m_git_git_out.reset_mock()
     assert {} == git_find([Commit(orig_node="aaa", node="aaa")])
+    m_git_git_out.assert_not_called()
 
     # One commit, one branch
-    m_git_git_out.return_value = ["branch"]
-    assert {"branch": ["aaa", "_aaa"]} == git_find(
+    m_git_git_out.side_effect = (["_aaa refs/heads/branch"], ["_aaa"])
+    assert {"refs/heads/branch": ["aaa", "_aaa"]} == git_find(
         [Commit(orig_node="_aaa", node="aaa")]
     )
+    m_git_git_out.assert_has_calls(
+        [
+            mock.call(
+                [
+                    "for-each-ref",
+                    "--contains",
+                    "_aaa",
+                    "--format=%(objectname) %(refname)",
+                    "refs/heads/",
+                ]
+            ),
+            mock.call(
+                ["rev-list", "--topo-order", "--parents", "_aaa", "--not", "_aaa^@"]
+            ),
+        ]
+    )
 
     # Two commits one branch
-    m_git_git_out.return_value = ["branch"]
-    assert {"branch": ["bbb", "_bbb"]} == git_find(
+    m_git_git_out.side_effect = (["_bbb refs/heads/branch"], ["_bbb _aaa", "_aaa"])
+    assert {"refs/heads/branch": ["bbb", "_bbb"]} == git_find(
         [Commit(orig_node="_aaa", node="aaa"), Commit(orig_node="_bbb", node="bbb")]
     )
 
+    # Only the rewritten commits are looked for
+    m_git_git_out.side_effect = (["_bbb refs/heads/branch"], ["_bbb aaa"])
+    assert {"refs/heads/branch": ["bbb", "_bbb"]} == git_find(
+        [Commit(orig_node="aaa", node="aaa"), Commit(orig_node="_bbb", node="bbb")]
+    )
+    assert m_git_git_out.call_args[0][0][-1] == "_bbb^@"
+
     # Two branches one commit
-    # ... (branch1)
-    # | ... (branch2)
+    # * xxx (branch1)
+    # | * yyy (branch2)
     # |/
     # * aaa
-    # More realistic output from the git command
-    m_git_git_out.return_value = ["*  branch1", "  branch2"]
-    assert {"branch1": ["aaa", "_aaa"], "branch2": ["aaa", "_aaa"]} == git_find(
-        [Commit(orig_node="_aaa", node="aaa")]
+    m_git_git_out.side_effect = (
+        ["xxx refs/heads/branch1", "yyy refs/heads/branch2"],
+        ["yyy _aaa", "xxx _aaa", "_aaa"],
     )
+    assert {
+        "refs/heads/branch1": ["aaa", "_aaa"],
+        "refs/heads/branch2": ["aaa", "_aaa"],
+    } == git_find([Commit(orig_node="_aaa", node="aaa")])
 
-    # ... (branch1)
+    # * xxx (branch1)
     # | * bbb (branch2)
     # |/
     # * aaa
-    m_git_git_out.side_effect = (["branch1", "branch2"], ["branch2"])
-    assert {"branch1": ["aaa", "_aaa"], "branch2": ["bbb", "_bbb"]} == git_find(
+    m_git_git_out.side_effect = (
+        ["xxx refs/heads/branch1", "_bbb refs/heads/branch2"],
+        ["_bbb _aaa", "xxx _aaa", "_aaa"],
+    )
+    assert {
+        "refs/heads/branch1": ["aaa", "_aaa"],
+        "refs/heads/branch2": ["bbb", "_bbb"],
+    } == git_find(
         [Commit(orig_node="_aaa", node="aaa"), Commit(orig_node="_bbb", node="bbb")]
     )
 
-    # * ... (master)
-    # | * ... (feature1)
-    # | | * ... (feature2)
+    # * mmm (master)
+    # | * fff (feature1)
+    # | | * ggg (feature2)
     # | |/
     # |/|
     # | | * ddd (feature1_1)
@@ -119,18 +375,29 @@ def test_branches_to_rebase(m_git_git_out, git):
     # |/
     # * bbb
     # * aaa
-
+    m_git_git_out.reset_mock()
     m_git_git_out.side_effect = (
-        ["master", "feature1", "feature1_1", "feature2"],  # aaa
-        ["master", "feature1", "feature1_1", "feature2"],  # bbb
-        ["feature1", "feature1_1"],  # ccc
-        ["feature1_1"],  # ddd
+        [
+            "mmm refs/heads/master",
+            "fff refs/heads/feature1",
+            "_ddd refs/heads/feature1_1",
+            "ggg refs/heads/feature2",
+        ],
+        [
+            "_ddd _ccc",
+            "fff _ccc",
+            "_ccc _bbb",
+            "ggg _bbb",
+            "mmm _bbb",
+            "_bbb _aaa",
+            "_aaa",
+        ],
     )
     assert {
-        "master": ["bbb", "_bbb"],
-        "feature1": ["ccc", "_ccc"],
-        "feature2": ["bbb", "_bbb"],
-        "feature1_1": ["ddd", "_ddd"],
+        "refs/heads/master": ["bbb", "_bbb"],
+        "refs/heads/feature1": ["ccc", "_ccc"],
+        "refs/heads/feature2": ["bbb", "_bbb"],
+        "refs/heads/feature1_1": ["ddd", "_ddd"],
     } == git_find(
         [
             Commit(orig_node="_aaa", node="aaa"),
@@ -139,47 +406,51 @@ def test_branches_to_rebase(m_git_git_out, git):
             Commit(orig_node="_ddd", node="ddd"),
         ]
     )
+    assert m_git_git_out.call_count == 2
 
 
-def test_get_direct_children(git):
-    get_children = git._get_direct_children
-    rev_list = ["aaa bbb ccc", "bbb", "ccc ddd"]
-    assert ["bbb", "ccc"] == get_children("aaa", rev_list)
-    assert [] == get_children("bbb", rev_list)
-    assert ["ddd"] == get_children("ccc", rev_list)
-    assert [] == get_children("xxx", rev_list)
+@mock.patch("mozphab.git.Git.git_out")
+def test_git_get_children(m_git_out, git):
+    m_git_out.return_value = ["ddd ccc", "ccc bbb", "eee bbb", "bbb aaa"]
+    assert git._git_get_children("bbb", "ddd") == {
+        "aaa": ["bbb"],
+        "bbb": ["ccc", "eee"],
+        "ccc": ["ddd"],
+    }
+    m_git_out.assert_called_once_with(
+        ["rev-list", "--parents", "ddd", "--not", "bbb^@"]
+    )
 
 
-def test_is_child(git):
-    is_child = git._is_child
+def test_get_descendants(git):
+    get_descendants = git._get_descendants
     # * ccc
     # * bbb
     # * aaa
-    nodes = ["ccc", "bbb ccc", "aaa bbb"]
-    assert is_child("aaa", "bbb", nodes)
-    assert is_child("aaa", "ccc", nodes)
-    assert is_child("bbb", "ccc", nodes)
-    assert not is_child("bbb", "aaa", nodes)
-    assert not is_child("aaa", "aaa", nodes)
-    assert not is_child("bbb", "bbb", nodes)
-    assert not is_child("ccc", "ccc", nodes)
-
-    # * ddd
-    # | * ccc
+    children = {"aaa": ["bbb"], "bbb": ["ccc"]}
+    assert get_descendants("aaa", children) == {"bbb", "ccc"}
+    assert get_descendants("bbb", children) == {"ccc"}
+    assert get_descendants("ccc", children) == set()
+    assert get_descendants("xxx", children) == set()
+
+    # * fff
+    # |\
+    # | * ddd
+    # * | ccc
     # | | * eee
     # | |/
-    # | * bbb
+    # * | bbb
     # |/
     # * aaa
-    nodes = ["ddd", "ccc", "eee", "bbb ccc eee", "aaa bbb ddd"]
-    assert is_child("aaa", "bbb", nodes)
-    assert is_child("aaa", "ccc", nodes)
-    assert is_child("aaa", "ddd", nodes)
-    assert is_child("aaa", "eee", nodes)
-    assert is_child("bbb", "ccc", nodes)
-    assert is_child("bbb", "eee", nodes)
-    assert not is_child("bbb", "ddd", nodes)
-    assert not is_child("ccc", "ddd", nodes)
+    children = {
+        "aaa": ["bbb", "ddd"],
+        "bbb": ["ccc", "eee"],
+        "ccc": ["fff"],
+        "ddd": ["fff"],
+    }
+    assert get_descendants("aaa", children) == {"bbb", "ccc", "ddd", "eee", "fff"}
+    assert get_descendants("bbb", children) == {"ccc", "eee", "fff"}
+    assert get_descendants("ddd", children) == {"fff"}
 
 
 @mock.patch("mozphab.git.Git.git_out")
@@ -305,6 +576,41 @@ def test_commit(m_git, git):
     m_git.assert_called_once()
 
 
+@mock.patch("mozphab.git.Git.git_out")
+def test_load_public_nodes(m_git_out, git, tmp_path):
+    git.dot_path = str(tmp_path)
+    git._phab_vcs = "hg"
+    m_git_out.return_value = ["hg_aaa", "0" * 40]
+    git.load_public_nodes(["aaa", "bbb", "aaa"])
+    m_git_out.assert_called_once_with(["cinnabar", "git2hg", "aaa", "bbb"])
+
+    assert git.get_public_node("aaa") == "hg_aaa"
+    assert git.get_public_node("bbb") == "bbb"
+    m_git_out.return_value = ["hg_ccc"]
+    assert git.get_public_node("ccc") == "hg_ccc"
+    assert m_git_out.call_count == 2
+
+    # Only the published commits are stored.
+    git._save_hg_nodes()
+    path = tmp_path / "moz-phab" / "git2hg.json"
+    assert json.loads(path.read_text()) == {"aaa": "hg_aaa", "ccc": "hg_ccc"}
+
+    # Later runs read the stored mapping.
+    git._hg_nodes = None
+    m_git_out.reset_mock()
+    m_git_out.return_value = ["0" * 40]
+    git.load_public_nodes(["aaa", "bbb", "ccc"])
+    m_git_out.assert_called_once_with(["cinnabar", "git2hg", "bbb"])
+    assert git._git_to_hg("ccc") == "hg_ccc"
+
+    # Nothing is looked up without Cinnabar.
+    git._phab_vcs = "git"
+    m_git_out.reset_mock()
+    git.load_public_nodes(["ddd"])
+    assert git.get_public_node("ddd") == "ddd"
+    m_git_out.assert_not_called()
+
+
 @mock.patch("mozphab.git.Git._hg_to_git")
 @mock.patch("mozphab.git.Git.is_node")
 @mock.patch("mozphab.git.Git.phab_vcs")
@@ -533,18 +839,125 @@ def test_is_cinnabar_installed(m_git_out, m_which, git, tmp_path):
 
 
 @mock.patch("mozphab.git.Git.git_out")
-def test_unicode_in_windows_env(m_git_out, git, monkeypatch):
-    monkeypatch.setattr(environment, "IS_WINDOWS", True)
-    git._commit_tree("parent", "tree_hash", "message", "ćwikła", "ćwikła", "date")
-    m_git_out.assert_called_once_with(
-        ["commit-tree", "-p", "parent", "-F", mock.ANY, "tree_hash"],
-        split=False,
-        extra_env={
-            "GIT_AUTHOR_NAME": "ćwikła",
-            "GIT_AUTHOR_EMAIL": "ćwikła",
-            "GIT_AUTHOR_DATE": "date",
-        },
+def test_commit_tree(m_git_out, git):
+    m_git_out.side_effect = (
+        "false",
+        "ćwikła <ćwikła@example.com> 0 +0000",
+        "Committer <c@example.com> 1600000000 +0200",
+        "sha1",
+        "a <b> 0 +0000",
+    )
+    node = git._commit_tree(
+        "parent",
+        "tree_hash",
+        "title\n\nbody",
+        "ćwikła",
+        "ćwikła@example.com",
+        "Tue, 14 Apr 2020 12:02:20 -0130",
+    )
+    contents = (
+        "tree tree_hash\n"
+        "parent parent\n"
+        "author ćwikła <ćwikła@example.com> 1586871140 -0130\n"
+        "committer Committer <c@example.com> 1600000000 +0200\n"
+        "\n"
+        "title\n\nbody"
+    ).encode("utf-8")
+    assert git._new_commits == {node: ("parent", contents)}
+    assert (
+        node == hashlib.sha1(b"commit %d\0%s" % (len(contents), contents)).hexdigest()
+    )
+
+    # The repository settings are only read once, the authors once each.
+    git._commit_tree(
+        "parent", "tree_hash", "", "a", "b", "Tue, 14 Apr 2020 12:02:20 +0000"
+    )
+    assert m_git_out.call_count == 5
+
+
+def test_commit_tree_like_git(git, git_command, git_repo_path):
+    git.path = str(git_repo_path)
+    committer_date = {"GIT_COMMITTER_DATE": "Tue, 14 Apr 2020 12:02:20 +0000"}
+    git.git._env.update(committer_date)
+    tree_hash = git_out("rev-parse", "HEAD^{tree}").strip()
+    parent = git_out("rev-parse", "HEAD").strip()
+    author = ("Jo Ann.", " <j@example.com>", "Tue, 14 Apr 2020 12:02:20 -0130")
+
+    # Git drops the trailing dot of the name and the brackets of the email.
+    node = git._commit_tree(parent, tree_hash, "title\n", *author)
+    env = dict(zip(("GIT_AUTHOR_NAME", "GIT_AUTHOR_EMAIL", "GIT_AUTHOR_DATE"), author))
+    expected = subprocess.check_output(
+        ["git", "commit-tree", "-p", parent, "-m", "title", tree_hash],
+        env={**os.environ, **env, **committer_date},
+        encoding="utf-8",
+    ).strip()
+    assert node == expected
+
+
+def test_commit_tree_signed(git, git_command, git_repo_path, tmp_path):
+    git.path = str(git_repo_path)
+    gpg = tmp_path / "gpg"
+    gpg.write_text(
+        "#!/bin/sh\n"
+        "cat > /dev/null\n"
+        "printf '\\n[GNUPG:] SIG_CREATED D 1 8 00 0 X\\n' >&2\n"
+        "printf -- '-----BEGIN PGP SIGNATURE-----\\n\\nX\\n"
+        "-----END PGP SIGNATURE-----\\n'\n"
+    )
+    gpg.chmod(0o755)
+    git_out("config", "commit.gpgSign", "true")
+    git_out("config", "gpg.program", str(gpg))
+    tree_hash = git_out("rev-parse", "HEAD^{tree}").strip()
+    parent = git_out("rev-parse", "HEAD").strip()
+
+    # Signed commits are written by `commit-tree` right away.
+    node = git._commit_tree(
+        parent, tree_hash, "title", "a", "b", "Tue, 14 Apr 2020 12:02:20 +0000"
+    )
+    assert not git._new_commits
+    assert "\ngpgsig -----BEGIN PGP SIGNATURE-----" in git_out(
+        "cat-file", "commit", node
+    )
+
+
+def test_amend_commit_and_finalize(git, git_command, git_repo_path):
+    git.path = str(git_repo_path)
+    for name in ("A", "B", "C"):
+        (git_repo_path / name).write_text(name)
+        git_out("add", name)
+        git_out("commit", "-m", f"{name}\n\nBody {name}")
+    git_out("branch", "other", "HEAD^")
+    git.branch = "main"
+    git_out("branch", "-M", "main")
+    git.revset = ("HEAD~3", "HEAD")
+    commits = git.commit_stack()
+    orig_nodes = [commit.node for commit in commits]
+
+    for commit in commits:
+        commit.body = f"{commit.body}\n\nDifferential Revision: http://phab/D1"
+        git.amend_commit(commit, commits)
+
+    assert [c.orig_node for c in commits] == orig_nodes
+    assert len({c.node for c in commits} | set(orig_nodes)) == 6
+    assert [c.parent for c in commits[1:]] == [c.node for c in commits[:-1]]
+    # Nothing is written before the stack is finalized.
+    with pytest.raises(subprocess.CalledProcessError):
+        git_out("cat-file", "-e", commits[0].node)
+    # Diffs of the amended commits are created from the original ones.
+    assert git._rewritten[commits[2].node] == orig_nodes[2]
+
+    with mock.patch("mozphab.git.Git.git_call", wraps=git.git_call) as m_git_call:
+        git.finalize(commits)
+    assert [c[0][0][0] for c in m_git_call.call_args_list] == ["update-ref", "checkout"]
+
+    assert git_out("rev-parse", "main", "other").split() == [
+        commits[2].node,
+        commits[1].node,
+    ]
+    assert git_out("log", "--format=%B", "-n1", "main") == (
+        "C\n\nBody C\n\nDifferential Revision: http://phab/D1\n"
     )
+    assert git._new_commits == {}
 
 
 def test_check_vcs(git):
@@ -572,7 +985,7 @@ def test_check_vcs(git):
 
 @mock.patch("mozphab.git.Git._get_commits_info")
 @mock.patch("mozphab.git.Git._git_get_children")
-@mock.patch("mozphab.git.Git._is_child")
+@mock.patch("mozphab.git.Git._get_descendants")
 def test_commit_stack_single(_1, _2, _3, git):
     git._get_commits_info.return_value = [
         """\
@@ -590,7 +1003,7 @@ description
     git.revset = ["HEAD^", "HEAD"]
     git.commit_stack(single=True)
     git._git_get_children.assert_not_called()
-    git._is_child.assert_not_called()
+    git._get_descendants.assert_not_called()
 
 
 @mock.patch("mozphab.git.Git.is_node")
@@ -285,6 +285,31 @@ def test_reviewer_case_sensitivity(call_conduit):
     assert [] == conduit.conduit.check_for_invalid_reviewers(reviewers)
 
 
+@mock.patch("mozphab.conduit.ConduitAPI.call")
+def test_check_for_invalid_reviewers_warm_cache(call_conduit, tmp_path):
+    reviewers = {"granted": [], "request": ["alice", "#user-group", "#alias1"]}
+    call_conduit.side_effect = (
+        # user.query
+        [{"userName": "alice", "phid": "PHID-USER-1"}],
+        # project.search
+        {
+            "data": [{"fields": {"slug": "user-group"}, "phid": "PHID-PROJ-1"}],
+            "maps": {"slugMap": {"#alias1": {"projectPHID": "PHID-PROJ-2"}}},
+        },
+    )
+    cache_path = tmp_path / "cache.json"
+    simplecache.cache.enable_persistence(cache_path)
+    assert [] == conduit.conduit.check_for_invalid_reviewers(reviewers)
+    assert call_conduit.call_count == 2
+    simplecache.cache.save()
+
+    # A new run loads the cache from the disk and doesn't call Phabricator.
+    simplecache.cache.reset()
+    simplecache.cache.enable_persistence(cache_path)
+    assert [] == conduit.conduit.check_for_invalid_reviewers(reviewers)
+    assert call_conduit.call_count == 2
+
+
 def test_get_users_no_users():
     conduit = mozphab.conduit
     assert [] == conduit.get_users([])
@@ -494,6 +519,79 @@ def test_temporary_file_unicode():
             assert f.readline() == message
 
 
+def test_spooled_contents():
+    contents = helpers.SpooledContents(lambda path: Path(path).write_bytes(b"\0abc"))
+    path = contents.path
+    assert len(contents) == 4
+    assert contents.head(2) == b"\0a"
+    with contents.view() as view:
+        assert isinstance(view, memoryview)
+        assert view[1:3] == b"ab"
+    # The view is released once done.
+    with pytest.raises(ValueError):
+        view.tobytes()
+
+    contents.close()
+    assert not Path(path).exists()
+    assert len(contents) == 4
+    contents.close()
+
+    empty = helpers.SpooledContents(lambda path: None)
+    with empty.view() as view:
+        assert view == b""
+    path = empty.path
+    del empty
+    assert not Path(path).exists()
+
+    # The temporary file is removed if it can't be written.
+    paths = []
+
+    def fail(path):
+        paths.append(path)
+        raise exceptions.CommandError("failed")
+
+    with pytest.raises(exceptions.CommandError):
+        helpers.SpooledContents(fail)
+    assert not Path(paths[0]).exists()
+
+
+def test_guess_mime_type():
+    png = b"\x89PNG\r\n\x1a\n\0\0\0\rIHDR"
+    assert helpers.guess_mime_type("image.gif", png) == "image/gif"
+    assert helpers.guess_mime_type("image", png) == "image/png"
+    assert helpers.guess_mime_type("image", b"GIF89a\0") == "image/gif"
+    assert helpers.guess_mime_type("image", b"\0") == ""
+    assert helpers.guess_mime_type("image", b"") == ""
+
+    spooled = helpers.SpooledContents(lambda path: Path(path).write_bytes(png))
+    assert helpers.guess_mime_type("image", spooled) == "image/png"
+    spooled.close()
+
+
+@pytest.mark.parametrize(
+    "body",
+    (
+        "a\nb\n",
+        "a\r\nb\r\n",
+        "a\nb\r still b\r\nc",
+        "zażółć\r\n\r\ngęślą",
+    ),
+)
+def test_create_hunk_corpus(body):
+    # The corpus has the lines given by `split_lines` and `join_lineseps`.
+    lines = helpers.split_lines(body)
+    eof_missing_newline = lines[-1] != ""
+    last_line = lines.pop()
+    lines = [f"+{line}" for line in helpers.join_lineseps(lines)]
+    if eof_missing_newline:
+        lines.append(f"+{last_line}\n")
+        lines.append("\\ No newline at end of file\n")
+    expected = ("".join(lines), len(lines) - eof_missing_newline, eof_missing_newline)
+
+    assert helpers.create_hunk_corpus(body, "+") == expected
+    assert helpers.create_hunk_corpus(body.encode("utf-8"), "+") == expected
+
+
 @pytest.mark.parametrize("prefix", ("+", "-", " "))
 @pytest.mark.parametrize("linesep", ("\n", "\r\n"))
 class TestCreateHunkLines:
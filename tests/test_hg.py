@@ -3,12 +3,13 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import copy
+from pathlib import Path
 from unittest import mock
 
 import pytest
 from packaging.version import Version
 
-from mozphab import diff, environment, exceptions, mozphab
+from mozphab import diff, environment, exceptions, mercurial, mozphab
 from mozphab.commits import Commit
 from mozphab.diff import Diff
 from mozphab.mercurial import Mercurial
@@ -16,17 +17,34 @@ from mozphab.mercurial import Mercurial
 from .conftest import assert_attributes, create_temp_fn
 
 
+@mock.patch("mozphab.mercurial.Mercurial.hg_out")
+def test_get_successors(m_hg_hg_out, hg):
+    m_hg_hg_out.return_value = ["aaa|1:AAA", "bbb", "ccc|3:CCC"]
+    assert hg._get_successors(["aaa", "bbb", "ccc", "ddd"]) == {
+        "aaa": ("1", "AAA"),
+        "ccc": ("3", "CCC"),
+    }
+    m_hg_hg_out.assert_called_once_with(
+        ["log", "-T", mock.ANY, "--hidden"]
+        + ["-r", "obsolete() and (aaa + bbb + ccc + ddd)"]
+    )
+
+    m_hg_hg_out.return_value = ["aaa|1:AAA|2:BBB"]
+    with pytest.raises(exceptions.Error):
+        hg._get_successors(["aaa"])
+
+    m_hg_hg_out.return_value = ["aaa|1:AAA,2:BBB"]
+    with pytest.raises(exceptions.Error):
+        hg._get_successors(["aaa"])
+
+
 @mock.patch("mozphab.mercurial.Mercurial.hg_out")
 def test_get_successor(m_hg_hg_out, hg):
     m_hg_hg_out.return_value = []
     assert (None, None) == hg._get_successor("x")
 
-    m_hg_hg_out.return_value = ["1 abcde"]
-    assert ["1", "abcde"] == hg._get_successor("x")
-
-    m_hg_hg_out.return_value = ["a", "b"]
-    with pytest.raises(exceptions.Error):
-        hg._get_successor("x")
+    m_hg_hg_out.return_value = ["x|1:abcde"]
+    assert ("1", "abcde") == hg._get_successor("x")
 
 
 @mock.patch("mozphab.mercurial.Mercurial._get_successor")
@@ -85,6 +103,127 @@ def test_finalize(m_get_parent, m_hg_rebase, m_hg_get_successor, hg):
     assert m_hg_rebase.call_count == 2
 
 
+@mock.patch("mozphab.mercurial.Mercurial._rewrite_stack")
+@mock.patch("mozphab.mercurial.Mercurial._amend_commit")
+@mock.patch("mozphab.mercurial.Mercurial.hg_out")
+def test_amend_commit(m_hg_out, m_amend_commit, m_rewrite_stack, hg):
+    hg.use_evolve = False
+    commits = [
+        Commit(node="aaa", title="A", body="same"),
+        Commit(node="bbb", title="B", body="updated"),
+    ]
+    m_hg_out.side_effect = ("A\nsame", "B\noriginal")
+    for commit in commits:
+        hg.amend_commit(commit, commits)
+
+    # The commits are amended together when finalizing.
+    m_rewrite_stack.return_value = True
+    m_rewrite_stack.assert_not_called()
+    hg.finalize(commits)
+    m_rewrite_stack.assert_called_once_with([(commits[1], commits, "B\nupdated")])
+    m_amend_commit.assert_not_called()
+
+    m_rewrite_stack.reset_mock()
+    hg.finalize(commits)
+    m_rewrite_stack.assert_not_called()
+
+    # Stacks which can't be rewritten at once are amended commit by commit.
+    m_hg_out.side_effect = ("B\noriginal",)
+    hg.amend_commit(commits[1], commits)
+    m_rewrite_stack.return_value = False
+    hg.finalize(commits)
+    m_amend_commit.assert_called_once_with(commits[1], commits, "B\nupdated")
+
+
+@mock.patch("mozphab.mercurial.Mercurial.finalize")
+def test_cleanup_amends_commits(m_finalize, hg):
+    commits = [Commit(node="aaa")]
+    hg._amends = [(commits[0], commits, "A\nupdated")]
+    hg.cleanup()
+    m_finalize.assert_called_once_with(commits)
+
+    m_finalize.reset_mock()
+    hg._amends = []
+    hg.cleanup()
+    m_finalize.assert_not_called()
+
+
+@mock.patch("mozphab.mercurial.Mercurial.checkout")
+@mock.patch("mozphab.mercurial.Mercurial.hg")
+def test_amend_commit_body(m_hg, m_checkout, hg):
+    # evolve rewrites the commit without a checkout
+    hg._amend_commit_body("aaa", "body")
+    m_checkout.assert_not_called()
+    m_hg.assert_called_once_with(["metaedit", "--rev", "aaa", "--logfile", mock.ANY])
+
+    m_hg.reset_mock()
+    hg.use_evolve = False
+    hg._amend_commit_body("aaa", "body")
+    m_checkout.assert_called_once_with("aaa")
+    m_hg.assert_called_once_with(["commit", "--amend", "--logfile", mock.ANY])
+
+
+@mock.patch("mozphab.mercurial.Mercurial._get_successors")
+def test_refresh_commit_stack(m_get_successors, hg):
+    commits = [
+        Commit(node="aaa", parent="000"),
+        Commit(node="bbb", parent="aaa"),
+        Commit(node="ccc", parent="bbb"),
+    ]
+    m_get_successors.return_value = {"bbb": ("4", "BBB"), "ccc": ("5", "CCC")}
+    hg.refresh_commit_stack(commits)
+    m_get_successors.assert_called_once_with(["aaa", "bbb", "ccc"])
+    assert [(c.node, c.parent) for c in commits] == [
+        ("aaa", "000"),
+        ("BBB", "aaa"),
+        ("CCC", "BBB"),
+    ]
+    assert hg.revset == "aaa::CCC"
+
+
+@mock.patch("mozphab.mercurial.Mercurial.hg_out")
+def test_commit_stack_branch_point(m_hg_out, hg):
+    hg.args = mock.Mock(force_delete=False)
+    hg.revset = "aaa::bbb"
+    hg.use_evolve = False
+
+    def log(boundary, children):
+        return "".join(
+            f"{rev}\n{node}\n0 0\nUser\nuser@example.com\n{child}\ntitle\n{boundary}"
+            for rev, node, child in zip((1, 2), ("aaa", "bbb"), children)
+        )
+
+    with mock.patch("mozphab.mercurial.uuid.uuid4") as m_uuid:
+        m_uuid.return_value.hex = "b"
+        m_hg_out.return_value = log("--b--\n", ["bbb", ""])
+        commits = hg.commit_stack()
+        assert [c.node for c in commits] == ["aaa", "bbb"]
+        # Children are listed by the same `hg log` call.
+        m_hg_out.assert_called_once()
+
+        m_hg_out.return_value = log("--b--\n", ["bbb ccc", ""])
+        with pytest.raises(exceptions.Error, match="DAG branch point"):
+            hg.commit_stack()
+
+        hg.use_evolve = True
+        assert len(hg.commit_stack()) == 2
+
+
+@mock.patch("mozphab.mercurial.Mercurial.hg_out")
+def test_set_diff_fingerprints(m_hg_out, hg):
+    hg.args = mock.Mock(lesscontext=False)
+    commits = [Commit(node="aaa"), Commit(node="bbb")]
+    m_hg_out.return_value = [
+        "000 fff man-0",
+        "aaa 000 man-a",
+        "bbb aaa man-b",
+    ]
+    hg.set_diff_fingerprints(commits)
+    assert m_hg_out.call_args[0][0][:3] == ["log", "-r", "aaa::bbb + p1(aaa)"]
+    assert commits[0].fingerprint == hg._diff_fingerprint("man-0", "man-a")
+    assert commits[1].fingerprint == hg._diff_fingerprint("man-a", "man-b")
+
+
 @mock.patch("mozphab.mercurial.Mercurial.rebase_commit")
 def test_finalize_no_evolve(m_hg_rebase, hg):
     hg.use_evolve = False
@@ -375,6 +514,25 @@ def test_hg_cat(m_hg, hg):
     assert cat == b"some text"
 
 
+@mock.patch("mozphab.mercurial.Mercurial.hg_out")
+def test_spool_file(m_hg, hg):
+    def cat(command, **kwargs):
+        Path(command[4].replace("%%", "%")).write_bytes(b"\0large")
+        return b""
+
+    m_hg.side_effect = cat
+    contents = hg._spool_file("fn", "node")
+    m_hg.assert_called_once_with(
+        ["cat", "-r", "node", "--output", mock.ANY, "fn"],
+        expect_binary=True,
+        split=False,
+    )
+    assert len(contents) == 6
+    with contents.view() as view:
+        assert view == b"\0large"
+    contents.close()
+
+
 @mock.patch("mozphab.mercurial.Mercurial.hg_out")
 def test_file_size(m_hg, hg):
     m_hg.return_value = "123\n"
@@ -385,6 +543,45 @@ def test_file_size(m_hg, hg):
     assert res == 123
 
 
+def test_split_patches():
+    git_diff = (
+        b"diff --git a/mod b/mod\n"
+        b"--- a/mod\n"
+        b"+++ b/mod\n"
+        b"@@ -1,1 +1,1 @@\n"
+        b"-a\n"
+        b"+b\n"
+        b"diff --git a/old b/new\n"
+        b"rename from old\n"
+        b"rename to new\n"
+        b"diff --git a/bin b/bin\n"
+        b"new file mode 100644\n"
+        b"Binary file bin has changed\n"
+    )
+    patches = mercurial.split_patches(git_diff)
+    assert list(patches) == ["mod", "new", "bin"]
+    assert patches["mod"].startswith(b"diff --git a/mod b/mod\n")
+    assert patches["mod"].endswith(b"+b\n")
+    assert patches["new"].endswith(b"rename to new\n")
+    assert patches["bin"] == (
+        b"diff --git a/bin b/bin\n"
+        b"new file mode 100644\n"
+        b"Binary file bin has changed\n"
+    )
+    assert mercurial.split_patches(b"") == {}
+
+
+def test_patch_body():
+    header = "diff --git a/fn b/fn\nnew file mode 100644\n--- /dev/null\n+++ b/fn\n"
+    assert mercurial.patch_body(header + "@@ -0,0 +1,2 @@\n+a\n+b\r\n") == "a\nb\r\n"
+    assert (
+        mercurial.patch_body(
+            header + "@@ -0,0 +1,2 @@\n+a\n+b\n\\ No newline at end of file\n"
+        )
+        == "a\nb"
+    )
+
+
 @mock.patch("mozphab.mercurial.Mercurial._file_size")
 @mock.patch("mozphab.mercurial.Mercurial.hg_cat")
 def test_file_meta(m_cat, m_file_size, hg):
@@ -398,15 +595,23 @@ def test_file_meta(m_cat, m_file_size, hg):
         "bin_body": b"spam\nham",
         "body": "spam\nham",
         "file_size": size,
+        "key": "rev:fn",
     }
 
+    # A NUL byte anywhere in the file makes it binary.
+    m_cat.return_value = b"text\n" * 2000 + b"\0"
+    meta = hg._get_file_meta("fn", "rev")
+    assert meta["binary"]
+    assert meta["body"] == m_cat.return_value
+
 
-@mock.patch("mozphab.mercurial.mimetypes")
+@mock.patch("mozphab.helpers.mimetypes")
 @mock.patch("mozphab.mercurial.Mercurial._file_size")
+@mock.patch("mozphab.mercurial.Mercurial._spool_file")
 @mock.patch("mozphab.mercurial.Mercurial.hg_cat")
-def test_file_meta_binary(m_cat, m_file_size, m_mime, hg):
+def test_file_meta_binary(m_cat, m_spool_file, m_file_size, m_mime, hg):
     m_mime.guess_type.return_value = ["MIMETYPE"]
-    m_cat.return_value = b"spam\nham"
+    m_spool_file.return_value = b"spam\nham"
     size = environment.MAX_TEXT_SIZE + 1
     m_file_size.return_value = size
     meta = hg._get_file_meta("fn", "rev")
@@ -416,11 +621,11 @@ def test_file_meta_binary(m_cat, m_file_size, m_mime, hg):
         "bin_body": b"spam\nham",
         "body": b"spam\nham",
         "file_size": size,
+        "key": "rev:fn",
     }
-
-    hg._get_file_meta.cache_clear()
-    hg.hg_cat.cache_clear()
-    hg._file_size.cache_clear()
+    # Files too big to be text aren't read.
+    m_cat.assert_not_called()
+    m_spool_file.assert_called_once_with("fn", "rev")
 
     size = environment.MAX_TEXT_SIZE - 1
     m_file_size.return_value = size
@@ -432,6 +637,7 @@ def test_file_meta_binary(m_cat, m_file_size, m_mime, hg):
         "bin_body": b"\0spam\nham",
         "body": b"\0spam\nham",
         "file_size": size,
+        "key": "rev:fn",
     }
 
 
@@ -468,6 +674,7 @@ def test_change_add(m_set_as_binary, m_get_file_meta, hg):
         "body": "abc\n",
         "file_size": 123,
         "mime": "MIME",
+        "key": "rev:fn",
     }
     hg._change_add(change, "fn", None, "parent", "node")
     assert not change.hunks
@@ -476,6 +683,7 @@ def test_change_add(m_set_as_binary, m_get_file_meta, hg):
         a_mime="",
         b_body=b"abc\n",
         b_mime="MIME",
+        b_key="rev:fn",
     )
 
     # empty
@@ -525,6 +733,7 @@ def test_change_del(m_set_as_binary, m_get_file_meta, hg):
         "body": "abc\n",
         "file_size": 123,
         "mime": "MIME",
+        "key": "rev:fn",
     }
     hg._change_del(change, "fn", None, "parent", "node")
     assert not change.hunks
@@ -533,6 +742,7 @@ def test_change_del(m_set_as_binary, m_get_file_meta, hg):
         a_mime="MIME",
         b_body="",
         b_mime="",
+        a_key="rev:fn",
     )
 
     # empty
@@ -579,7 +789,7 @@ diff --git a/fn b/fn
         ["diff"]
         + ["--git"]
         + ["--unified", str(environment.MAX_CONTEXT_SIZE)]
-        + ["--rev", "parent"]
+        + ["--rev", "parent", "--rev", "node"]
         + ["fn"],
         expect_binary=True,
     )
@@ -591,7 +801,8 @@ diff --git a/fn b/fn
     hg.args = Args(lesscontext=True)
     hg._change_mod(change, "fn", "old_fn", "parent", "node")
     m_hg_out.assert_called_once_with(
-        ["diff", "--git", "--unified", "100", "--rev", "parent", "fn"],
+        ["diff", "--git", "--unified", "100", "--rev", "parent", "--rev", "node"]
+        + ["fn"],
         expect_binary=True,
     )
 
@@ -604,6 +815,7 @@ diff --git a/fn b/fn
             "body": b"abc\n",
             "file_size": 4,
             "mime": "MIME",
+            "key": "parent:old_fn",
         },
         {
             "binary": False,
@@ -611,51 +823,53 @@ diff --git a/fn b/fn
             "body": "def\n",
             "file_size": 4,
             "mime": "TEXT",
+            "key": "node:fn",
         },
     )
     hg._change_mod(change, "fn", "old_fn", "parent", "node")
     m_set_as_binary.assert_called_once_with(
-        a_body=b"abc\n", a_mime="MIME", b_body=b"def\n", b_mime="TEXT"
+        a_body=b"abc\n",
+        a_mime="MIME",
+        b_body=b"def\n",
+        b_mime="TEXT",
+        a_key="parent:old_fn",
+        b_key="node:fn",
     )
 
 
 @mock.patch("mozphab.mercurial.Mercurial.hg_out")
-def test_get_file_modes(m_hg, hg):
-    m_hg.side_effect = (
-        ["  file name"],  # status
-        [" :file name"],  # files - parent
-        [" :file name"],  # files - node
-    )
-    actual = hg._get_file_modes(Commit(node="aaa", parent="bbb"))
-    expected = {"file name": {"old_mode": "100644", "new_mode": "100644"}}
-    assert actual == expected
-
-    m_hg.side_effect = (
-        ["M file name"],  # status
-        [" :file name"],  # files - parent
-        ["x:file name"],  # files - node
-    )
-    actual = hg._get_file_modes(Commit(node="aaa", parent="bbb"))
-    expected = {"file name": {"old_mode": "100644", "new_mode": "100755"}}
-    assert actual == expected
-
-    m_hg.side_effect = (
-        ["A file name"],  # status
-        [],  # files - parent
-        ["x:file name"],  # files - node
-    )
-    actual = hg._get_file_modes(Commit(node="aaa", parent="bbb"))
-    expected = {"file name": {"new_mode": "100755"}}
-    assert actual == expected
-
-    m_hg.side_effect = (
-        ["R file name"],  # status
-        [" :file name"],  # files - parent
-        [],  # files - node
+def test_hg_files(m_hg, hg):
+    def hg_out(args):
+        with open(args[-1][len("listfile0:") :]) as f:
+            patterns.append(f.read())
+        return ["12\t\tfn", "0\tx\tdir/with space", "3\tl\tlink"]
+
+    patterns = []
+    m_hg.side_effect = hg_out
+    assert hg.hg_files("rev", ["fn", "dir/with space", "link"]) == {
+        "fn": {"size": 12, "mode": "100644"},
+        "dir/with space": {"size": 0, "mode": "100755"},
+        "link": {"size": 3, "mode": "100644"},
+    }
+    m_hg.assert_called_once_with(
+        ["files", "-r", "rev", "-T", "{size}\t{flags}\t{path}\n"] + [mock.ANY]
     )
-    actual = hg._get_file_modes(Commit(node="aaa", parent="bbb"))
-    expected = {"file name": {"old_mode": "100644"}}
-    assert actual == expected
+    # The files are listed in a file instead of the command.
+    assert patterns == ["path:fn\0path:dir/with space\0path:link\0"]
+    # The sizes are reused when asked for a single file.
+    assert hg._file_size("fn", "rev") == 12
+    m_hg.assert_called_once()
+
+    # Nothing is asked without files.
+    assert hg.hg_files("rev", []) == {}
+    m_hg.assert_called_once()
+
+    m_hg.side_effect = exceptions.CommandError("no files", 1)
+    assert hg.hg_files("rev", ["gone"]) == {}
+
+    m_hg.side_effect = exceptions.CommandError("abort", 255)
+    with pytest.raises(exceptions.CommandError):
+        hg.hg_files("rev", ["fn"])
 
 
 def test_check_vcs(hg):
@@ -2,6 +2,7 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import json
 import os
 import pathlib
 import platform
@@ -430,8 +431,6 @@ def test_submit_create_no_checkout(in_process, git_repo_path: pathlib.Path, init
         {"phid": "PHID-DIFF-1", "diffid": "1"},
         # differential.revision.edit
         {"object": {"id": "123", "phid": "PHID-DREV-123"}},
-        # differential.setdiffproperty
-        {},
         # Second diff
         # differential.creatediff
         {"phid": "PHID-DIFF-2", "diffid": "2"},
@@ -439,6 +438,8 @@ def test_submit_create_no_checkout(in_process, git_repo_path: pathlib.Path, init
         {"object": {"id": "124", "phid": "PHID-DREV-124"}},
         # differential.setdiffproperty
         {},
+        # differential.setdiffproperty
+        {},
     )
 
     git_out("checkout", "-qb", "first")
@@ -538,6 +539,8 @@ def test_submit_update(in_process, git_repo_path: pathlib.Path, init_sha):
         {"data": [search_rev(rev=123, reviewers=["alice"])]},
         # diffusion.diff.search
         {"data": [search_diff()]},
+        # differential.querydiffs
+        {},
         # whoami
         {"phid": "PHID-USER-1"},
         # user.query
@@ -596,6 +599,8 @@ def test_submit_update_uplift(in_process, git_repo_path: pathlib.Path, init_sha)
         {"data": [search_rev(rev=1000, repo="PHID-REPO-BETA", reviewers=["#group"])]},
         # differential.diff.search
         {"data": [search_diff()]},
+        # differential.querydiffs
+        {},
         # user.whoami
         {"phid": "PHID-USER-1"},
         # differential.creatediff
@@ -843,6 +848,7 @@ def test_submit_update_no_message(in_process, git_repo_path: pathlib.Path, init_
         {"data": [{"phid": "PHID-REPO-1", "fields": {"vcs": "git"}}]},
         {"data": [search_rev(rev=123)]},
         {"data": [search_diff()]},
+        {},
         {"phid": "PHID-USER-1"},
         # differential.creatediff
         {"phid": "PHID-DIFF-1", "diffid": "1"},
@@ -875,6 +881,75 @@ Differential Revision: http://example.test/D123
     assert log == expected
 
 
+def test_submit_update_unchanged_diff(
+    in_process, git_repo_path: pathlib.Path, init_sha
+):
+    call_conduit.reset_mock()
+    call_conduit.side_effect = (
+        # ping
+        {},
+        # diffusion.repository.search
+        {"data": [{"phid": "PHID-REPO-1", "fields": {"vcs": "git"}}]},
+        # differential.creatediff
+        {"phid": "PHID-DIFF-1", "diffid": "1"},
+        # differential.revision.edit
+        {"object": {"id": "123", "phid": "PHID-DREV-123"}},
+        # differential.setdiffproperty
+        {},
+    )
+    (git_repo_path / "X").write_text("ą", encoding="utf-8")
+    git_out("add", ".")
+    git_out("commit", "--message", "Bug 1 - Ą")
+    mozphab.main(["submit", "--yes", "--no-wip", init_sha], is_development=True)
+
+    submitted_sha = git_out("rev-parse", "HEAD").strip()
+    local_commits = json.loads(call_conduit.call_args_list[-1][0][1]["data"])
+    fingerprint = local_commits[submitted_sha]["fingerprint"]
+
+    # Only the commit message changes.
+    git_out(
+        "commit",
+        "--amend",
+        "--message",
+        "Bug 1 - Ą edited\n\nDifferential Revision: http://example.test/D123",
+    )
+    call_conduit.reset_mock()
+    call_conduit.side_effect = (
+        # differential.revision.search
+        {"data": [search_rev(rev=123)]},
+        # differential.diff.search
+        {"data": [search_diff(node=submitted_sha)]},
+        # differential.querydiffs
+        {
+            "1": {
+                "id": "1",
+                "properties": {
+                    "local:commits": {submitted_sha: {"fingerprint": fingerprint}}
+                },
+            }
+        },
+        # user.whoami
+        {"phid": "PHID-USER-1"},
+        # differential.revision.edit
+        {"object": {"id": "123", "phid": "PHID-DREV-123"}},
+    )
+    mozphab.main(["submit", "--yes", "--no-wip", init_sha], is_development=True)
+
+    assert call_conduit.call_args_list[2] == mock.call(
+        "differential.querydiffs", {"ids": [1]}
+    )
+    assert call_conduit.call_args_list[-1] == mock.call(
+        "differential.revision.edit",
+        {
+            "objectIdentifier": 123,
+            "transactions": [
+                {"type": "title", "value": "Bug 1 - Ą edited"},
+                {"type": "summary", "value": ""},
+            ],
+        },
+    )
+
+
 def test_submit_update_revision_not_found(
     in_process, git_repo_path: pathlib.Path, init_sha
 ):
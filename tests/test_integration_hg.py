@@ -11,6 +11,8 @@ import pytest
 from callee import Contains, Matching, StartsWith
 
 from mozphab import mozphab
+from mozphab.conduit import ConduitAPIError
+from mozphab.mercurial import Mercurial
 
 from .conftest import hg_out, write_text
 
@@ -724,11 +726,9 @@ def test_submit_create_no_checkout(in_process, hg_repo_path):
     checkout prior to generating diffs.
 
     This is a counterpart to test_integration_git.test_submit_create_no_checkout
-    and is named the same for ease of localisation. It doesn't however, test
-    that the Hg logic doesn't do checkouts during submissions. Currently, it
-    very much does, and diffs for files touched by multiple commits end up
-    containing, incorrectly, all the changes up to the tip of the branche (see
-    bug 1926924).
+    and is named the same for ease of localisation. The diffs are read from the
+    store without updating the working directory, so diffs for files touched by
+    multiple commits only contain the changes of their commit (see bug 1926924).
     """
     call_conduit.reset_mock()
     call_conduit.side_effect = (
@@ -742,8 +742,6 @@ def test_submit_create_no_checkout(in_process, hg_repo_path):
         {"phid": "PHID-DIFF-1", "diffid": "1"},
         # differential.revision.edit
         {"object": {"id": "123", "phid": "PHID-DREV-123"}},
-        # differential.setdiffproperty
-        {},
         # Second diff
         # differential.creatediff
         {"phid": "PHID-DIFF-2", "diffid": "2"},
@@ -751,6 +749,8 @@ def test_submit_create_no_checkout(in_process, hg_repo_path):
         {"object": {"id": "124", "phid": "PHID-DREV-124"}},
         # differential.setdiffproperty
         {},
+        # differential.setdiffproperty
+        {},
     )
     a_rename = hg_repo_path / "A to rename"
     write_text(a_rename, "rename me\nsecond line\n")
@@ -1115,6 +1115,247 @@ A
     assert log == expected
 
 
+def disable_evolve():
+    with open(".hg/hgrc", "a") as f:
+        f.write("[extensions]\nevolve = !\n")
+    get_extension = Mercurial._get_extension
+    return mock.patch.object(
+        Mercurial,
+        "_get_extension",
+        side_effect=lambda name, hg_config: (
+            None if name == "evolve" else get_extension(name, hg_config)
+        ),
+    )
+
+
+def test_submit_stack_no_evolve(in_process, hg_repo_path):
+    hg_out("phase", "--public", ".")
+    call_conduit.side_effect = (
+        # ping
+        {},
+        # diffusion.repository.search
+        {"data": [{"phid": "PHID-REPO-1", "fields": {"vcs": "hg"}}]},
+        # differential.creatediff
+        {"phid": "PHID-DIFF-1", "diffid": "1"},
+        # differential.revision.edit
+        {"object": {"id": "1", "phid": "PHID-DREV-1"}},
+        # differential.creatediff
+        {"phid": "PHID-DIFF-2", "diffid": "2"},
+        # differential.revision.edit
+        {"object": {"id": "2", "phid": "PHID-DREV-2"}},
+        # differential.setdiffproperty
+        {},
+        {},
+    )
+    write_text(hg_repo_path / "X", "a\n")
+    hg_out("add", "X")
+    hg_out("commit", "-m", "A")
+    write_text(hg_repo_path / "X", "b\n")
+    hg_out("commit", "-m", "B")
+    hg_out("bookmark", "stack")
+
+    with disable_evolve(), mock.patch.object(
+        Mercurial, "checkout", autospec=True, side_effect=Mercurial.checkout
+    ) as m_checkout:
+        mozphab.main(["submit", "--yes", "--bug", "1"], is_development=True)
+
+    # The stack is rewritten at once.
+    assert m_checkout.call_count == 1
+    log = hg_out("log", "--hidden", "--template", r"{desc}|{bookmarks}\n---\n")
+    expected = """\
+Bug 1 - B
+
+Differential Revision: http://example.test/D2|stack
+---
+Bug 1 - A
+
+Differential Revision: http://example.test/D1|
+---
+init|
+---
+"""
+    assert log == expected
+    assert hg_out("log", "-r", ".", "-T", "{desc|firstline}") == "Bug 1 - B"
+    assert hg_out("cat", "-r", ".", "X") == "b\n"
+    assert not os.path.exists(".hg/store/obsstore")
+
+
+def test_submit_stack_no_evolve_diff_config(in_process, hg_repo_path):
+    hg_out("phase", "--public", ".")
+    call_conduit.side_effect = (
+        # ping
+        {},
+        # diffusion.repository.search
+        {"data": [{"phid": "PHID-REPO-1", "fields": {"vcs": "hg"}}]},
+        # differential.creatediff
+        {"phid": "PHID-DIFF-1", "diffid": "1"},
+        # differential.revision.edit
+        {"object": {"id": "1", "phid": "PHID-DREV-1"}},
+        # differential.creatediff
+        {"phid": "PHID-DIFF-2", "diffid": "2"},
+        # differential.revision.edit
+        {"object": {"id": "2", "phid": "PHID-DREV-2"}},
+        # differential.setdiffproperty
+        {},
+        {},
+    )
+    write_text(hg_repo_path / "X", "a\n\nb\n")
+    hg_out("add", "X")
+    hg_out("commit", "-m", "A")
+    write_text(hg_repo_path / "X", "a \n\n\nb\tb\n")
+    hg_out("commit", "-m", "B")
+    with open(".hg/hgrc", "a") as f:
+        f.write(
+            "[diff]\nignorews = true\nignoreblanklines = true\nnoprefix = true\n"
+            "[defaults]\ndiff = --ignore-all-space\n"
+        )
+
+    with disable_evolve():
+        mozphab.main(["submit", "--yes", "--bug", "1"], is_development=True)
+
+    # The whitespace changes ignored by the diff options are kept.
+    assert hg_out("log", "-r", ".^", "-T", "{desc|firstline}") == "Bug 1 - A"
+    assert hg_out("cat", "-r", ".^", "X") == "a\n\nb\n"
+    assert hg_out("log", "-r", ".", "-T", "{desc|firstline}") == "Bug 1 - B"
+    assert hg_out("cat", "-r", ".", "X") == "a \n\n\nb\tb\n"
+
+
+def test_submit_stack_no_evolve_extras(in_process, hg_repo_path):
+    hg_out("phase", "--public", ".")
+    call_conduit.side_effect = (
+        # ping
+        {},
+        # diffusion.repository.search
+        {"data": [{"phid": "PHID-REPO-1", "fields": {"vcs": "hg"}}]},
+        # differential.creatediff
+        {"phid": "PHID-DIFF-1", "diffid": "1"},
+        # differential.revision.edit
+        {"object": {"id": "1", "phid": "PHID-DREV-1"}},
+        # differential.setdiffproperty
+        {},
+    )
+    write_text(hg_repo_path / "X", "a\n")
+    hg_out("add", "X")
+    hg_out("commit", "-m", "A", "--config", "extensions.topic=", "--topic", "T")
+
+    with disable_evolve():
+        mozphab.main(["submit", "--yes", "--bug", "1"], is_development=True)
+
+    # The commit is amended as its extras can't be imported.
+    assert hg_out("log", "-r", ".", "-T", "{desc|firstline}") == "Bug 1 - A"
+    assert hg_out("log", "-r", ".", "-T", "{extras % '{key} '}") == (
+        "amend_source branch topic "
+    )
+
+
+def test_submit_single_first_no_evolve(in_process, hg_repo_path, hg_sha):
+    call_conduit.side_effect = (
+        # ping
+        {},
+        # diffusion.repository.search
+        {"data": [{"phid": "PHID-REPO-1", "fields": {"vcs": "hg"}}]},
+        # differential.creatediff
+        {"phid": "PHID-DIFF-1", "diffid": "1"},
+        # differential.revision.edit
+        {"object": {"id": "123", "phid": "PHID-DREV-123"}},
+        # differential.setdiffproperty
+        {},
+    )
+    write_text(hg_repo_path / "X", "a\n")
+    hg_out("add", "X")
+    hg_out("commit", "-m", "A")
+    sha = hg_sha()
+    write_text(hg_repo_path / "X", "b\n")
+    hg_out("commit", "-m", "B")
+
+    with disable_evolve():
+        mozphab.main(
+            ["submit", "--yes", "--bug", "1", "--single", sha], is_development=True
+        )
+
+    # The child of the commit is rebased on the rewritten commit.
+    log = hg_out("log", "--hidden", "--graph", "--template", r"{desc|firstline}\n")
+    expected = """\
+@  B
+|
+o  Bug 1 - A
+|
+o  init
+
+"""
+    assert log == expected
+
+
+def test_submit_stack_failure(in_process, hg_repo_path):
+    hg_out("phase", "--public", ".")
+    call_conduit.side_effect = (
+        # ping
+        {},
+        # diffusion.repository.search
+        {"data": [{"phid": "PHID-REPO-1", "fields": {"vcs": "hg"}}]},
+        # differential.creatediff
+        {"phid": "PHID-DIFF-1", "diffid": "1"},
+        # differential.revision.edit
+        {"object": {"id": "1", "phid": "PHID-DREV-1"}},
+        # differential.creatediff
+        ConduitAPIError("failed"),
+    )
+    write_text(hg_repo_path / "X", "a\n")
+    hg_out("add", "X")
+    hg_out("commit", "-m", "A")
+    write_text(hg_repo_path / "X", "b\n")
+    hg_out("commit", "-m", "B")
+
+    with pytest.raises(ConduitAPIError):
+        mozphab.main(["submit", "--yes", "--bug", "1"], is_development=True)
+
+    # The submitted commit keeps its revision URL.
+    log = hg_out("log", "--template", r"{desc}\n---\n")
+    expected = """\
+B
+---
+Bug 1 - A
+
+Differential Revision: http://example.test/D1
+---
+init
+---
+"""
+    assert log == expected
+    # The failure isn't followed by other Conduit calls which could hide it.
+    assert call_conduit.call_args_list[-1] == mock.call(
+        "differential.creatediff", mock.ANY
+    )
+
+
+def test_submit_root_commit(in_process, hg_repo_path, hg_sha):
+    call_conduit.reset_mock()
+    call_conduit.side_effect = (
+        # ping
+        {},
+        # diffusion.repository.search
+        {"data": [{"phid": "PHID-REPO-1", "fields": {"vcs": "hg"}}]},
+        # differential.creatediff
+        {"phid": "PHID-DIFF-1", "diffid": "1"},
+        # differential.revision.edit
+        {"object": {"id": "123", "phid": "PHID-DREV-123"}},
+        # differential.setdiffproperty
+        {},
+    )
+    sha = hg_sha()
+
+    mozphab.main(
+        ["submit", "--yes", "--bug", "1", "--single", sha], is_development=True
+    )
+
+    # The files of a commit without parent are added.
+    changes = call_conduit.call_args_list[2][0][1]["changes"]
+    assert [
+        (c["currentPath"], c["oldProperties"], c["newProperties"], len(c["hunks"]))
+        for c in changes
+    ] == [(".arcconfig", {}, {"unix:filemode": "100644"}, 1)]
+
+
 def test_multiple_copy(in_process, hg_repo_path):
     call_conduit.side_effect = (
         # ping
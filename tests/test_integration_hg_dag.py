@@ -64,11 +64,18 @@ def _conduit_side_effect(calls=1):
                 {"phid": "PHID-DIFF-{}".format(i), "diffid": str(i)},
                 # differential.revision.edit
                 {"object": {"id": str(123 + i), "phid": f"PHID-DREV-{str(123 + 1)}"}},
-                # differential.setdiffproperty
-                {},
             ]
         )
 
+    # The diff properties are set once all the commits are amended.
+    side_effect.extend(
+        [
+            # differential.setdiffproperty
+            {},
+        ]
+        * calls
+    )
+
     return side_effect
 
 
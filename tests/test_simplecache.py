@@ -0,0 +1,155 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+from unittest import mock
+
+import pytest
+
+from mozphab import simplecache
+from mozphab.simplecache import ContentCache, SimpleCache, persistent_cache_path
+
+
+@pytest.fixture
+def path(tmp_path):
+    return tmp_path / "cache" / "phab.test.json"
+
+
+def test_persistent_cache_path():
+    path = persistent_cache_path("https://phab.test:8080/api/")
+    assert path.name == "phab.test_8080.json"
+    assert path.parent.name == "cache"
+
+
+def test_persistence(path):
+    cache = SimpleCache()
+    cache.enable_persistence(path)
+    cache.set("user-Alice", {"userName": "alice"})
+    cache.set("whoami", {"phid": "PHID-USER-1"})
+    cache.set("api_token", "cli-secret")
+    cache.set("arcrc", "/home/.arcrc")
+    cache.save()
+
+    assert set(json.loads(path.read_text())) == {"user-alice", "whoami"}
+
+    cache = SimpleCache()
+    cache.enable_persistence(path)
+    assert cache.get("USER-alice") == {"userName": "alice"}
+    assert "whoami" in cache
+    assert "api_token" not in cache
+
+
+def test_expired_entries_are_ignored(path):
+    cache = SimpleCache()
+    cache.enable_persistence(path)
+    cache.set("user-alice", {})
+    cache.set("whoami", {})
+    cache.save()
+
+    now = simplecache.time.time()
+    with mock.patch("mozphab.simplecache.time.time") as m_time:
+        m_time.return_value = now + simplecache.DAY
+        cache = SimpleCache()
+        cache.enable_persistence(path)
+        assert "user-alice" not in cache
+        assert "whoami" in cache
+
+
+def test_revalidation(path):
+    cache = SimpleCache()
+    cache.enable_persistence(path)
+    cache.set("rev-PHID-DREV-1", {"id": 1})
+    cache.set("rev-id-1", "PHID-DREV-1")
+    assert not cache.needs_revalidation("rev-PHID-DREV-1")
+    cache.save()
+
+    cache = SimpleCache()
+    cache.enable_persistence(path)
+    assert cache.needs_revalidation("rev-PHID-DREV-1")
+    assert not cache.needs_revalidation("rev-id-1")
+    cache.set("rev-PHID-DREV-1", {"id": 1})
+    assert not cache.needs_revalidation("rev-PHID-DREV-1")
+
+
+def test_save_merges_other_processes(path):
+    first = SimpleCache()
+    first.enable_persistence(path)
+    second = SimpleCache()
+    second.enable_persistence(path)
+
+    first.set("user-alice", {})
+    first.save()
+    second.set("user-bob", {})
+    second.save()
+    assert set(json.loads(path.read_text())) == {"user-alice", "user-bob"}
+
+    third = SimpleCache()
+    third.enable_persistence(path)
+    third.delete("user-alice")
+    third.save()
+    assert set(json.loads(path.read_text())) == {"user-bob"}
+    # No temporary files are left behind.
+    assert [p.name for p in path.parent.iterdir()] == [path.name]
+
+
+@mock.patch("mozphab.simplecache.PERSISTENT_MAX_ENTRIES", 2)
+def test_lru_eviction(path):
+    cache = SimpleCache()
+    cache.enable_persistence(path)
+    cache.set("user-a", {})
+    cache.set("user-b", {})
+    cache.save()
+
+    now = simplecache.time.time()
+    with mock.patch("mozphab.simplecache.time.time") as m_time:
+        m_time.return_value = now + 60
+        cache = SimpleCache()
+        cache.enable_persistence(path)
+        cache.get("user-a")
+        cache.set("user-c", {})
+        cache.save()
+
+    assert set(json.loads(path.read_text())) == {"user-a", "user-c"}
+
+
+def test_corrupted_file(path):
+    path.parent.mkdir()
+    path.write_text("{not json")
+    cache = SimpleCache()
+    cache.enable_persistence(path)
+    cache.set("user-a", {})
+    cache.save()
+    assert set(json.loads(path.read_text())) == {"user-a"}
+
+
+def test_content_cache():
+    cache = ContentCache(max_bytes=10)
+    cache.set("a", b"1234")
+    cache.set("b", b"5678")
+    assert cache.get("a") == b"1234"
+    assert cache.get("c") is None
+
+    # "b" is the least recently used.
+    cache.set("c", b"90")
+    cache.set("d", b"ab")
+    assert "b" not in cache
+    assert [cache.get(key) for key in "acd"] == [b"1234", b"90", b"ab"]
+    assert cache.size == 8
+
+    # Contents larger than the budget aren't stored.
+    cache.set("e", b"x" * 11)
+    assert "e" not in cache
+    assert cache.size == 8
+
+    cache.set("a", b"12", size=1)
+    assert cache.size == 5
+
+    assert (cache.hits, cache.misses, cache.evictions) == (4, 1, 1)
+    with mock.patch("mozphab.simplecache.logger") as m_logger:
+        cache.log_stats()
+    m_logger.debug.assert_called_once_with(mock.ANY, 4, 1, 1, 5, 3)
+
+    cache.clear()
+    assert "a" not in cache
+    assert (cache.size, cache.hits, cache.misses, cache.evictions) == (0, 0, 0, 0)
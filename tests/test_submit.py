@@ -8,6 +8,7 @@ import unittest
 import uuid
 from unittest import mock
 
+import pytest
 from callee import Contains
 
 from mozphab import environment, exceptions, helpers, mozphab, repository
@@ -1048,5 +1049,134 @@ class TestUpdateCommitSummary(unittest.TestCase):
         self.assertEqual([], transactions)
 
 
+@mock.patch("mozphab.commands.submit.conduit.get_diff_fingerprints")
+@mock.patch("mozphab.commands.submit.conduit.get_revisions")
+@mock.patch("mozphab.commands.submit.conduit.get_diffs")
+@mock.patch("mozphab.commands.submit.conduit.whoami")
+def test_show_commit_stack_unchanged_diff(
+    m_whoami, m_get_diffs, m_get_revisions, m_get_fingerprints
+):
+    args = mock.Mock(force=False)
+    m_whoami.return_value = {"phid": "PHID-USER-1"}
+    m_get_revisions.return_value = [
+        search_rev(rev=1, phid="PHID-DREV-1", diff="PHID-DIFF-1"),
+        search_rev(rev=2, phid="PHID-DREV-2", diff="PHID-DIFF-2"),
+        search_rev(rev=3, phid="PHID-DREV-3", diff="PHID-DIFF-3"),
+        search_rev(rev=4, phid="PHID-DREV-4", diff="PHID-DIFF-4"),
+    ]
+    m_get_diffs.return_value = {
+        "PHID-DIFF-1": search_diff(diff=1, phid="PHID-DIFF-1", node="old1"),
+        "PHID-DIFF-2": search_diff(diff=2, phid="PHID-DIFF-2", node="old2"),
+        "PHID-DIFF-3": search_diff(diff=3, phid="PHID-DIFF-3", node="same"),
+        "PHID-DIFF-4": search_diff(diff=4, phid="PHID-DIFF-4", node="same4"),
+    }
+    m_get_fingerprints.return_value = {1: "fp1", 2: "fp-old"}
+    commits = [commit(rev_id=rev_id, bug_id="1") for rev_id in (1, 2, 3, 4)]
+    for c, fingerprint in zip(commits, ("fp1", "fp2", "fp3", "fp4")):
+        c.fingerprint = fingerprint
+    commits[2].node = "same"
+    # The revision is updated to WIP, from a commit with the same SHA1.
+    commits[3].node = "same4"
+    commits[3].wip = True
+
+    submit.show_commit_stack(commits, args)
+
+    # Diffs of commits with an unchanged SHA1 aren't compared.
+    m_get_fingerprints.assert_called_once_with([1, 2])
+    assert [(c.submit, c.skip_diff) for c in commits] == [
+        (True, True),
+        (True, False),
+        (False, False),
+        (True, True),
+    ]
+
+    args.force = True
+    m_get_fingerprints.reset_mock()
+    commits = [commit(rev_id=1, bug_id="1")]
+    commits[0].fingerprint = "fp1"
+    submit.show_commit_stack(commits, args)
+    m_get_fingerprints.assert_not_called()
+    assert not commits[0].skip_diff
+
+
+class FakeRepository:
+    def __init__(self, fail_on=None):
+        self.fail_on = fail_on
+        self.created = []
+
+    def get_diff(self, commit):
+        if commit is self.fail_on:
+            raise exceptions.Error("diff failed")
+        self.created.append(commit)
+        return mock.sentinel.diff, commit.node
+
+
+def test_diff_pipeline():
+    commits = [commit() for _i in range(6)]
+    commits[1].submit = False
+    commits[5].skip_diff = True
+    repo = FakeRepository()
+    with submit.DiffPipeline(repo, commits, 2) as pipeline:
+        assert pipeline._thread
+        for c in commits:
+            if c.submit and not c.skip_diff:
+                assert pipeline.get_diff(c) == (mock.sentinel.diff, c.node)
+
+    assert repo.created == [commits[0], commits[2], commits[3], commits[4]]
+    assert not pipeline._thread.is_alive()
+
+
+def test_diff_pipeline_error():
+    commits = [commit() for _i in range(3)]
+    repo = FakeRepository(fail_on=commits[1])
+    with submit.DiffPipeline(repo, commits, 2) as pipeline:
+        pipeline.get_diff(commits[0])
+        with pytest.raises(exceptions.Error, match="diff failed"):
+            pipeline.get_diff(commits[1])
+
+    assert repo.created == [commits[0]]
+
+
+def test_diff_pipeline_stops_early():
+    commits = [commit() for _i in range(5)]
+    repo = FakeRepository()
+    with pytest.raises(exceptions.Error):
+        with submit.DiffPipeline(repo, commits, 1) as pipeline:
+            pipeline.get_diff(commits[0])
+            raise exceptions.Error("submission failed")
+
+    assert not pipeline._thread.is_alive()
+    assert len(repo.created) < len(commits)
+
+
+def test_diff_pipeline_disabled():
+    commits = [commit() for _i in range(3)]
+    repo = FakeRepository()
+    with submit.DiffPipeline(repo, commits, 0) as pipeline:
+        assert pipeline._thread is None
+        assert repo.created == []
+        pipeline.get_diff(commits[0])
+        assert repo.created == [commits[0]]
+
+
+def test_finish_submission():
+    commits = [commit(), commit()]
+    commits[1].parent = commits[0].node
+    repo = mock.Mock()
+    submit._finish_submission(repo, mock.Mock(command="submit"), commits)
+
+    # The amended commits are looked up together before they're written.
+    assert [call[0] for call in repo.method_calls] == [
+        "load_public_nodes",
+        "finalize",
+        "after_submit",
+        "cleanup",
+        "refresh_commit_stack",
+    ]
+    repo.load_public_nodes.assert_called_once_with(
+        [commits[0].node, commits[1].node, commits[0].node]
+    )
+
+
 if __name__ == "__main__":
     unittest.main()